@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: abekthink
+
+import asyncio
+import ssl
+import weakref
+import requests
+import metrics
+
+import urllib.parse as urlparse
+from requests.structures import CaseInsensitiveDict
+
+from dns_cache import open_connection
+from util import ConnectionPool, connection_pool, rate_limiter, fix_url, is_url_localhost, url_pool_key, \
+    lookup_http_cache, request_headers, read_response, feed_extractor, StreamingExtract, observe_request, \
+    get_request_type, url_net_loc, Timer, http_log, throttle_log
+
+MAX_REDIRECTS = 30
+MAX_HEADERS = 100
+READ_CHUNK_SIZE = 64 * 1024
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+_ssl_context = None
+
+
+def get_ssl_context():
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = ssl.create_default_context()
+    return _ssl_context
+
+
+class AsyncResponse(object):
+    def __init__(self, url, status_code, reason, headers, connection):
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = None
+        self.connection = connection
+        # set when the body is left to the caller and the connection may go back to the pool afterwards
+        self.pool = None
+        self.pool_key = None
+
+    def release(self):
+        if self.connection is not None and self.pool_key:
+            self.pool.release(self.pool_key, self.connection)
+            self.connection = None
+        self.close()
+
+    def close(self):
+        # a connection released back to the pool is no longer owned by the response
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+async def _read(coro, timeout, url):
+    try:
+        return await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        raise requests.ReadTimeout('Read timed out. url = %s' % url)
+
+
+async def read_status_and_headers(reader, url, timeout):
+    # both 'HTTP/1.x 200 OK' and the shoutcast style 'ICY 200 OK' status lines are accepted
+    line = await _read(reader.readline(), timeout, url)
+    if not line:
+        raise requests.ConnectionError('Connection closed before the status line. url = %s' % url)
+    parts = line.decode('latin-1').strip().split(None, 2)
+    if len(parts) < 2 or not (parts[0].startswith('HTTP/') or parts[0] == 'ICY') or not parts[1].isdigit():
+        raise requests.ConnectionError('Bad status line %r. url = %s' % (line, url))
+    version = parts[0]
+    status_code = int(parts[1])
+    reason = parts[2] if len(parts) > 2 else ''
+
+    headers = CaseInsensitiveDict()
+    for _ in range(MAX_HEADERS):
+        line = await _read(reader.readline(), timeout, url)
+        if not line or line in (b'\r\n', b'\n'):
+            break
+        name, sep, value = line.decode('latin-1').partition(':')
+        if not sep:
+            continue
+        name, value = name.strip(), value.strip()
+        if name in headers:
+            headers[name] = headers[name] + ', ' + value
+        else:
+            headers[name] = value
+    else:
+        raise requests.ConnectionError('Got more than %d headers. url = %s' % (MAX_HEADERS, url))
+    return version, status_code, reason, headers
+
+
+async def iter_body(res, method, timeout, chunk_size=READ_CHUNK_SIZE):
+    reader = res.connection.reader
+    if method == 'HEAD' or res.status_code in (204, 304) or 100 <= res.status_code < 200:
+        return
+
+    if 'chunked' in res.headers.get('transfer-encoding', '').lower():
+        while True:
+            line = await _read(reader.readline(), timeout, res.url)
+            try:
+                size = int(line.split(b';')[0].strip(), 16)
+            except ValueError:
+                raise requests.exceptions.ChunkedEncodingError('Bad chunk size %r. url = %s' % (line, res.url))
+            if size == 0:
+                break
+            try:
+                while size > 0:
+                    chunk = await _read(reader.readexactly(min(size, chunk_size)), timeout, res.url)
+                    size -= len(chunk)
+                    yield chunk
+                await _read(reader.readline(), timeout, res.url)
+            except asyncio.IncompleteReadError:
+                raise requests.exceptions.ChunkedEncodingError('Connection broken. url = %s' % res.url)
+        return
+
+    length = res.headers.get('content-length')
+    if length is not None and length.isdigit():
+        size = int(length)
+        try:
+            while size > 0:
+                chunk = await _read(reader.readexactly(min(size, chunk_size)), timeout, res.url)
+                size -= len(chunk)
+                yield chunk
+        except asyncio.IncompleteReadError:
+            raise requests.exceptions.ChunkedEncodingError('Connection broken. url = %s' % res.url)
+        return
+
+    while True:
+        chunk = await _read(reader.read(chunk_size), timeout, res.url)
+        if not chunk:
+            break
+        yield chunk
+
+
+async def read_body(res, method, timeout):
+    chunks = []
+    async for chunk in iter_body(res, method, timeout):
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+class AsyncHttpClient(object):
+    """
+    asyncio counterpart of util.HttpClient, it speaks plain HTTP/1.1 over asyncio streams,
+    so thousands of requests can be in flight from one event loop.
+    """
+
+    def __init__(self, **kwargs):
+        self.rate_limiter = kwargs.get('rate_limiter', rate_limiter)
+        self.http_timeout = kwargs.get('http_timeout', 10)
+        self.connection_pool = kwargs.get('connection_pool')
+        self.http_cache = kwargs.get('http_cache')
+        self.controller = kwargs.get('controller')
+        self.dns_cache = kwargs.get('dns_cache')
+
+    def set_requests_per_second(self, requests_per_second):
+        # the limiter is shared, so this changes the default rate of every host for all clients
+        self.rate_limiter.set_rate(requests_per_second)
+
+    def set_http_timeout(self, http_timeout):
+        self.http_timeout = http_timeout
+
+    async def get_url(self, url, proxy=False, method='GET', data=None, max_size=None, http_timeout=None,
+                      stream=False, throttle=True, ensure_utf8=True, cache_class=None, extractor=None):
+        http_log.debug("GET URL", url=url)
+        request_type = get_request_type(url, stream, cache_class)
+        cache, cache_entry, cache_class = lookup_http_cache(self.http_cache, url, method, stream, cache_class)
+        if cache_entry:
+            res = cache.fresh_response(cache_entry, cache_class)
+            if res:
+                return feed_extractor(read_response(res, url, max_size=max_size, ensure_utf8=ensure_utf8), extractor)
+        streaming_extract = extractor is not None and cache is None
+
+        if throttle:
+            delay = self.rate_limiter.reserve(fix_url(url))
+            if delay > 0:
+                await asyncio.sleep(delay)
+                metrics.observe_throttle(url_net_loc(url), delay)
+                throttle_log.info("GET URL throttle", delay=round(delay, 3), url=url)
+
+        headers = request_headers(stream)
+        if cache_entry:
+            headers.update(cache.conditional_headers(cache_entry))
+        if stream and proxy:
+            http_log.info("'proxy' is not compatible with 'stream'")
+            proxy = False
+        if proxy and is_url_localhost(url):
+            http_log.info("'proxy' is not compatible with url: 'localhost'")
+            proxy = False
+        res = None
+
+        # fix url
+        if url.startswith("mms"):
+            http_log.error("URL is invalid", url=url)
+            return None
+        url = fix_url(url)
+
+        timer = Timer()
+        timer.start()
+        try:
+            timeout = http_timeout or self.http_timeout
+            res = await self.request(method, url, headers, data=data, timeout=timeout, stream=stream, proxy=proxy,
+                                     read=not streaming_extract)
+        except requests.exceptions.InvalidURL as e:
+            error_tag = 'InvalidURL'
+            assert (res is None)
+        except requests.Timeout as e:
+            error_tag = 'Timeout'
+            assert (res is None)
+        except requests.ConnectionError as e:
+            error_tag = 'ConnectionError'
+            assert (res is None)
+        except requests.TooManyRedirects as e:
+            error_tag = 'TooManyRedirects'
+            assert (res is None)
+        except asyncio.CancelledError:
+            raise
+        except:
+            http_log.exception("GET URL failed", url=url)
+            error_tag = 'OtherError'
+            assert (res is None)
+
+        observe_request(self.controller, url, request_type, timer.stop(), res, error_tag if res is None else None)
+        # connection problem.
+        if res is None:
+            http_log.error("GET URL connect", url=url, error_tag=error_tag)
+            return None
+
+        try:
+            if streaming_extract:
+                return await self.read_response_into(res, url, method, extractor, timeout, max_size=max_size)
+            value = cache.update(url, cache_class, cache_entry, res) if cache else res
+            value = read_response(value, url, stream=stream, max_size=max_size, ensure_utf8=ensure_utf8)
+            return feed_extractor(value, extractor)
+        finally:
+            res.close()
+
+    async def read_response_into(self, res, url, method, extractor, timeout, max_size=None):
+        streaming = StreamingExtract(url, extractor, max_size=max_size, content_length=res.headers.get('content-length'))
+        if not streaming.check_status(res.status_code):
+            return None
+        complete = False
+        try:
+            async for chunk in iter_body(res, method, timeout * 0.8):
+                if not streaming.feed(chunk):
+                    break
+            else:
+                complete = True
+        except (requests.RequestException, OSError) as e:
+            http_log.error("GET URL read", url=url, error=e)
+            return None
+        # only a fully read body leaves the connection usable, an early cutoff closes it in get_url
+        if complete:
+            res.release()
+        return streaming.finish()
+
+    async def request(self, method, url, headers, data=None, timeout=10, stream=False, proxy=False, read=True):
+        for _ in range(MAX_REDIRECTS + 1):
+            res = await self.send(method, url, headers, data=data, timeout=timeout, stream=stream, proxy=proxy,
+                                  read=read)
+            location = res.headers.get('location')
+            if res.status_code not in REDIRECT_CODES or not location:
+                return res
+            res.close()
+            url = urlparse.urljoin(url, location)
+            # same method rewriting as requests does
+            if res.status_code == 303 or (res.status_code in (301, 302) and method == 'POST'):
+                method, data = 'GET', None
+        raise requests.TooManyRedirects('Exceeded %d redirects. url = %s' % (MAX_REDIRECTS, url))
+
+    async def send(self, method, url, headers, data=None, timeout=10, stream=False, proxy=False, read=True):
+        # connect timeout and read timeout.
+        connect_timeout, read_timeout = timeout * 0.5, timeout * 0.8
+
+        r = urlparse.urlsplit(url)
+        try:
+            port = r.port
+        except ValueError:
+            raise requests.exceptions.InvalidURL('Invalid port. url = %s' % url)
+        if r.scheme not in ('http', 'https') or not r.hostname:
+            raise requests.exceptions.InvalidURL('Invalid URL. url = %s' % url)
+        use_ssl = r.scheme == 'https'
+        port = port or (443 if use_ssl else 80)
+
+        target = urlparse.urlunsplit(('', '', r.path or '/', r.query, ''))
+        host = r.hostname
+        if proxy and not use_ssl:
+            target = url
+            host, port = 'localhost', 64441
+
+        body = b''
+        if method == 'POST' and data:
+            if isinstance(data, dict):
+                data = urlparse.urlencode(data)
+                headers = dict(headers, **{'Content-Type': 'application/x-www-form-urlencoded'})
+            body = data.encode('utf-8') if isinstance(data, str) else data
+
+        # stream probes only read the headers, so their connection can never be reused.
+        pool = self.connection_pool or get_async_connection_pool()
+        pool_key = None if (stream or proxy) else url_pool_key(url)
+
+        lines = ['%s %s HTTP/1.1' % (method, target), 'Host: %s' % r.netloc]
+        lines.extend('%s: %s' % (k, v) for k, v in headers.items())
+        lines.extend(['Accept: */*', 'Accept-Encoding: identity'])
+        lines.append('Connection: keep-alive' if pool_key else 'Connection: close')
+        if body or method == 'POST':
+            lines.append('Content-Length: %d' % len(body))
+        request_data = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+        conn = pool.acquire(pool_key) if pool_key else None
+        if conn is not None:
+            try:
+                return await self.exchange(conn, pool, pool_key, method, url, request_data, read_timeout, stream,
+                                           read)
+            except requests.ConnectionError:
+                # the server closed the idle connection, retry once on a new one
+                pass
+
+        try:
+            reader, writer = await asyncio.wait_for(
+                open_connection(host, port, ssl=get_ssl_context() if use_ssl else None, dns_cache=self.dns_cache),
+                connect_timeout)
+        except asyncio.TimeoutError:
+            raise requests.ConnectTimeout('Connect timed out. url = %s' % url)
+        except OSError as e:
+            raise requests.ConnectionError('%s. url = %s' % (e, url))
+        conn = AsyncConnection(reader, writer)
+        return await self.exchange(conn, pool, pool_key, method, url, request_data, read_timeout, stream, read)
+
+    async def exchange(self, conn, pool, pool_key, method, url, request_data, read_timeout, stream, read=True):
+        try:
+            conn.writer.write(request_data)
+            await conn.writer.drain()
+            version, status_code, reason, res_headers = await read_status_and_headers(conn.reader, url, read_timeout)
+            res = AsyncResponse(url, status_code, reason, res_headers, conn)
+            if not stream and read:
+                res.content = await read_body(res, method, read_timeout)
+        except OSError as e:
+            conn.close()
+            raise requests.ConnectionError('%s. url = %s' % (e, url))
+        except:
+            conn.close()
+            raise
+
+        if pool_key and is_keep_alive(version, res, method):
+            if stream or not read:
+                res.pool, res.pool_key = pool, pool_key
+            else:
+                res.connection = None
+                pool.release(pool_key, conn)
+        return res
+
+
+class AsyncConnection(object):
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def close(self):
+        self.writer.close()
+
+
+def is_keep_alive(version, res, method):
+    connection = res.headers.get('connection', '').lower()
+    if version == 'HTTP/1.1':
+        keep_alive = 'close' not in connection
+    else:
+        keep_alive = 'keep-alive' in connection
+    if not keep_alive:
+        return False
+    # the body must have been delimited by the framing, not by the server closing the connection
+    return (method == 'HEAD' or res.status_code in (204, 304) or 'content-length' in res.headers
+            or 'chunked' in res.headers.get('transfer-encoding', '').lower())
+
+
+_async_connection_pools = weakref.WeakKeyDictionary()
+
+
+def get_async_connection_pool():
+    # asyncio connections belong to one event loop, so every loop gets its own pool
+    loop = asyncio.get_event_loop()
+    pool = _async_connection_pools.get(loop)
+    if pool is None:
+        pool = ConnectionPool(pool_size=connection_pool.pool_size, idle_timeout=connection_pool.idle_timeout)
+        _async_connection_pools[loop] = pool
+    return pool
+
+
+def close_async_connection_pool():
+    pool = _async_connection_pools.pop(asyncio.get_event_loop(), None) or ConnectionPool()
+    stats = pool.stats()
+    pool.close()
+    return stats
@@ -2,14 +2,34 @@
 # -*- coding: utf-8 -*-
 # author: abekthink
 
+import asyncio
 import queue
 import time
-import traceback
+import threading
+import log
+import metrics
+from collections import deque
 from threading import Thread
 
 
+# put by a producer after its last task. a consumer that gets it puts it back for the other
+# consumers of the queue and quits, so no consumer has to wait for an idle timeout.
+END_OF_STREAM = object()
+
+# bound of a producer queue, a producer blocks once its consumers are this far behind
+DEFAULT_QUEUE_SIZE = 1024
+
+consumer_log = log.get_logger("consumer")
+pipeline_log = log.get_logger("pipeline")
+concurrency_log = log.get_logger("concurrency")
+
+
+def current_time():
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+
+
 class Producer(Thread):
-    def __init__(self, queue_size=2048):
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE):
         Thread.__init__(self)
         self.queue = queue.Queue(maxsize=queue_size)
 
@@ -17,54 +37,472 @@ class Producer(Thread):
         pass
 
     def run(self):
-        tasks = self.produce()
-        if not tasks:
-            return
-        for task in tasks:
-            self.queue.put(task)
-        return
+        try:
+            tasks = self.produce()
+            if not tasks:
+                return
+            for task in tasks:
+                self.queue.put(task)
+        finally:
+            # the stream also ends when produce() failed, so the consumers do not wait forever
+            self.queue.put(END_OF_STREAM)
 
     def sync(self, qsize=0, delay_time=5):
+        # wait until the consumers got the queue down to qsize tasks, with 0 until every task is done
+        if qsize <= 0:
+            self.queue.join()
+            return
         while self.queue.qsize() > qsize:
-            # sleep delay_time seconds
-            # must use gevent.sleep(), not use time.sleep()
             time.sleep(delay_time)
 
 
 class Consumer(Thread):
-    def __init__(self, queue, queue_timeout=30):
+    """
+    takes tasks from the queue until the end of the stream.
+    with a queue_timeout it also quits after that many idle seconds, as it used to.
+    """
+
+    def __init__(self, queue, queue_timeout=None, controller=None):
         Thread.__init__(self)
         self.queue = queue
         self.queue_timeout = queue_timeout
+        # a worker beyond the limit of the controller holds its task until a slot is free
+        self.controller = controller
 
     def consume(self, task):
         pass
 
+    def next_task(self):
+        try:
+            task = self.queue.get(timeout=self.queue_timeout)
+        except queue.Empty:
+            consumer_log.info("the consumer get timeout at %s", current_time())
+            return END_OF_STREAM
+        if task is END_OF_STREAM:
+            self.queue.task_done()
+            self.queue.put(END_OF_STREAM)
+        return task
+
+    def run_task(self, task):
+        if self.controller:
+            self.controller.acquire()
+        try:
+            self.consume(task)
+        except:
+            consumer_log.exception("the consumer failed on a task")
+        finally:
+            if self.controller:
+                self.controller.release()
+            self.queue.task_done()
+
     def run(self):
         while True:
-            try:
-                task = self.queue.get(timeout=self.queue_timeout)
-            except queue.Empty:
-                cur_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-                print('consumer: the consumer get timeout, and then quit normally at %s' % cur_time)
+            task = self.next_task()
+            if task is END_OF_STREAM:
+                consumer_log.info("the consumer reached the end of the stream, and then quit normally at %s",
+                                  current_time())
                 break
 
-            try:
-                self.consume(task)
-            except:
-                traceback.print_stack()
+            self.run_task(task)
 
             if getattr(self, '_exit_', False):
                 break
 
 
+class AsyncProducer(object):
+    """
+    asyncio counterpart of Producer, produce() is an async generator
+    and the queue is an asyncio.Queue shared with the AsyncConsumer workers.
+    """
+
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE):
+        self.queue = asyncio.Queue(maxsize=queue_size)
+
+    def produce(self):
+        pass
+
+    async def run(self):
+        try:
+            tasks = self.produce()
+            if not tasks:
+                return
+            async for task in tasks:
+                await self.queue.put(task)
+        finally:
+            await self.queue.put(END_OF_STREAM)
+
+    async def sync(self, qsize=0, delay_time=5):
+        if qsize <= 0:
+            await self.queue.join()
+            return
+        while self.queue.qsize() > qsize:
+            await asyncio.sleep(delay_time)
+
+
+class AsyncConsumer(object):
+    def __init__(self, queue, queue_timeout=None, controller=None):
+        self.queue = queue
+        self.queue_timeout = queue_timeout
+        self.controller = controller
+
+    async def consume(self, task):
+        pass
+
+    async def next_task(self):
+        try:
+            task = await asyncio.wait_for(self.queue.get(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            consumer_log.info("the consumer get timeout at %s", current_time())
+            return END_OF_STREAM
+        if task is END_OF_STREAM:
+            self.queue.task_done()
+            await self.queue.put(END_OF_STREAM)
+        return task
+
+    async def run_task(self, task):
+        if self.controller:
+            await self.controller.acquire()
+        try:
+            await self.consume(task)
+        except:
+            consumer_log.exception("the consumer failed on a task")
+        finally:
+            if self.controller:
+                self.controller.release()
+            self.queue.task_done()
+
+    async def run(self):
+        while True:
+            task = await self.next_task()
+            if task is END_OF_STREAM:
+                consumer_log.info("the consumer reached the end of the stream, and then quit normally at %s",
+                                  current_time())
+                break
+
+            await self.run_task(task)
+
+            if getattr(self, '_exit_', False):
+                break
+
+
+class Stage(object):
+    """
+    one stage of a pipeline: its bounded input queue, the stage feeding it and the counters
+    of its workers. the workers join the stage when they are created, the last one to leave
+    it ends the stream of the next stage.
+    """
+
+    def __init__(self, name, queue, upstream=None):
+        self.name = name
+        self.queue = queue
+        self.upstream = upstream
+        self.mutex = threading.Lock()
+        self.started = False
+        self.running = 0
+        self.processed = 0
+        self.busy_time = 0.0
+        self.max_depth = 0
+
+    def enter(self):
+        with self.mutex:
+            self.started = True
+            self.running += 1
+
+    def leave(self):
+        # True for the last worker of the stage
+        with self.mutex:
+            self.running -= 1
+            return self.running == 0
+
+    def done(self, busy_time):
+        with self.mutex:
+            self.processed += 1
+            self.busy_time += busy_time
+        metrics.observe_stage_task(self.name)
+
+    @property
+    def finished(self):
+        return self.started and self.running == 0
+
+    def depth(self):
+        depth = self.queue.qsize()
+        self.max_depth = max(self.max_depth, depth)
+        return depth
+
+
+class StageConsumer(Consumer):
+    def __init__(self, stage, next_stage=None, queue_timeout=None, controller=None):
+        Consumer.__init__(self, stage.queue, queue_timeout, controller)
+        self.stage = stage
+        self.next_stage = next_stage
+        self.stage.enter()
+
+    def emit(self, task):
+        self.next_stage.queue.put(task)
+
+    def run(self):
+        try:
+            while True:
+                task = self.next_task()
+                if task is END_OF_STREAM:
+                    consumer_log.info("the %s consumer reached the end of the stream, and then quit normally at %s",
+                                      self.stage.name, current_time())
+                    break
+
+                begin = time.time()
+                self.run_task(task)
+                self.stage.done(time.time() - begin)
+        finally:
+            if self.stage.leave() and self.next_stage:
+                self.next_stage.queue.put(END_OF_STREAM)
+
+
+class AsyncStageConsumer(AsyncConsumer):
+    def __init__(self, stage, next_stage=None, queue_timeout=None, controller=None):
+        AsyncConsumer.__init__(self, stage.queue, queue_timeout, controller)
+        self.stage = stage
+        self.next_stage = next_stage
+        self.stage.enter()
+
+    async def emit(self, task):
+        await self.next_stage.queue.put(task)
+
+    async def run(self):
+        try:
+            while True:
+                task = await self.next_task()
+                if task is END_OF_STREAM:
+                    consumer_log.info("the %s consumer reached the end of the stream, and then quit normally at %s",
+                                      self.stage.name, current_time())
+                    break
+
+                begin = time.time()
+                await self.run_task(task)
+                self.stage.done(time.time() - begin)
+        finally:
+            if self.stage.leave() and self.next_stage:
+                await self.next_stage.queue.put(END_OF_STREAM)
+
+
+class ConcurrencyController(object):
+    """
+    AIMD limit on how many workers of a stage run a task at the same time, kept between
+    min_workers and max_workers. the http clients of the stage report every request to observe(),
+    and once per interval the window of requests decides: the limit is cut by decrease_factor
+    when a request was throttled (429), when 5xx responses and timeouts passed max_error_rate,
+    or when the mean latency rose above latency_tolerance times the best window so far.
+    a clean window in which every slot was taken raises the limit by one.
+    """
+
+    def __init__(self, name, min_workers=1, max_workers=8, workers=None, interval=5.0, min_requests=10,
+                 max_error_rate=0.05, latency_tolerance=2.0, decrease_factor=0.75):
+        self.name = name
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers, max_workers)
+        self.limit = min(max(workers or self.min_workers, self.min_workers), self.max_workers)
+        self.interval = interval
+        self.min_requests = min_requests
+        self.max_error_rate = max_error_rate
+        self.latency_tolerance = latency_tolerance
+        self.decrease_factor = decrease_factor
+        self.mutex = threading.Lock()
+        self.condition = threading.Condition(self.mutex)
+        self.active = 0
+        self.best_latency = None
+        self.adjustments = 0
+        self.reset_window(time.time())
+
+    def reset_window(self, now):
+        self.window_begin = now
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.latency_sum = 0.0
+        self.latency_count = 0
+        self.saturated = self.active >= self.limit
+
+    def observe(self, latency, status=None, timeout=False):
+        # status is None for a request that failed without a response
+        with self.mutex:
+            self.requests += 1
+            if timeout:
+                self.timeouts += 1
+            elif status == 429:
+                self.throttled += 1
+            elif status is not None and status >= 500:
+                self.errors += 1
+            elif status is not None:
+                self.latency_sum += latency
+                self.latency_count += 1
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.saturated = True
+                self.condition.wait()
+            self.active += 1
+            if self.active >= self.limit:
+                self.saturated = True
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.adjust()
+            self.condition.notify_all()
+
+    def adjust(self):
+        # called with the mutex held
+        now = time.time()
+        if now - self.window_begin < self.interval or self.requests < self.min_requests:
+            return
+        latency = self.latency_sum / self.latency_count if self.latency_count else None
+        error_rate = (self.errors + self.timeouts) / float(self.requests)
+        limit, reason = self.limit, None
+        if self.throttled or error_rate > self.max_error_rate:
+            limit, reason = int(limit * self.decrease_factor), "errors"
+        elif latency is not None and self.best_latency is not None \
+                and latency > self.best_latency * self.latency_tolerance:
+            limit, reason = int(limit * self.decrease_factor), "latency"
+        elif self.saturated:
+            limit, reason = limit + 1, "saturated"
+        if latency is not None:
+            # the best latency creeps up 10% a window, so a lasting change of the site is taken as normal
+            self.best_latency = latency if self.best_latency is None else min(latency, self.best_latency * 1.1)
+
+        limit = min(max(limit, self.min_workers), self.max_workers)
+        if limit != self.limit:
+            concurrency_log.info("stage %s workers %d -> %d (%s), requests: %d, throttled: %d, errors: %d, "
+                                 "timeouts: %d, latency: %s, best latency: %s",
+                                 self.name, self.limit, limit, reason, self.requests, self.throttled, self.errors,
+                                 self.timeouts, format_latency(latency), format_latency(self.best_latency))
+            self.limit = limit
+            self.adjustments += 1
+        self.reset_window(now)
+
+    def stats(self):
+        with self.mutex:
+            return {'workers': self.limit, 'min_workers': self.min_workers, 'max_workers': self.max_workers,
+                    'adjustments': self.adjustments}
+
+
+class AsyncConcurrencyController(ConcurrencyController):
+    # the coroutines of one event loop wait on futures instead of a condition
+    def __init__(self, name, **kwargs):
+        ConcurrencyController.__init__(self, name, **kwargs)
+        self.waiters = deque()
+
+    async def acquire(self):
+        while self.active >= self.limit:
+            self.saturated = True
+            waiter = asyncio.get_event_loop().create_future()
+            self.waiters.append(waiter)
+            await waiter
+        self.active += 1
+        if self.active >= self.limit:
+            self.saturated = True
+
+    def release(self):
+        with self.mutex:
+            self.active -= 1
+            self.adjust()
+        free = self.limit - self.active
+        while free > 0 and self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+
+def format_latency(latency):
+    return "-" if latency is None else "%.3fs" % latency
+
+
+def print_concurrency_stats(controllers):
+    for controller in controllers:
+        stats = controller.stats()
+        concurrency_log.info("stage %s workers: %d (min: %d, max: %d), adjustments: %d", controller.name,
+                             stats['workers'], stats['min_workers'], stats['max_workers'], stats['adjustments'])
+
+
+def format_stage_depths(stages):
+    return ", ".join("%s: %d" % (stage.name, stage.depth()) for stage in stages)
+
+
+def print_stage_stats(stages):
+    for stage in stages:
+        pipeline_log.info("stage %s processed: %d, busy: %.1f seconds, max queue depth: %d",
+                          stage.name, stage.processed, stage.busy_time, stage.max_depth)
+
+
+# seconds between two samples of the queue depths, the asyncio monitor also ends this soon after the pipeline
+MONITOR_TICK = 0.1
+
+
+class StageMonitor(Thread):
+    # prints the queue depth of every stage, the stage in front of the deepest queue is the bottleneck
+    def __init__(self, stages, interval=10):
+        Thread.__init__(self)
+        self.daemon = True
+        self.stages = stages
+        self.interval = interval
+
+    def run(self):
+        last = time.time()
+        while not all(stage.finished for stage in self.stages):
+            time.sleep(MONITOR_TICK)
+            depths = format_stage_depths(self.stages)
+            if time.time() - last >= self.interval:
+                last = time.time()
+                pipeline_log.info("queue depths %s", depths)
+
+
+class AsyncStageMonitor(object):
+    def __init__(self, stages, interval=10):
+        self.stages = stages
+        self.interval = interval
+
+    async def run(self):
+        last = time.time()
+        while not all(stage.finished for stage in self.stages):
+            await asyncio.sleep(MONITOR_TICK)
+            depths = format_stage_depths(self.stages)
+            if time.time() - last >= self.interval:
+                last = time.time()
+                pipeline_log.info("queue depths %s", depths)
+
+
+async def run_async(producer, consumers):
+    await asyncio.gather(producer.run(), *[consumer.run() for consumer in consumers])
+
+
+def run_event_loop(setup, teardown=None):
+    """
+    run the workers returned by setup() until all of them finished,
+    setup is called inside the new loop so asyncio queues bind to it.
+    teardown is called before the loop is closed, e.g. to close pooled connections.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        producer, consumers = setup()
+        loop.run_until_complete(run_async(producer, consumers))
+    finally:
+        if teardown:
+            teardown()
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
 if __name__ == "__main__":
+    test_log = log.get_logger("test")
+
     class TestProducer(Producer):
-        def __init__(self, queue_size=2048, name="producer"):
+        def __init__(self, queue_size=16, name="producer"):
             Producer.__init__(self, queue_size)
 
         def produce(self):
-            print("producer: begin to produce")
+            test_log.info("producer: begin to produce")
             for i in range(0, 20):
                 yield i
             self.sync(delay_time=1)
@@ -73,23 +511,23 @@ if __name__ == "__main__":
                 yield i
             self.sync(delay_time=1)
 
-            print("producer: end to produce")
+            test_log.info("producer: end to produce")
 
 
     class TestConsumer(Consumer):
-        def __init__(self, queue, queue_timeout=5, name="consumer"):
+        def __init__(self, queue, queue_timeout=None, name="consumer"):
             Consumer.__init__(self, queue, queue_timeout)
             self.name = name
 
         def consume(self, task):
-            print("consumer: the name is %s, consume the data {%d}" % (self.name, task))
+            test_log.info("consumer: the name is %s, consume the data {%d}", self.name, task)
 
 
-    print("main: begin...")
+    test_log.info("main: begin...")
     thread_count = 4
     producer = TestProducer()
     producer.start()
     for i in range(thread_count):
         consumer = TestConsumer(producer.queue, name="consumer%d" % i)
         consumer.start()
-    print("main: end...")
+    test_log.info("main: end...")
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: abekthink
+
+# end to end: --crawl-radioguide-source, then --parse-radioguide-station on its output, run as
+# crawl_radioguide.py processes against the local radioguide of benchmark/fixture_server.py, offline.
+# reports stations/s, the p50/p99 latency of a station (its first request to its last response,
+# as the fixture server saw them) and the peak RSS of the crawler process, per engine.
+#   python benchmark/bench_crawl.py [--engines thread,asyncio] [--workers 32] [--stations 2000]
+#       [--latency 0.01] [--tail-share 0.01] [--error-rate 0.01] [--shared-share 0.5]
+#       [--crawler-args "--extraction-processes 2"]
+
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'benchmark'))
+
+from fixture_server import STATION_PATH_RE, add_fixture_arguments, make_fixture_server, percentile
+from output_file import read_json_lines
+from util import RADIO_GUIDE_SOURCE_FILE, RADIO_GUIDE_OUTPUT_FILE
+
+ICY_FIELDS = ('icy-name', 'icy-genre', 'icy-url')
+
+MODES = [
+    ('crawl', '--crawl-radioguide-source', RADIO_GUIDE_SOURCE_FILE),
+    ('parse', '--parse-radioguide-station', RADIO_GUIDE_OUTPUT_FILE),
+]
+
+
+def run_crawler(work_dir, mode_arg, engine, args, root_url):
+    command = [sys.executable, os.path.join(ROOT_DIR, 'crawl_radioguide.py'), mode_arg, '--root-url', root_url,
+               '--engine', engine, '--workers', str(args.workers), '--requests-per-second', '0',
+               '--metrics-interval', '0'] + shlex.split(args.crawler_args)
+    log_name = os.path.join(work_dir, '%s.log' % mode_arg.strip('-'))
+    with open(log_name, 'w') as log:
+        begin = time.perf_counter()
+        process = subprocess.Popen(command, cwd=work_dir, stdout=log, stderr=subprocess.STDOUT)
+        # the rusage of this one child, ru_maxrss is in KB on linux and in bytes on macos
+        _, status, rusage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - begin
+    peak_rss = rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    if status:
+        print("[WARN]bench: %s failed with wait status %d, see %s" % (mode_arg, status, log_name))
+    return elapsed, peak_rss
+
+
+def count_records(file_name):
+    try:
+        return sum(1 for _ in read_json_lines(file_name))
+    except OSError:
+        return 0
+
+
+def count_blank_icy_fields(file_name):
+    # every live stream of the fixture sends icy-name, icy-genre and icy-url, so none may come out blank
+    streams, blank = 0, 0
+    for line in read_json_lines(file_name):
+        for stream in json.loads(line).get('stream_urls') or []:
+            streams += 1
+            if not all(stream.get(field) for field in ICY_FIELDS):
+                blank += 1
+    return streams, blank
+
+
+def count_stream_mismatches(file_name, site):
+    # the stations whose record is missing or has other than the live streams the fixture serves for them
+    found = {}
+    for line in read_json_lines(file_name):
+        record = json.loads(line)
+        match = STATION_PATH_RE.match(urllib.parse.urlsplit(record.get('station_page_url') or '').path)
+        if match:
+            found[int(match.group(1))] = len(record.get('stream_urls') or [])
+    return sum(1 for k in range(site.station_count) if found.get(k) != site.live_stream_count(k))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engines', default='thread,asyncio')
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--crawler-args', default='', help="more arguments of crawl_radioguide.py")
+    parser.add_argument('--work-dir', help="keep the outputs and logs here instead of a temporary directory")
+    add_fixture_arguments(parser)
+    args = parser.parse_args()
+
+    failed = False
+    server = make_fixture_server(args).start()
+    print("fixture: %d stations, %d genres, latency %.3fs + %.3fs jitter, tail %.1f%% from %.2fs, errors %.1f%%"
+          % (args.stations, len(server.site.genres), args.latency, args.jitter, args.tail_share * 100,
+             args.tail_latency, args.error_rate * 100))
+    print("%-8s %-6s %9s %9s %11s %9s %9s %10s %9s %8s"
+          % ('engine', 'mode', 'stations', 'seconds', 'stations/s', 'p50 ms', 'p99 ms', 'peak MB', 'requests',
+             'errors'))
+    for engine in args.engines.split(','):
+        work_dir = args.work_dir and os.path.join(args.work_dir, engine)
+        if work_dir:
+            os.makedirs(work_dir, exist_ok=True)
+        temp_dir = None if work_dir else tempfile.TemporaryDirectory(prefix='bench_crawl_')
+        work_dir = work_dir or temp_dir.name
+        for mode, mode_arg, output_name in MODES:
+            server.reset()
+            elapsed, peak_rss = run_crawler(work_dir, mode_arg, engine, args, server.root_url)
+            stations = count_records(os.path.join(work_dir, output_name))
+            latencies = server.station_times.latencies()
+            errors = sum(count for status, count in server.status_counts.items() if status >= 500)
+            print("%-8s %-6s %9d %9.2f %11.1f %9.1f %9.1f %10.1f %9d %8d"
+                  % (engine, mode, stations, elapsed, stations / elapsed, percentile(latencies, 0.5) * 1000,
+                     percentile(latencies, 0.99) * 1000, peak_rss / 1024.0 / 1024.0,
+                     sum(server.status_counts.values()), errors))
+            if mode == 'parse' and stations:
+                streams, blank = count_blank_icy_fields(os.path.join(work_dir, output_name))
+                if blank or not streams:
+                    print("[WARN]bench: %s: %d of %d streams without %s" % (engine, blank, streams,
+                                                                          "/".join(ICY_FIELDS)))
+                    failed = True
+                # failed responses lose streams on purpose
+                mismatches = count_stream_mismatches(os.path.join(work_dir, output_name), server.site)
+                if mismatches and not args.error_rate:
+                    print("[WARN]bench: %s: %d of %d stations without all their live streams"
+                          % (engine, mismatches, args.stations))
+                    failed = True
+        if temp_dir:
+            temp_dir.cleanup()
+    server.stop()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
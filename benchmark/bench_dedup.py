@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: abekthink
+
+# feed the same synthetic stream source urls (10% of them repeated) through every dedup mode,
+# each in its own process, and report the RSS it grew by, the time it took and the urls it kept.
+#   python benchmark/bench_dedup.py [--count 10000000] [--modes dict,exact,bloom] [--error-rate 0.001]
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import dedup
+
+
+def synthetic_urls(count):
+    unique = int(count * 0.9)
+    for i in range(count):
+        n = (i * 2654435761) % unique
+        yield "http://stream%d.radio-host%d.com:8000/live/%08x.mp3" % (n % 97, n % 1009, n)
+
+
+def current_rss():
+    # resident set size in bytes, from /proc so it drops as well as grows
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def run_mode(mode, count, error_rate):
+    base = current_rss()
+    begin = time.perf_counter()
+    dedup_set = dedup.make_dedup(mode, capacity=int(count * 0.9), error_rate=error_rate)
+    kept = 0
+    for url in synthetic_urls(count):
+        if dedup_set.add(url):
+            kept += 1
+    elapsed = time.perf_counter() - begin
+    print("%d %d %.3f" % (current_rss() - base, kept, elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=10000000)
+    parser.add_argument('--modes', default=','.join(dedup.DEDUP_MODES))
+    parser.add_argument('--error-rate', type=float, default=0.001)
+    parser.add_argument('--run-mode', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_mode:
+        run_mode(args.run_mode, args.count, args.error_rate)
+        return
+
+    unique = int(args.count * 0.9)
+    print("urls: %d, unique: %d" % (args.count, unique))
+    print("%-8s %12s %14s %10s %12s %10s" % ('mode', 'rss(MB)', 'bytes/url', 'time(s)', 'kept', 'lost'))
+    for mode in args.modes.split(','):
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--run-mode', mode,
+                                          '--count', str(args.count), '--error-rate', str(args.error_rate)])
+        rss, kept, elapsed = output.decode().split()
+        rss, kept = int(rss), int(kept)
+        print("%-8s %12.1f %14.1f %10.1f %12d %10d"
+              % (mode, rss / 1048576.0, rss / float(unique), float(elapsed), kept, unique - kept))
+
+
+if __name__ == "__main__":
+    main()
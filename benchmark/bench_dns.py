@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: abekthink
+
+# the stream probes of --parse-radioguide-station against benchmark/fixture_server.py, with the stream
+# urls spread over --hosts host names that a stand-in resolver answers after --dns-latency seconds,
+# --dead-hosts of them not at all. a lookup in every connect, as getaddrinfo did, against the dns cache,
+# and the dns cache with all the hosts prefetched before the first probe, on both engines.
+#   python benchmark/bench_dns.py [--stations 2000] [--hosts 200] [--dns-latency 0.2] [--workers 32]
+
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'benchmark'))
+
+from dns_cache import DnsCache, normalize_host, url_host
+from fixture_server import add_fixture_arguments, make_fixture_server
+from stream_probe import StreamProbe, close_probe_loop
+
+MODES = ['connect', 'cache', 'prefetch']
+
+
+class StandInResolver(object):
+    # every host is the fixture server, the dead ones do not resolve
+    def __init__(self, latency, dead_hosts, ttl=300):
+        self.latency = latency
+        self.dead_hosts = dead_hosts
+        self.ttl = ttl
+        self.mutex = threading.Lock()
+        self.lookups = 0
+
+    def lookup(self, host):
+        with self.mutex:
+            self.lookups += 1
+        time.sleep(self.latency)
+        if host in self.dead_hosts:
+            raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+        return ['127.0.0.1'], self.ttl
+
+
+class LookupEveryConnect(object):
+    # what the clients did without the cache: the resolver in every connect, on the thread connecting
+    def __init__(self, resolver):
+        self.resolver = resolver
+
+    def resolve(self, host, timeout=None):
+        return self.resolver.lookup(normalize_host(host))[0]
+
+    async def resolve_async(self, host):
+        result = await asyncio.get_event_loop().run_in_executor(None, self.resolver.lookup, normalize_host(host))
+        return result[0]
+
+    def close(self):
+        pass
+
+
+def make_urls(root_url, stations, hosts):
+    port = int(root_url.rsplit(':', 1)[1])
+    return ['http://host%d.fixture.test:%d/stream/fixture-station-%d/0' % (k % hosts, port, k)
+            for k in range(stations)]
+
+
+def probe_threads(urls, cache, workers):
+    # the threads of the thread engine wait on their probes in the shared probe loop
+    probe = StreamProbe(dns_cache=cache)
+    with ThreadPoolExecutor(workers) as executor:
+        return list(executor.map(lambda url: probe.probe_blocking(url, throttle=False), urls))
+
+
+def probe_asyncio(urls, cache, workers):
+    probe = StreamProbe(dns_cache=cache)
+
+    async def run():
+        semaphore = asyncio.Semaphore(workers)
+
+        async def probe_one(url):
+            async with semaphore:
+                return await probe.probe(url, throttle=False)
+        return await asyncio.gather(*[probe_one(url) for url in urls])
+    return asyncio.get_event_loop().run_until_complete(run())
+
+
+def run_mode(engine, mode, urls, args):
+    dead_hosts = set('host%d.fixture.test' % i for i in range(args.dead_hosts))
+    resolver = StandInResolver(args.dns_latency, dead_hosts)
+    if mode == 'connect':
+        cache = LookupEveryConnect(resolver)
+    else:
+        cache = DnsCache(resolver=resolver, workers=args.dns_workers)
+    if mode == 'prefetch':
+        cache.prefetch(url_host(url) for url in urls)
+    begin = time.time()
+    results = (probe_asyncio if engine == 'asyncio' else probe_threads)(urls, cache, args.workers)
+    seconds = time.time() - begin
+    cache.close()
+    return seconds, resolver.lookups, sum(1 for res in results if res)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engines', default='thread,asyncio')
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--hosts', type=int, default=200, help="host names the stream urls are spread over")
+    parser.add_argument('--dead-hosts', type=int, default=20, help="hosts that do not resolve")
+    parser.add_argument('--dns-latency', type=float, default=0.2, help="seconds every lookup takes")
+    parser.add_argument('--dns-workers', type=int, default=16)
+    add_fixture_arguments(parser)
+    parser.set_defaults(stations=2000, tail_share=0.0, latency=0.0, jitter=0.0)
+    args = parser.parse_args()
+
+    server = make_fixture_server(args)
+    server.start()
+    urls = make_urls(server.root_url, args.stations, args.hosts)
+    print("%-8s %-9s %7s %9s %9s %8s %8s" % ('engine', 'mode', 'probes', 'seconds', 'probes/s', 'lookups', 'live'))
+    try:
+        for engine in args.engines.split(','):
+            for mode in MODES:
+                seconds, lookups, live = run_mode(engine, mode, urls, args)
+                print("%-8s %-9s %7d %9.2f %9.1f %8d %8d"
+                      % (engine, mode, len(urls), seconds, len(urls) / seconds, lookups, live))
+    finally:
+        close_probe_loop()
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
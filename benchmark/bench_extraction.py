@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: abekthink
+
+# a crawl served from the http cache is bound by the extraction of the station pages.
+# N fetching threads extract the recorded station page (padded like a full radioguide page)
+# either themselves, under the GIL, or through the util.ExtractionPool processes.
+#   python benchmark/bench_extraction.py [--pages 2000] [--threads 8] [--processes 1,2,4]
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import html_extractor
+import util
+
+FIXTURE_DIR = os.path.join(ROOT_DIR, 'benchmark', 'fixtures', 'radioguide')
+
+
+def read_page(padding):
+    # the player and the station info sit after the site header and menus of a real page
+    with open(os.path.join(FIXTURE_DIR, 'station.html'), 'rb') as f:
+        page = f.read()
+    return page.replace(b'<div class="player">', b'<div class="menu"></div>\n' * padding + b'<div class="player">', 1)
+
+
+def run(page, pages, thread_count, pool):
+    expected = html_extractor.run_extractor(html_extractor.station_page_extractor, page)
+
+    def worker(count):
+        for _ in range(count):
+            if pool:
+                results = pool.run(html_extractor.run_extractor, html_extractor.station_page_extractor, page)
+            else:
+                results = html_extractor.run_extractor(html_extractor.station_page_extractor, page)
+            assert results == expected
+
+    threads = [threading.Thread(target=worker, args=(pages // thread_count,)) for _ in range(thread_count)]
+    begin = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return (pages // thread_count) * thread_count / (time.perf_counter() - begin)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--processes', default='1,2,4')
+    parser.add_argument('--padding', type=int, default=2000, help="menu lines in front of the player")
+    args = parser.parse_args()
+
+    page = read_page(args.padding)
+    print("page: %d bytes, threads: %d, cpu cores: %d" % (len(page), args.threads, os.cpu_count()))
+    print("%-24s %12s" % ('extraction', 'pages/s'))
+    print("%-24s %12.0f" % ('in the threads', run(page, args.pages, args.threads, None)))
+    for processes in [int(p) for p in args.processes.split(',')]:
+        pool = util.ExtractionPool(processes)
+        run(page, args.threads * 4, args.threads, pool)  # start the workers
+        print("%-24s %12.0f" % ('%d processes' % processes, run(page, args.pages, args.threads, pool)))
+        pool.close()
+
+
+if __name__ == "__main__":
+    main()
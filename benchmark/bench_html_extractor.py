@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: abekthink
+
+# compare html_extractor with the DOTALL regexes the crawler used before it on the recorded
+# radioguide fixtures: the output has to be identical, then both are timed. the scanner runs over
+# the whole page (findall, the fast path) and over the page fed in chunks as the streaming download
+# feeds it.
+#   python benchmark/bench_html_extractor.py [--rounds 200]
+
+import argparse
+import os
+import re
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import html_extractor
+from util import STREAMING_CHUNK_SIZE
+
+# the regexes of crawl_radioguide.py before html_extractor
+GENRE_PAGE_RE = (
+    r"<li>.*?<div\s+class=\"inner\">.*?<a\s+href=\"(/genre/.*?)\".*?>(.*?)</a>.*?</div>.*?</li>"
+)
+
+STATION_RE = (
+    r"<li\s+class=\"clearfix\">.*?"
+    r"<div class=\"station-info2\">.*?"
+    r"<a\s+href=\"(/.*?)\".*?>.*?"
+    r"<strong>(.*?)</strong>.*?</div>"
+    r".*?</li>"
+)
+
+STATION_DETAIL_RE = (
+    r"<div\s+class=\"player\">.*?"
+    r"<span\s+class=\"logo\">.*?"
+    r"<img\s+src=\"(.*?)\"\s+alt=\"(.*?)\">"
+    r".*?</span>"
+    r".*?</div>.*?"
+    r"<div\s+class=\"station-info\">.*?"
+    r"<strong>Country:</strong>\s+<a\s+href=\"/.*?\">(.*?)</a>.*?"
+    r"<strong>Genre\(s\):</strong>(.*?)\|.*?"
+    r"<strong>Rating:</strong>.*?<div.*?title=\"Rating:\s+(\d\.*\d*)\".*?>.*?</div>.*?"
+    r"</div>"
+)
+
+STATION_FRAME_PATH_RE = (
+    r"<iframe\s+name=\"playerContainer\".*?src=\"(.*?)\".*?>.*?</iframe>"
+)
+
+STATION_SOURCE_URL_RE = (
+    r"\"setMedia\".*?{(.*?):.*?\"(.*?)\".*?}"
+)
+
+STATION_EMBEDED_SOURCE_URL_RE = (
+    r"<embed.*?src=\"(.*?)\".*?>.*?<style>.*?</style>"
+)
+
+FIXTURE_DIR = os.path.join(ROOT_DIR, 'benchmark', 'fixtures', 'radioguide')
+
+CASES = [
+    ('genres.html', GENRE_PAGE_RE, html_extractor.GENRE_RULE),
+    ('genre_page.html', STATION_RE, html_extractor.STATION_RULE),
+    ('genre_page_empty.html', STATION_RE, html_extractor.STATION_RULE),
+    ('station.html', STATION_DETAIL_RE, html_extractor.STATION_DETAIL_RULE),
+    ('station.html', STATION_FRAME_PATH_RE, html_extractor.STATION_FRAME_PATH_RULE),
+    ('iframe_setmedia.html', STATION_SOURCE_URL_RE, html_extractor.STATION_SOURCE_URL_RULE),
+    ('iframe_embed.html', STATION_SOURCE_URL_RE, html_extractor.STATION_SOURCE_URL_RULE),
+    ('iframe_embed.html', STATION_EMBEDED_SOURCE_URL_RE, html_extractor.STATION_EMBEDED_SOURCE_URL_RULE),
+]
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURE_DIR, name)) as f:
+        return f.read()
+
+
+def synthetic_pages():
+    # a long genre page, and a station page without its rating label: STATION_DETAIL_RE then
+    # backtracks through every combination of its nested '.*?' before giving up.
+    genre_page = read_fixture('genre_page.html')
+    items = re.findall(r'<li class="clearfix">.*?</li>\n', genre_page, flags=re.DOTALL)
+    large = genre_page.replace(items[0], ''.join(items) * 100, 1)
+
+    station = read_fixture('station.html')
+    broken = station.replace('<strong>Rating:</strong>', '<strong>Votes:</strong>')
+    return [
+        ('synthetic large genre page', large, STATION_RE, html_extractor.STATION_RULE),
+        ('synthetic malformed station page', broken, STATION_DETAIL_RE, html_extractor.STATION_DETAIL_RULE),
+    ]
+
+
+def findall_chunked(rule, html):
+    extractor = html_extractor.PageExtractor([rule])
+    for offset in range(0, len(html), STREAMING_CHUNK_SIZE):
+        extractor.feed(html[offset:offset + STREAMING_CHUNK_SIZE])
+    return extractor.results()[rule.name]
+
+
+def timeit(fn, rounds):
+    begin = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - begin) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    cases = [(name, read_fixture(name), pattern, rule) for name, pattern, rule in CASES] + synthetic_pages()
+    total_regex, total_extractor, total_chunked = 0, 0, 0
+    print("%-36s %-16s %12s %12s %8s %12s %8s"
+          % ('page', 'rule', 'regex(us)', 'scanner(us)', 'speedup', 'chunked(us)', 'speedup'))
+    for name, html, pattern, rule in cases:
+        expected = re.findall(pattern, html, flags=re.DOTALL)
+        for actual in [html_extractor.findall(rule, html), findall_chunked(rule, html)]:
+            if expected != actual:
+                print("[ERROR]bench: output differs for %s/%s\n  regex:   %r\n  scanner: %r"
+                      % (name, rule.name, expected, actual))
+                sys.exit(1)
+
+        rounds = 1 if name.startswith('synthetic') else args.rounds
+        t1 = timeit(lambda: re.findall(pattern, html, flags=re.DOTALL), rounds)
+        t2 = timeit(lambda: html_extractor.findall(rule, html), rounds)
+        t3 = timeit(lambda: findall_chunked(rule, html), rounds)
+        total_regex += t1
+        total_extractor += t2
+        total_chunked += t3
+        print("%-36s %-16s %12.1f %12.1f %7.1fx %12.1f %7.1fx"
+              % (name, rule.name, t1 * 1e6, t2 * 1e6, t1 / t2, t3 * 1e6, t1 / t3))
+    print("%-36s %-16s %12.1f %12.1f %7.1fx %12.1f %7.1fx"
+          % ('total', '', total_regex * 1e6, total_extractor * 1e6, total_regex / total_extractor,
+             total_chunked * 1e6, total_regex / total_chunked))
+
+
+if __name__ == "__main__":
+    main()
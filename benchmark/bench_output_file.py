@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: abekthink
+
+# write the same station records from 1..N threads, once through the batched OutputFile writer
+# and once the way it used to be done: a shared lock, json.dumps and a flush per record.
+# with --fsync both make the records durable: an fsync per record against one per batch.
+#   python benchmark/bench_output_file.py [--records 200000] [--threads 1,8,32] [--fsync]
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from output_file import OutputFile, FSYNC_BATCH, FSYNC_NEVER
+
+
+class LockedOutputFile(object):
+    def __init__(self, output_file_name, fsync=False):
+        self.file = open(output_file_name, "w", encoding="utf-8")
+        self.mutex = threading.Lock()
+        self.fsync = fsync
+
+    def write_json(self, json_data):
+        with self.mutex:
+            self.file.write(json.dumps(json_data) + "\n")
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+
+    def destroy(self):
+        self.file.close()
+
+
+def make_record(i):
+    return {
+        "station_page_url": "http://www.radioguide.fm/station-%d" % i,
+        "station_source_url": "http://stream.example.com:8000/%d.mp3" % i,
+        "station_source_type": "mp3",
+        "logo_url": "http://www.radioguide.fm/logos/%d.png" % i,
+        "title": "Station %d" % i,
+        "desc": "Best music 24/7",
+        "country": "Germany",
+        "genres": ["Rock", "Pop"],
+        "rating": "4.5",
+        "generated_date": "2018-06-01 12:00:00"
+    }
+
+
+def run(output_file, records, thread_count):
+    def worker(begin):
+        for i in range(begin, records, thread_count):
+            output_file.write_json(make_record(i))
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(thread_count)]
+    begin = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    output_file.destroy()
+    return time.perf_counter() - begin
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--records', type=int, default=200000)
+    parser.add_argument('--threads', default='1,8,32')
+    parser.add_argument('--fsync', action='store_true')
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'output.json')
+    print("%-8s %16s %16s" % ('threads', 'locked(rec/s)', 'batched(rec/s)'))
+    for thread_count in [int(t) for t in args.threads.split(',')]:
+        t1 = run(LockedOutputFile(path, fsync=args.fsync), args.records, thread_count)
+        t2 = run(OutputFile(path, fsync=FSYNC_BATCH if args.fsync else FSYNC_NEVER), args.records, thread_count)
+        print("%-8d %16.0f %16.0f" % (thread_count, args.records / t1, args.records / t2))
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: abekthink
+
+# the stream urls of the playlists in benchmark/fixtures/playlists, and of a few large generated ones,
+# read by plparser.streamUrls from the raw bytes and by the playlist parsing the crawler did before:
+# the body decoded as utf-8, typeGuess, then the full m3u/pls parsers with the global key table and
+# the minidom xspf/xml parsers. the urls are compared, then both are timed, the peak memory of the
+# large xml playlists is compared and streamUrls is run from several threads at once.
+#   python benchmark/bench_playlist.py [--rounds 2000] [--entries 500] [--threads 8]
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from xml.dom import minidom
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import plparser
+
+FIXTURE_DIR = os.path.join(ROOT_DIR, 'benchmark', 'fixtures', 'playlists')
+
+legacy_keys = dict()
+
+
+def legacy_type_guess(data):
+    lines = data.split('\n')
+    if lines[0].startswith('http://') or lines[0].startswith('https://'):
+        return '.m3u'
+    if '#EXTM3U' in lines[0]:
+        return '.m3u'
+    if '[playlist]' in lines[0]:
+        return '.pls'
+    dom = minidom.parseString(data)
+    for playlist in dom.getElementsByTagName('playlist')[:1]:
+        for _, value in playlist.attributes.items():
+            if value == 'http://xspf.org/ns/0/':
+                return '.xspf'
+    return '.xml'
+
+
+def legacy_m3u(data):
+    lines = data.split('\n')
+    if not lines[0].startswith('http://') and not lines[0].startswith('https://'):
+        lines.pop(0)
+    urls = []
+    for line in filter(None, map(lambda x: x.strip(), lines)):
+        info = line.split('#EXTINF:')
+        if len(info) == 2:
+            int(info[1].split(',')[0])
+        else:
+            urls.append(line)
+    return urls
+
+
+def legacy_pls(data):
+    ini = {}
+    for line in data.split('\n'):
+        parts = line.strip().split('=')
+        if len(parts) == 2:
+            ini[parts[0]] = parts[1]
+    urls, cursor = [], 1
+    while True:
+        result = {}
+        for key in ['File', 'Title', 'Length']:
+            legacy_keys[key + str(cursor)] = key
+            if key + str(cursor) in ini:
+                result[legacy_keys[key + str(cursor)]] = ini[key + str(cursor)]
+        if not result:
+            return urls
+        int(result.get('Length', 0))
+        urls.append(result.get('File'))
+        cursor += 1
+
+
+def legacy_xspf(data):
+    dom = minidom.parseString(data)
+    urls = []
+    for track in dom.getElementsByTagName('trackList')[0].getElementsByTagName('track'):
+        for item in track.getElementsByTagName('location')[:1]:
+            urls.append(item.childNodes[0].nodeValue)
+    return urls
+
+
+def legacy_xml(data):
+    dom = minidom.parseString(data)
+    urls = []
+    for track in dom.getElementsByTagName('dict')[0].getElementsByTagName('dict')[0].getElementsByTagName('dict'):
+        for item in track.getElementsByTagName('key'):
+            if item.childNodes[0].nodeValue == 'Location':
+                urls.append(item.nextSibling.childNodes[0].nodeValue)
+    return urls
+
+
+def legacy_urls(body):
+    # what util.parse_playlist_data got: the body as utf-8 text, None when it was not utf-8
+    try:
+        data = body.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+    kind = legacy_type_guess(data)
+    if kind == '.m3u':
+        return [x.strip() for x in legacy_m3u(data)]
+    if kind == '.pls':
+        return [x.strip() for x in legacy_pls(data)]
+    if kind == '.xspf':
+        return [x.strip() for x in legacy_xspf(data)]
+    return [x.strip() for x in legacy_xml(data)]
+
+
+def new_urls(body, name, limit=None):
+    return [x.strip() for x in plparser.streamUrls(body, fileName=name, limit=limit) if x.strip()]
+
+
+def generated_playlists(entries):
+    m3u = ['#EXTM3U']
+    pls = ['[playlist]', 'NumberOfEntries=%d' % entries]
+    xspf = ['<?xml version="1.0" encoding="UTF-8"?>', '<playlist version="1" xmlns="http://xspf.org/ns/0/">',
+            '<trackList>']
+    xml = ['<?xml version="1.0" encoding="UTF-8"?>', '<plist version="1.0"><dict><key>Tracks</key><dict>']
+    for i in range(1, entries + 1):
+        url = 'http://stream%d.example.com:8000/live' % i
+        m3u += ['#EXTINF:-1,Station %d - Genre %d' % (i, i % 20), url]
+        pls += ['File%d=%s' % (i, url), 'Title%d=Station %d' % (i, i), 'Length%d=-1' % i]
+        xspf.append('<track><location>%s</location><title>Station %d</title><annotation>Genre %d</annotation>'
+                    '</track>' % (url, i, i % 20))
+        xml.append('<key>%d</key><dict><key>Track ID</key><integer>%d</integer><key>Name</key>'
+                   '<string>Station %d</string><key>Location</key><string>%s</string></dict>' % (i, i, i, url))
+    pls.append('Version=2')
+    xspf.append('</trackList></playlist>')
+    xml.append('</dict></dict></plist>')
+    return [('generated_%d.m3u' % entries, '\r\n'.join(m3u).encode('utf-8')),
+            ('generated_%d.pls' % entries, '\n'.join(pls).encode('utf-8')),
+            ('generated_%d.xspf' % entries, '\n'.join(xspf).encode('utf-8')),
+            ('generated_%d.xml' % entries, '\n'.join(xml).encode('utf-8'))]
+
+
+def load_corpus(entries):
+    corpus = []
+    for name in sorted(os.listdir(FIXTURE_DIR)):
+        with open(os.path.join(FIXTURE_DIR, name), 'rb') as f:
+            corpus.append((name, f.read()))
+    return corpus + generated_playlists(entries)
+
+
+def run_legacy(body):
+    try:
+        return legacy_urls(body)
+    except Exception as e:
+        return e
+
+
+def peak_memory(fn):
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def timed(fn, rounds):
+    begin = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - begin) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=2000)
+    parser.add_argument('--entries', type=int, default=500, help="entries of the generated playlists")
+    parser.add_argument('--limit', type=int, default=32, help="like --max-playlist-streams of the crawler")
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.entries)
+    print("%-22s %6s %5s %5s %-28s %11s %11s %8s"
+          % ('playlist', 'bytes', 'type', 'urls', 'legacy', 'legacy us', 'new us', 'speedup'))
+    for name, body in corpus:
+        urls = new_urls(body, name)
+        legacy = run_legacy(body)
+        if isinstance(legacy, Exception):
+            verdict = 'failed: %s' % type(legacy).__name__
+        elif legacy is None:
+            verdict = 'not utf-8, skipped'
+        elif legacy == urls:
+            verdict = 'same urls'
+        else:
+            verdict = 'differs (%d urls)' % len(legacy)
+        rounds = max(1, args.rounds * 1000 // (len(body) + 1000))
+        legacy_time = timed(lambda: run_legacy(body), rounds)
+        new_time = timed(lambda: new_urls(body, name), rounds)
+        print("%-22s %6d %5s %5d %-28s %11.1f %11.1f %7.1fx"
+              % (name, len(body), plparser.sniff(body, fileName=name), len(urls), verdict, legacy_time * 1e6,
+                 new_time * 1e6, legacy_time / new_time))
+
+    # the xml playlists as a minidom tree against the pull parsers, and the pull parsers stopping at --limit
+    print("%-22s %12s %12s %12s" % ('playlist', 'legacy KB', 'new KB', 'limit %d KB' % args.limit))
+    for name, body in corpus:
+        if name.startswith('generated_') and name.endswith(('.xspf', '.xml')):
+            print("%-22s %12.1f %12.1f %12.1f"
+                  % (name, peak_memory(lambda: run_legacy(body)) / 1024.0, peak_memory(lambda: new_urls(body, name))
+                     / 1024.0, peak_memory(lambda: new_urls(body, name, args.limit)) / 1024.0))
+
+    # the same playlists from several threads at once have to give the same urls as one by one
+    expected = [new_urls(body, name) for name, body in corpus]
+    with ThreadPoolExecutor(args.threads) as executor:
+        results = list(executor.map(lambda item: new_urls(item[1], item[0]), corpus * args.threads))
+    mismatches = sum(1 for i, urls in enumerate(results) if urls != expected[i % len(corpus)])
+    print("threads: %d x %d playlists, %d mismatches" % (args.threads, len(corpus), mismatches))
+
+
+if __name__ == "__main__":
+    main()
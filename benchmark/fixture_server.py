@@ -0,0 +1,523 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: abekthink
+
+# a local radioguide.fm for the benchmarks: the genre listing, paginated genre pages, station pages,
+# player iframes, m3u/pls/xspf playlists and icy audio streams, all generated from the station count.
+# every response waits a base latency plus jitter, a share of them falls into a pareto slow tail,
+# and a share of them fails with a 500, so the crawler can be measured without the real site.
+#   python benchmark/fixture_server.py [--port 8765] [--stations 2000] [--latency 0.01] [--error-rate 0.01]
+#   python crawl_radioguide.py --crawl-radioguide-source --root-url http://127.0.0.1:8765
+
+import argparse
+import http.server
+import random
+import re
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+
+GENRE_NAMES = ["Rock", "Adult Contemporary", "80s", "Alternative", "Blues", "Classic Rock", "Classical",
+               "Country", "Dance", "Electronic", "Folk", "Hip Hop", "Jazz", "Latin", "Metal", "News",
+               "Oldies", "Pop", "Reggae", "Soul", "Talk", "Top 40", "World"]
+COUNTRIES = ["Germany", "France", "Italy", "Spain", "United Kingdom", "United States", "Brazil"]
+PLAYLIST_KINDS = ["m3u", "pls", "xspf"]
+
+STATION_PATH_RE = re.compile(r"^/(?:player/|playlist/|listen/|stream/)?fixture-station-(\d+)")
+
+HEADER = """<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>%(title)s - RadioGuide.FM</title>
+<link rel="stylesheet" href="/css/style.css?v=20180612">
+<script type="text/javascript" src="/js/jquery.min.js"></script>
+</head>
+<body>
+<div id="header" class="clearfix">
+  <a href="/" class="site-logo"><img src="/images/logo.png" alt="RadioGuide.FM"></a>
+  <ul class="menu">
+    <li><a href="/">Home</a></li>
+    <li><a href="/genre">Genres</a></li>
+    <li><a href="/country">Countries</a></li>
+    <li><a href="/top">Top Stations</a></li>
+  </ul>
+</div>
+<div id="content" class="clearfix">
+"""
+
+FOOTER = """</div>
+<div id="footer">
+  <ul>
+    <li><a href="/about">About</a></li>
+    <li><a href="/contact">Contact</a></li>
+  </ul>
+  <p>&copy; 2018 RadioGuide.FM</p>
+</div>
+</body>
+</html>
+"""
+
+GENRE_ITEM = """  <li>
+    <div class="inner">
+      <a href="/genre/%(genre)s" title="%(genre)s radio stations">%(genre)s</a>
+      <span class="count">%(count)d stations</span>
+    </div>
+  </li>
+"""
+
+STATION_ITEM = """  <li class="clearfix">
+    <div class="station-logo"><a href="/%(path)s"><img src="/logos/%(path)s.png" alt="%(title)s"></a></div>
+    <div class="station-info2">
+      <a href="/%(path)s" title="Listen to %(title)s">
+        <strong>%(title)s</strong>
+      </a>
+      <p class="country"><a href="/country/de">%(country)s</a></p>
+    </div>
+    <div class="play"><a href="/%(path)s" class="btn">Play</a></div>
+  </li>
+"""
+
+STATION_PAGE = """<div class="player">
+  <span class="logo">
+    <img src="/logos/%(path)s.png" alt=" %(title)s - the best %(genre)s ">
+  </span>
+  <h1>%(title)s</h1>
+</div>
+<div class="station-info">
+  <p><strong>Country:</strong> <a href="/country/de">%(country)s</a></p>
+  <p><strong>Genre(s):</strong> %(genre_links)s | <strong>Language:</strong> English</p>
+  <p><strong>Rating:</strong> <div class="rating" title="Rating: %(rating)s"><span></span></div> 12 votes</p>
+</div>
+<div class="player-frame">
+  <iframe name="playerContainer" width="100%%" height="80" frameborder="0" src="/player/%(path)s?autoplay=1"></iframe>
+</div>
+<div class="comments">
+%(comments)s</div>
+"""
+
+COMMENT = """  <div class="comment"><strong>listener%d</strong> <span class="date">2018-01-10</span><p>Great station!</p></div>
+"""
+
+IFRAME_SETMEDIA = """<!DOCTYPE html>
+<html>
+<head>
+<script type="text/javascript">
+$(document).ready(function(){
+  $("#jquery_jplayer_1").jPlayer({
+    ready: function () {
+      $(this).jPlayer("setMedia", {
+        mp3: "%(url)s"
+      }).jPlayer("play");
+    },
+    supplied: "mp3"
+  });
+});
+</script>
+</head>
+<body><div id="jquery_jplayer_1" class="jp-jplayer"></div></body>
+</html>
+"""
+
+IFRAME_EMBED = """<!DOCTYPE html>
+<html>
+<head><title>player</title></head>
+<body>
+<embed type="application/x-mplayer2" src="%(url)s" width="300" height="45" autostart="true">
+<style>
+  body { margin: 0; }
+</style>
+</body>
+</html>
+"""
+
+
+class FixtureSite(object):
+    """
+    the stations of the fake site. station k is listed by genre k % genres, every fourth station
+    by the next genre too, so a crawl meets the same station under several genres like on radioguide.
+    its source is a direct mp3 stream or, for playlist_share of the stations, a m3u/pls/xspf playlist
+    of playlist_streams streams. shared_share of the stations have a playlist of the streams of one of
+    the first shared_sources stations instead, like the stations of a network sharing its mount points.
+    for nested_share of the stations the playlist only links to /listen/, a m3u under a url without
+    an extension, and dead_share of the streams after the first one answer a 503 late, dead mirrors.
+    """
+
+    def __init__(self, stations=2000, genres=10, page_size=30, playlist_share=0.4, playlist_streams=2,
+                 shoutcast_share=0.5, comments=40, shared_share=0.0, shared_sources=10, nested_share=0.0,
+                 dead_share=0.0, seed=1):
+        self.station_count = stations
+        self.genres = [GENRE_NAMES[i % len(GENRE_NAMES)] + ("" if i < len(GENRE_NAMES) else " %d" % i)
+                       for i in range(max(1, genres))]
+        self.page_size = page_size
+        self.playlist_share = playlist_share
+        self.playlist_streams = playlist_streams
+        self.shoutcast_share = shoutcast_share
+        self.comments = comments
+        self.shared_share = shared_share
+        self.shared_sources = max(1, min(shared_sources, stations))
+        self.nested_share = nested_share
+        self.dead_share = dead_share
+        self.seed = seed
+        self.genre_stations = dict((genre, []) for genre in self.genres)
+        for k in range(stations):
+            for genre in self.station_genres(k):
+                self.genre_stations[genre].append(k)
+
+    def station_genres(self, k):
+        genres = [self.genres[k % len(self.genres)]]
+        if k % 4 == 0 and len(self.genres) > 1:
+            genres.append(self.genres[(k + 1) % len(self.genres)])
+        return genres
+
+    def station_random(self, k):
+        return random.Random(self.seed * 1000003 + k)
+
+    def station_source(self, k):
+        # (kind, path) of the source the player iframe of station k links to
+        rng = self.station_random(k)
+        if rng.random() < self.playlist_share or self.shared_station(k) is not None:
+            kind = rng.choice(PLAYLIST_KINDS)
+            return kind, "/playlist/fixture-station-%d.%s" % (k, kind)
+        return "mp3", "/stream/fixture-station-%d/0" % k
+
+    def shared_station(self, k):
+        # the station whose streams the playlist of station k lists, None for its own streams
+        if not self.shared_share or k < self.shared_sources:
+            return None
+        rng = self.station_random(k + 104729)
+        return rng.randrange(self.shared_sources) if rng.random() < self.shared_share else None
+
+    def is_nested(self, k):
+        return bool(self.nested_share) and self.station_random(k + 15485863).random() < self.nested_share
+
+    def is_dead(self, k, i):
+        return i > 0 and bool(self.dead_share) and self.station_random(k * 31 + i + 2750159).random() < self.dead_share
+
+    def live_stream_count(self, k):
+        # the streams a crawl finds for station k: its mp3 stream, or the live ones of its playlist
+        if self.station_source(k)[0] == "mp3":
+            return 1
+        owner = self.shared_station(k)
+        owner = k if owner is None else owner
+        return sum(1 for i in range(self.playlist_streams) if not self.is_dead(owner, i))
+
+    def is_shoutcast(self, k):
+        # shoutcast v1 answers with an "ICY 200 OK" status line instead of HTTP
+        return self.station_random(k + 7919).random() < self.shoutcast_share
+
+    def genre_list(self):
+        items = "".join(GENRE_ITEM % {'genre': genre, 'count': len(self.genre_stations[genre])}
+                        for genre in self.genres)
+        return HEADER % {'title': "Radio genres"} + '<ul class="genres clearfix">\n' + items + "</ul>\n" + FOOTER
+
+    def genre_page(self, genre, page):
+        if genre not in self.genre_stations:
+            return None
+        stations = self.genre_stations[genre]
+        page_count = max(1, (len(stations) + self.page_size - 1) // self.page_size)
+        items = "".join(STATION_ITEM % self.station_values(k)
+                        for k in stations[(page - 1) * self.page_size:page * self.page_size])
+        pagination = ""
+        if page <= page_count:
+            links = ['  <a href="/genre/%s?page=%d">%d</a>\n' % (genre, p, p) for p in range(1, page_count + 1)]
+            pagination = '<div class="pagination">\n%s</div>\n' % "".join(links)
+        return (HEADER % {'title': genre} + '<ul class="stations">\n' + items + "</ul>\n" + pagination + FOOTER)
+
+    def station_values(self, k):
+        genres = self.station_genres(k)
+        return {
+            'path': "fixture-station-%d" % k,
+            'title': "Fixture Station %d" % k,
+            'genre': genres[0],
+            'genre_links': ", ".join('<a href="/genre/%s">%s</a>' % (genre, genre) for genre in genres),
+            'country': COUNTRIES[k % len(COUNTRIES)],
+            'rating': "%.1f" % (1 + k % 40 / 10.0),
+        }
+
+    def station_page(self, k):
+        values = self.station_values(k)
+        values['comments'] = "".join(COMMENT % i for i in range(self.comments))
+        return HEADER % values + STATION_PAGE % values + FOOTER
+
+    def iframe(self, k, base_url):
+        kind, path = self.station_source(k)
+        template = IFRAME_SETMEDIA if kind == "mp3" else IFRAME_EMBED
+        return template % {'url': base_url + path}
+
+    def playlist(self, k, kind, base_url, nested=True):
+        if nested and self.is_nested(k):
+            return self.playlist_body(k, kind, [base_url + "/listen/fixture-station-%d" % k])
+        owner = self.shared_station(k)
+        urls = [base_url + "/stream/fixture-station-%d/%d" % (k if owner is None else owner, i)
+                for i in range(self.playlist_streams)]
+        return self.playlist_body(k, kind, urls)
+
+    def playlist_body(self, k, kind, urls):
+        if kind == "m3u":
+            return "#EXTM3U\n" + "".join("#EXTINF:-1,Fixture Station %d\n%s\n" % (k, url) for url in urls)
+        if kind == "pls":
+            entries = "".join("File%d=%s\nTitle%d=Fixture Station %d\nLength%d=-1\n" % (i + 1, url, i + 1, k, i + 1)
+                              for i, url in enumerate(urls))
+            return "[playlist]\n%sNumberOfEntries=%d\nVersion=2\n" % (entries, len(urls))
+        tracks = "".join("    <track><location>%s</location><title>Fixture Station %d</title></track>\n" % (url, k)
+                         for url in urls)
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n<playlist version="1" xmlns="http://xspf.org/ns/0/">\n'
+                '  <trackList>\n%s  </trackList>\n</playlist>\n' % tracks)
+
+
+class Behavior(object):
+    """
+    how long a response takes and whether it fails: latency plus uniform jitter, and for tail_share
+    of the responses a pareto distributed slow tail starting at tail_latency, capped at max_latency.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, tail_share=0.0, tail_latency=0.5, tail_alpha=1.5,
+                 max_latency=30.0, error_rate=0.0, seed=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.tail_share = tail_share
+        self.tail_latency = tail_latency
+        self.tail_alpha = tail_alpha
+        self.max_latency = max_latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.mutex = threading.Lock()
+
+    def next(self):
+        # (delay, failed) of the next response
+        with self.mutex:
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            if self.tail_share and self.random.random() < self.tail_share:
+                delay += self.tail_latency * self.random.paretovariate(self.tail_alpha)
+            return min(delay, self.max_latency), self.random.random() < self.error_rate
+
+
+class StationTimes(object):
+    # the first request and the last response per station, the latency of a station is the time between
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.times = {}
+
+    def reset(self):
+        with self.mutex:
+            self.times = {}
+
+    def begin(self, k, now):
+        with self.mutex:
+            span = self.times.get(k)
+            if span is None:
+                self.times[k] = [now, now]
+
+    def end(self, k, now):
+        with self.mutex:
+            span = self.times.setdefault(k, [now, now])
+            span[1] = max(span[1], now)
+
+    def latencies(self):
+        with self.mutex:
+            return sorted(end - begin for begin, end in self.times.values())
+
+
+def percentile(values, p):
+    # values sorted
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class FixtureHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        url = urllib.parse.urlsplit(self.path)
+        path = urllib.parse.unquote_plus(url.path)
+        match = STATION_PATH_RE.match(path)
+        self.station = int(match.group(1)) if match else None
+        if self.station is not None:
+            server.station_times.begin(self.station, time.monotonic())
+        self.respond(path, url.query, self.station)
+
+    def respond(self, path, query, station):
+        server, site = self.server, self.server.site
+        delay, failed = server.behavior.next()
+        if delay:
+            time.sleep(delay)
+        if failed:
+            return self.send_body(500, "text/html", "<html>internal server error</html>")
+
+        base_url = "http://%s" % (self.headers.get("Host") or "%s:%d" % self.server.server_address[:2])
+        body, content_type = None, "text/html; charset=utf-8"
+        if path == "/genre":
+            body = site.genre_list()
+        elif path.startswith("/genre/"):
+            page = urllib.parse.parse_qs(query).get("page", ["1"])[0]
+            body = site.genre_page(path[len("/genre/"):], int(page) if page.isdigit() else 1)
+        elif station is None or station >= site.station_count:
+            body = None
+        elif path.startswith("/player/"):
+            body = site.iframe(station, base_url)
+        elif path.startswith("/playlist/"):
+            kind = path.rsplit(".", 1)[-1]
+            body = site.playlist(station, kind, base_url)
+            content_type = {"m3u": "audio/x-mpegurl", "pls": "audio/x-scpls"}.get(kind, "application/xspf+xml")
+        elif path.startswith("/listen/"):
+            body, content_type = site.playlist(station, "m3u", base_url, nested=False), "audio/x-mpegurl"
+        elif path.startswith("/stream/"):
+            index = path.rsplit("/", 1)[-1]
+            if index.isdigit() and site.is_dead(station, int(index)):
+                time.sleep(server.dead_latency)
+                return self.send_body(503, "text/html", "<html>service unavailable</html>")
+            return self.send_stream(station)
+        else:
+            body = site.station_page(station)
+
+        if body is None:
+            return self.send_body(404, "text/html", "<html>not found</html>")
+        self.send_body(200, content_type, body)
+
+    def send_body(self, status, content_type, body):
+        data = body.encode("utf-8")
+        self.server.count(status)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.sent()
+
+    def sent(self):
+        # a station is done with once its last response is out, a stream once its headers are
+        if self.station is not None:
+            self.server.station_times.end(self.station, time.monotonic())
+
+    def send_stream(self, station):
+        # headers, then audio until the client hangs up or stream_seconds are over
+        self.server.count(200)
+        self.close_connection = True
+        status = "ICY 200 OK" if self.server.site.is_shoutcast(station) else "HTTP/1.0 200 OK"
+        headers = [status, "Content-Type: audio/mpeg", "icy-name: Fixture Station %d" % station,
+                   "icy-genre: %s" % self.server.site.station_genres(station)[0], "icy-br: 128",
+                   "icy-metaint: 16000", "icy-url: http://fixture-station-%d.example.com" % station]
+        try:
+            self.wfile.write(("\r\n".join(headers) + "\r\n\r\n").encode("latin-1"))
+            self.wfile.flush()
+            self.sent()
+            chunk = b"\xff\xfb\x90\x00" * 1024
+            end_time = time.monotonic() + self.server.stream_seconds
+            while time.monotonic() < end_time:
+                self.wfile.write(chunk)
+                self.wfile.flush()
+                time.sleep(0.05)
+        except OSError:
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FixtureServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, site, behavior, port=0, host="127.0.0.1", stream_seconds=2.0, dead_latency=1.0):
+        http.server.HTTPServer.__init__(self, (host, port), FixtureHandler)
+        self.site = site
+        self.behavior = behavior
+        self.stream_seconds = stream_seconds
+        self.dead_latency = dead_latency
+        self.station_times = StationTimes()
+        self.mutex = threading.Lock()
+        self.status_counts = {}
+        self.thread = threading.Thread(target=self.serve_forever, name="fixture-server")
+        self.thread.daemon = True
+
+    @property
+    def root_url(self):
+        return "http://%s:%d" % self.server_address[:2]
+
+    def count(self, status):
+        with self.mutex:
+            self.status_counts[status] = self.status_counts.get(status, 0) + 1
+
+    def reset(self):
+        with self.mutex:
+            self.status_counts = {}
+        self.station_times.reset()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # clients hang up on streams and on pages they stopped reading early
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            http.server.HTTPServer.handle_error(self, request, client_address)
+
+
+def add_fixture_arguments(parser):
+    parser.add_argument('--stations', type=int, default=2000)
+    parser.add_argument('--genres', type=int, default=10)
+    parser.add_argument('--page-size', type=int, default=30, help="stations per genre page")
+    parser.add_argument('--playlist-share', type=float, default=0.4,
+                        help="stations whose source is a m3u/pls/xspf playlist instead of a stream")
+    parser.add_argument('--playlist-streams', type=int, default=2, help="streams per playlist")
+    parser.add_argument('--shoutcast-share', type=float, default=0.5,
+                        help="streams answering with an ICY status line instead of HTTP/1.0")
+    parser.add_argument('--shared-share', type=float, default=0.0,
+                        help="stations with a playlist of the streams of another station")
+    parser.add_argument('--shared-sources', type=int, default=10, help="the stations whose streams are shared")
+    parser.add_argument('--nested-share', type=float, default=0.0,
+                        help="playlists linking to another playlist under a url without an extension")
+    parser.add_argument('--dead-share', type=float, default=0.0, help="playlist streams after the first one dead")
+    parser.add_argument('--dead-latency', type=float, default=1.0, help="seconds a dead stream takes to fail")
+    parser.add_argument('--comments', type=int, default=40, help="comments padding every station page")
+    parser.add_argument('--latency', type=float, default=0.01, help="seconds every response waits")
+    parser.add_argument('--jitter', type=float, default=0.01, help="uniform extra seconds up to this")
+    parser.add_argument('--tail-share', type=float, default=0.01, help="responses falling into the slow tail")
+    parser.add_argument('--tail-latency', type=float, default=0.5, help="seconds the pareto slow tail starts at")
+    parser.add_argument('--tail-alpha', type=float, default=1.5, help="pareto shape, lower is a heavier tail")
+    parser.add_argument('--max-latency', type=float, default=30.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="responses failing with a 500")
+    parser.add_argument('--stream-seconds', type=float, default=2.0,
+                        help="seconds a stream sends audio before the server closes it")
+    parser.add_argument('--seed', type=int, default=1)
+
+
+def make_fixture_server(args, port=0, host="127.0.0.1"):
+    site = FixtureSite(stations=args.stations, genres=args.genres, page_size=args.page_size,
+                       playlist_share=args.playlist_share, playlist_streams=args.playlist_streams,
+                       shoutcast_share=args.shoutcast_share, comments=args.comments,
+                       shared_share=args.shared_share, shared_sources=args.shared_sources,
+                       nested_share=args.nested_share, dead_share=args.dead_share, seed=args.seed)
+    behavior = Behavior(latency=args.latency, jitter=args.jitter, tail_share=args.tail_share,
+                        tail_latency=args.tail_latency, tail_alpha=args.tail_alpha, max_latency=args.max_latency,
+                        error_rate=args.error_rate, seed=args.seed)
+    return FixtureServer(site, behavior, port=port, host=host, stream_seconds=args.stream_seconds,
+                         dead_latency=args.dead_latency)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--host', default="127.0.0.1")
+    add_fixture_arguments(parser)
+    args = parser.parse_args()
+
+    server = make_fixture_server(args, port=args.port, host=args.host)
+    print("serving %d stations in %d genres on %s" % (args.stations, len(server.site.genres), server.root_url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -4,10 +4,27 @@
 
 import sys
 import argparse
+import asyncio
+import queue
+import threading
 import urllib
-import re
-
-from asynclib import Producer, Consumer
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
+
+import log
+import util
+import metrics
+import html_extractor
+from asynclib import Producer, Consumer, AsyncProducer, AsyncConsumer, run_event_loop, \
+    Stage, StageConsumer, AsyncStageConsumer, StageMonitor, AsyncStageMonitor, print_stage_stats, \
+    ConcurrencyController, AsyncConcurrencyController, print_concurrency_stats, DEFAULT_QUEUE_SIZE
+from async_http import AsyncHttpClient, close_async_connection_pool
+from stream_probe import StreamProbe, close_probe_loop
+from dns_cache import configure_dns_cache, close_dns_cache, get_dns_cache, prefetch_urls
+from stream_resolver import DEFAULT_MAX_DEPTH, DEFAULT_FAN_OUT, StreamResolver, AsyncStreamResolver
+from dedup import DEDUP_MODES, DEDUP_EXACT, make_dedup
+from output_file import FSYNC_NEVER, FSYNC_POLICIES, SHARD_BY_HASH, SHARD_BY_WORKER, COMPRESSION_GZIP, \
+    COMPRESSION_EXTS, open_output_file, read_json_lines
 from util import *
 
 
@@ -17,327 +34,861 @@ else:
     quote_plus = urllib.quote_plus
 
 
+ENGINE_THREAD = "thread"
+ENGINE_ASYNCIO = "asyncio"
+
+# journal entries: a finished genre, a station listed by a finished genre,
+# a station written to the source file, a station source written to the output file
+JOURNAL_GENRE = "genre"
+JOURNAL_LISTED = "listed"
+JOURNAL_STATION = "station"
+JOURNAL_SOURCE = "source"
+
+STAGE_STATION = "station"
+STAGE_IFRAME = "iframe"
+STAGE_RECORD = "record"
+# the workers probing stream urls when parsing the stations
+STAGE_STREAM = "stream"
+
+# the stages whose http requests can drive a ConcurrencyController
+ADAPTIVE_STAGES = [STAGE_STATION, STAGE_IFRAME, STAGE_STREAM]
+
+# dead stream hosts time out whatever the load, so the stream stage tolerates far more timeouts
+CONTROLLER_OPTIONS = {
+    STAGE_STREAM: {'max_error_rate': 0.3},
+}
+
+producer_log = log.get_logger("producer")
+consumer_log = log.get_logger("consumer")
+main_log = log.get_logger("main")
+
 ROOT_URL = "http://www.radioguide.fm"
 GENRES_PATH = "/genre"
-
-GENRE_PAGE_RE = (
-    r"<li>.*?<div\s+class=\"inner\">.*?<a\s+href=\"(/genre/.*?)\".*?>(.*?)</a>.*?</div>.*?</li>"
-)
-
-STATION_RE = (
-    r"<li\s+class=\"clearfix\">.*?"
-    r"<div class=\"station-info2\">.*?"
-    r"<a\s+href=\"(/.*?)\".*?>.*?"
-    r"<strong>(.*?)</strong>.*?</div>"
-    r".*?</li>"
-)
-
-GENRE_NAME_RE = (
-    r"<a\s+href=\"/genre/.*?\">(.*?)</a>"
-)
-
-STATION_DETAIL_RE = (
-    r"<div\s+class=\"player\">.*?"
-    r"<span\s+class=\"logo\">.*?"
-    r"<img\s+src=\"(.*?)\"\s+alt=\"(.*?)\">"
-    r".*?</span>"
-    r".*?</div>.*?"
-    r"<div\s+class=\"station-info\">.*?"
-    r"<strong>Country:</strong>\s+<a\s+href=\"/.*?\">(.*?)</a>.*?"
-    r"<strong>Genre\(s\):</strong>(.*?)\|.*?"
-    r"<strong>Rating:</strong>.*?<div.*?title=\"Rating:\s+(\d\.*\d*)\".*?>.*?</div>.*?"
-    r"</div>"
-)
-
-STATION_FRAME_PATH_RE = (
-    r"<iframe\s+name=\"playerContainer\".*?src=\"(.*?)\".*?>.*?</iframe>"
-)
-
-STATION_SOURCE_URL_RE = (
-    r"\"setMedia\".*?{(.*?):.*?\"(.*?)\".*?}"
-)
-
-STATION_EMBEDED_SOURCE_URL_RE = (
-    r"<embed.*?src=\"(.*?)\".*?>.*?<style>.*?</style>"
-)
+# only the first stream urls of a longer playlist are probed, the rest of it is not even parsed
+MAX_PLAYLIST_STREAMS = 32
+# playlists in playlists are followed this many levels deep
+MAX_PLAYLIST_DEPTH = DEFAULT_MAX_DEPTH
+# the urls of one station resolved at the same time
+STREAM_FAN_OUT = DEFAULT_FAN_OUT
+# stop resolving a station after this many live streams, 0 resolves all of them
+MAX_LIVE_STREAMS = 0
+# look up the hosts of all the station sources before the first one is probed
+DNS_PREFETCH = True
+
+
+def parse_genres(html):
+    result = html_extractor.findall(html_extractor.GENRE_RULE, html)
+    return dict(map(lambda x: (x[1], x[0]), result))
+
+
+def parse_stations(html):
+    return html_extractor.findall(html_extractor.STATION_RULE, html)
+
+
+def get_genre_url(path):
+    pathes = path.split("/")
+    path = "/".join([quote_plus(p) for p in pathes])
+    return ROOT_URL + path
+
+
+class GenrePages(object):
+    """
+    pagination state of one genre while its pages are fetched out of order.
+    pages up to the page count read from the pagination links are fetched at once, without
+    pagination the next prefetch_pages pages are fetched speculatively. stations are only
+    released in page order, and nothing after the first empty (or failed) page is kept.
+    """
+
+    def __init__(self, genre, path, prefetch_pages=4):
+        self.genre = genre
+        self.genre_url = get_genre_url(path)
+        self.prefetch_pages = prefetch_pages
+        self.next_page = 1
+        self.last_page = None
+        self.end_page = None
+        self.pages = {}
+        self.emit_page = 1
+        self.stations = []
+        self.failed = False
+        self.begin_time = time.time()
+
+    def page_url(self, page):
+        return "%s?page=%d" % (self.genre_url, page)
+
+    @property
+    def finished(self):
+        if self.end_page is not None:
+            return self.emit_page >= self.end_page
+        return self.last_page is not None and self.emit_page > self.last_page
+
+    def pages_to_fetch(self):
+        if self.finished or self.end_page is not None:
+            return []
+        if self.last_page is not None:
+            limit = self.last_page
+        else:
+            limit = self.emit_page + self.prefetch_pages
+        pages = list(range(self.next_page, limit + 1))
+        self.next_page = max(self.next_page, limit + 1)
+        return pages
+
+    def complete(self, page, html):
+        if self.end_page is not None and page >= self.end_page:
+            return []
+        stations = parse_stations(html) if html else []
+        if not html:
+            producer_log.error("can not get the page for %s, the genre is %s", self.page_url(page), self.genre)
+            self.failed = True
+        if stations:
+            self.pages[page] = stations
+            page_count = html_extractor.extract_page_count(html)
+            if page_count:
+                self.last_page = max(self.last_page or 0, page_count)
+        else:
+            self.end_page = page
+            self.pages = dict((p, v) for p, v in self.pages.items() if p < page)
+
+        ready = []
+        while self.emit_page in self.pages:
+            ready.extend(self.pages.pop(self.emit_page))
+            self.emit_page += 1
+        self.stations.extend(ready)
+        return ready
+
+    def is_stale(self, page):
+        # a page after the end of the genre, its request can be cancelled
+        return self.end_page is not None and page > self.end_page or self.finished
+
+    def print_stats(self):
+        producer_log.info("genres name: %s, station number: %d", self.genre, len(self.stations))
+        producer_log.info("get the station pages of the targeted genre using %d seconds", time.time() - self.begin_time)
+
+
+class StationListing(object):
+    """
+    the listing genres of every station found so far. a station listed by several genres is
+    queued at its first listing only, so its page and iframe are fetched once. the record stage
+    writes the genres listed by then, the complete genres of the stations listed more than once
+    go to the listing file next to the source file once every genre is listed (see write_listing).
+    """
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.genres = {}
+
+    def add(self, station_url, genre):
+        # True the first time the station is listed
+        with self.mutex:
+            genres = self.genres.get(station_url)
+            if genres is None:
+                self.genres[station_url] = [genre]
+                return True
+            if genre not in genres:
+                genres.append(genre)
+            return False
+
+    def get(self, station_url):
+        with self.mutex:
+            return list(self.genres.get(station_url, []))
+
+    def shared(self):
+        # (station url, genres) of the stations listed by several genres
+        with self.mutex:
+            return [(station_url, list(genres)) for station_url, genres in self.genres.items() if len(genres) > 1]
+
+    def __len__(self):
+        return len(self.genres)
+
+
+def journal_genre(journal, genre_pages):
+    # a genre cut short by a failed page is crawled again on resume
+    if not journal or genre_pages.failed:
+        return
+    for station_path, title in genre_pages.stations:
+        journal.record(JOURNAL_LISTED, genre_pages.genre, station_path, title)
+    journal.record(JOURNAL_GENRE, genre_pages.genre)
+
+
+def journal_entry(journal, kind, key):
+    if not journal:
+        return None
+    return lambda: journal.record(kind, key)
+
+
+def read_journal_genre(journal, genre):
+    stations = []
+    seen = set()
+    for station_path, title in journal.get_values(JOURNAL_LISTED, genre):
+        if station_path not in seen:
+            seen.add(station_path)
+            stations.append((station_path, title))
+    producer_log.info("genres name: %s, station number: %d, from the journal", genre, len(stations))
+    return stations
+
+
+def parse_station_page(results, station_url):
+    result = results[html_extractor.STATION_DETAIL_RULE.name]
+
+    if len(result) == 1:
+        detail = {
+            "logo_url": ROOT_URL + result[0][0],
+            "desc": result[0][1].strip(),
+            "country": result[0][2],
+            "genres": html_extractor.extract_genre_names(result[0][3]),
+            "rating": result[0][4]
+        }
+    else:
+        consumer_log.error("can not get logo_url, desc, country, genres, or rating from the page %s", station_url)
+        return None
+
+    iframe_path = results[html_extractor.STATION_FRAME_PATH_RULE.name]
+    if len(iframe_path) == 1:
+        detail["iframe_url"] = ROOT_URL + iframe_path[0]
+    else:
+        consumer_log.error("can not get the iframe url from the page %s", station_url)
+        return None
+    return detail
+
+
+def parse_station_iframe(results, iframe_url, station_url):
+    station_source_type = ""
+    station_source_urls = results[html_extractor.STATION_SOURCE_URL_RULE.name]
+    if station_source_urls and len(station_source_urls) == 1:
+        station_source_type = station_source_urls[0][0]
+        station_source_url = station_source_urls[0][1]
+    else:
+        station_embeded_source_urls = results[html_extractor.STATION_EMBEDED_SOURCE_URL_RULE.name]
+        if station_embeded_source_urls and len(station_embeded_source_urls) == 1:
+            station_source_url = station_embeded_source_urls[0]
+        else:
+            consumer_log.error("can not get the stream url from the page %s, the station url %s", iframe_url,
+                               station_url)
+            return None
+    return station_source_type, station_source_url
+
+
+def make_station(station_url, title, detail, source, listing_genres=None):
+    station_source_type, station_source_url = source
+    station = {
+        "station_page_url": station_url,
+        "station_source_url": station_source_url,
+        "station_source_type": station_source_type,
+        "logo_url": detail["logo_url"],
+        "title": title,
+        "desc": detail["desc"],
+        "country": detail["country"],
+        "genres": detail["genres"],
+        "rating": detail["rating"],
+        "generated_date": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+    }
+    if listing_genres is not None:
+        # the genres whose listings the station was found in, "genres" is what its own page says
+        station["listing_genres"] = listing_genres
+    return station
+
+
+def get_listing_file_name(output_file_name):
+    return output_file_name + ".listing"
+
+
+def write_listing(output_file_name, listing):
+    # one json line per station listed by several genres, its url and all the genres listing it
+    file_name = get_listing_file_name(output_file_name)
+    tmp_file_name = file_name + ".tmp"
+    stations = listing.shared()
+    with open(tmp_file_name, "w", encoding="utf-8") as f:
+        for station_url, genres in stations:
+            f.write(json.dumps({"station_page_url": station_url, "listing_genres": genres}) + "\n")
+    # replaced atomically, like the manifest of a sharded output
+    os.replace(tmp_file_name, file_name)
+    main_log.info("wrote the genres of %d stations listed by several genres to %s", len(stations), file_name)
+
+
+def read_listing(output_file_name):
+    # station url -> all its listing genres, from the listing file of a finished crawl
+    file_name = get_listing_file_name(output_file_name)
+    if not os.path.exists(file_name):
+        return {}
+    with open(file_name, encoding="utf-8") as f:
+        return dict((data["station_page_url"], data["listing_genres"]) for data in map(json.loads, f))
+
+
+def merge_listing_genres(data, listing_genres):
+    genres = listing_genres.get(data.get('station_page_url'))
+    if genres and data.get('listing_genres') is not None:
+        data['listing_genres'] = data['listing_genres'] + [g for g in genres if g not in data['listing_genres']]
+
+
+def read_station_sources(url_black_list, journal=None, dedup=None):
+    station_total, station_skipped = 0, 0
+    # the stream source urls seen so far, see dedup.py for the modes
+    seen = dedup if dedup is not None else make_dedup()
+    listing_genres = read_listing(RADIO_GUIDE_SOURCE_FILE)
+    # the source file of the crawl, plain or sharded
+    for line in read_json_lines(RADIO_GUIDE_SOURCE_FILE):
+        data = json.loads(line)
+        if not data or 'station_source_url' not in data:
+            producer_log.warning("the data is invalid[data=%s]", line)
+            continue
+
+        if data['station_source_url'] in url_black_list:
+            producer_log.warning("the station source url of the data is invalid[data=%s]", line)
+            continue
+
+        if not seen.add(data['station_source_url']):
+            continue
+
+        station_total += 1
+        if journal and journal.contains(JOURNAL_SOURCE, data['station_source_url']):
+            station_skipped += 1
+            continue
+        merge_listing_genres(data, listing_genres)
+        yield data
+
+    producer_log.info("station number: %d", station_total)
+    if journal:
+        producer_log.info("skipped %d stations finished before", station_skipped)
+
+
+def prefetch_station_hosts(url_black_list, journal=None):
+    # one pass over the source file queues the dns lookups of its hosts, they run while the first
+    # stations are probed and the stations asking for a host still queued move it to the front
+    if not DNS_PREFETCH or get_dns_cache() is None:
+        return
+    urls = set()
+    for line in read_json_lines(RADIO_GUIDE_SOURCE_FILE):
+        data = json.loads(line)
+        url = data.get('station_source_url') if data else None
+        if not url or url in url_black_list or (journal and journal.contains(JOURNAL_SOURCE, url)):
+            continue
+        urls.add(url)
+    producer_log.info("dns prefetch of %d hosts", prefetch_urls(urls))
+
+
+def get_station_source_url(station):
+    station_source_url = station['station_source_url']
+    if not station_source_url or not station_source_url.strip():
+        consumer_log.warning("the station source url is invalid[data=%s]", station_source_url)
+        return None
+    return station_source_url.strip()
+
+
+def get_page_results(http_client, url, cache_class, make_extractor):
+    # with an extraction pool the page is read whole and its bytes are extracted in a worker process,
+    # otherwise it is streamed into the extractor, which can end the download early
+    if util.extraction_pool:
+        body = http_client.get_url(url, cache_class=cache_class, ensure_utf8=False)
+        return util.extraction_pool.run(html_extractor.run_extractor, make_extractor, body) if body else None
+    extractor = http_client.get_url(url, cache_class=cache_class, extractor=make_extractor())
+    return extractor.results() if extractor else None
+
+
+async def get_page_results_async(http_client, url, cache_class, make_extractor):
+    if util.extraction_pool:
+        body = await http_client.get_url(url, cache_class=cache_class, ensure_utf8=False)
+        return await util.extraction_pool.run_async(html_extractor.run_extractor, make_extractor, body) \
+            if body else None
+    extractor = await http_client.get_url(url, cache_class=cache_class, extractor=make_extractor())
+    return extractor.results() if extractor else None
+
+
+def parse_playlist(data, url=None):
+    if util.extraction_pool and data:
+        return util.extraction_pool.run(parse_playlist_data, data, url, MAX_PLAYLIST_STREAMS)
+    return parse_playlist_data(data, url, MAX_PLAYLIST_STREAMS)
+
+
+async def parse_playlist_async(data, url=None):
+    if util.extraction_pool and data:
+        return await util.extraction_pool.run_async(parse_playlist_data, data, url, MAX_PLAYLIST_STREAMS)
+    return parse_playlist_data(data, url, MAX_PLAYLIST_STREAMS)
+
+
+def make_station_streams(resolved):
+    # the probe of every stream, under the url the playlist gave for it
+    final_stream_urls = []
+    for url, res in resolved:
+        data = json.loads(res)
+        data['url'] = url
+        final_stream_urls.append(data)
+    return final_stream_urls
+
+
+def update_station_streams(station, final_stream_urls):
+    if final_stream_urls:
+        station['stream_urls'] = final_stream_urls
+        station['parsed_date'] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+    return station
 
 
 class StationProducer(Producer):
-    def __init__(self, queue_size=2048000):
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE, fetch_workers=8, prefetch_pages=4, journal=None, listing=None):
         Producer.__init__(self, queue_size)
         kwargs = {
-            'requests_per_second': 5,
             'http_timeout': 60
         }
         self.http_client = HttpClient(**kwargs)
+        self.fetch_workers = fetch_workers
+        self.prefetch_pages = prefetch_pages
+        self.journal = journal
+        self.listing = listing if listing is not None else StationListing()
 
     def produce(self):
-        print("[INFO]producer: begin to get all station info list(including title and page_url)")
+        producer_log.info("begin to get all station info list(including title and page_url)")
 
         total_time1 = time.time()
         genres = self.get_genres(ROOT_URL + GENRES_PATH)
         genres_total = len(genres.items())
 
-        station_total = 0
-        for genre, genre_path in genres.items():
-            time1 = time.time()
-            station_pages = self.get_stations(genre, genre_path)
-            station_genre_total = 0
-
-            for station in station_pages:
-                station_genre_total += 1
-                yield station
-
-            station_total += station_genre_total
-            time2 = time.time()
-            print("[INFO]producer: genres name: %s, station number: %d" % (genre, station_genre_total))
-            print("[INFO]producer: get the station pages of the targeted genre using %d seconds" % (time2 - time1))
+        station_total, station_skipped = 0, 0
+        for genre, station in self.get_all_stations(genres):
+            station_total += 1
+            station_path, title = station
+            # a station listed by an earlier genre only adds this genre to its listing
+            if not self.listing.add(ROOT_URL + station_path, genre):
+                continue
+            if self.journal and self.journal.contains(JOURNAL_STATION, ROOT_URL + station_path):
+                station_skipped += 1
+                continue
+            yield station
 
         total_time2 = time.time()
-        print("[INFO]producer: genres number: %d, station number: %d" % (genres_total, station_total))
-        print("[INFO]producer: get all station info list(including title and page_url) using %d seconds"
-              % (total_time2 - total_time1))
+        producer_log.info("genres number: %d, station number: %d, unique stations: %d", genres_total, station_total,
+                          len(self.listing))
+        if self.journal:
+            producer_log.info("skipped %d stations finished before", station_skipped)
+        producer_log.info("get all station info list(including title and page_url) using %d seconds",
+                          total_time2 - total_time1)
 
         cur_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-        print("[INFO]producer: end to get all station info list(including title and page_url) at %s" % cur_time)
+        producer_log.info("end to get all station info list(including title and page_url) at %s", cur_time)
+
+    def get_all_stations(self, genres):
+        # the genre pages of all genres are fetched by one pool of workers,
+        # the (genre, station) pairs are yielded as soon as their page and the pages before it arrived.
+        pending = {}
+        executor = ThreadPoolExecutor(max_workers=self.fetch_workers)
+
+        def submit(genre_pages):
+            for page in genre_pages.pages_to_fetch():
+                future = executor.submit(self.http_client.get_url, genre_pages.page_url(page), cache_class='genre')
+                pending[future] = (genre_pages, page)
+
+        try:
+            for genre, genre_path in genres.items():
+                if self.journal and self.journal.contains(JOURNAL_GENRE, genre):
+                    for station in read_journal_genre(self.journal, genre):
+                        yield genre, station
+                    continue
+                producer_log.info("retrieving genre %s", get_genre_url(genre_path))
+                submit(GenrePages(genre, genre_path, self.prefetch_pages))
+
+            while pending:
+                done, _ = futures.wait(list(pending), return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    if future not in pending:
+                        continue
+                    genre_pages, page = pending.pop(future)
+                    if genre_pages.finished:
+                        continue
+                    for station in genre_pages.complete(page, future.result()):
+                        yield genre_pages.genre, station
+                    if genre_pages.finished:
+                        genre_pages.print_stats()
+                        journal_genre(self.journal, genre_pages)
+                    for other, (other_pages, other_page) in list(pending.items()):
+                        if other_pages is genre_pages and genre_pages.is_stale(other_page):
+                            other.cancel()
+                            del pending[other]
+                    submit(genre_pages)
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
 
     def get_genres(self, website_url):
-        html = self.http_client.get_url(website_url)
+        html = self.http_client.get_url(website_url, cache_class='genre')
         if not html:
-            print("[ERROR]producer: can not get the page of genres for %s" % website_url)
-        result = re.findall(GENRE_PAGE_RE, html, flags=re.DOTALL)
-        return dict(map(lambda x: (x[1], x[0]), result))
-
-    def get_stations(self, genre, path):
-        pathes = path.split("/")
-        path = "/".join([quote_plus(p) for p in pathes])
-        genre_url = ROOT_URL + path
-        print("[INFO]producer: retrieving genre %s" % genre_url)
-
-        index = 0
-        while True:
-            index += 1
-            genre_page_url = "%s?page=%d" % (genre_url, index)
-            # print("producer: retrieving the genre page %s" % origin)
-            html = self.http_client.get_url(genre_page_url)
-            if html:
-                stations = re.findall(STATION_RE, html, flags=re.DOTALL)
-                if len(stations) == 0:
-                    break
-                for station in stations:
-                    yield station
-            else:
-                print("[ERROR]producer: can not get the page for %s, the genre is %s" % (genre_page_url, genre))
-                break
-
-
-class StationConsumer(Consumer):
-    def __init__(self, queue, queue_timeout=5, consumer_id=0, output_file=None):
-        Consumer.__init__(self, queue, queue_timeout)
-        self.consumer_id = consumer_id
-        self.output_file = output_file
+            producer_log.error("can not get the page of genres for %s", website_url)
+        return parse_genres(html)
+
+
+class StationPageConsumer(StageConsumer):
+    # stage 'station': fetches the station page and hands its detail to the iframe stage
+    def __init__(self, stage, next_stage=None, queue_timeout=None, output_file=None, journal=None, consumer_id=0,
+                 listing=None, controller=None):
+        StageConsumer.__init__(self, stage, next_stage, queue_timeout, controller)
         kwargs = {
-            'requests_per_second': 5,
-            'http_timeout': 60
+            'http_timeout': 60,
+            'controller': controller
         }
         self.http_client = HttpClient(**kwargs)
 
     def consume(self, task):
-        station = self.get_station_detail(*task)
-        if station:
-            self.output_file.write_json(station)
-
-    def get_station_detail(self, station_path, title):
+        station_path, title = task
         station_url = ROOT_URL + station_path
-        html = self.http_client.get_url(station_url)
-        if not html:
-            print("[ERROR]consumer: can not get the page for %s" % station_url)
-            return {}
-        result = re.findall(STATION_DETAIL_RE, html, flags=re.DOTALL)
-
-        if len(result) == 1:
-            logo_url = ROOT_URL + result[0][0]
-            desc = result[0][1].strip()
-            country = result[0][2]
-            genres_array = re.findall(GENRE_NAME_RE, result[0][3], flags=re.DOTALL)
-            rating = result[0][4]
-        else:
-            print("[ERROR]consumer: can not get logo_url, desc, country, genres, or rating from the page %s"
-                  % station_url)
-            return {}
+        results = get_page_results(self.http_client, station_url, 'station', html_extractor.station_page_extractor)
+        if not results:
+            consumer_log.error("can not get the page for %s", station_url)
+            return
+        detail = parse_station_page(results, station_url)
+        if detail:
+            self.emit((station_url, title, detail))
+
+
+class StationIframeConsumer(StageConsumer):
+    # stage 'iframe': fetches the player iframe and hands the stream source to the record stage
+    def __init__(self, stage, next_stage=None, queue_timeout=None, output_file=None, journal=None, consumer_id=0,
+                 listing=None, controller=None):
+        StageConsumer.__init__(self, stage, next_stage, queue_timeout, controller)
+        kwargs = {
+            'http_timeout': 60,
+            'controller': controller
+        }
+        self.http_client = HttpClient(**kwargs)
 
-        iframe_path = re.findall(STATION_FRAME_PATH_RE, html, flags=re.DOTALL)
-        if len(iframe_path) == 1:
-            iframe_url = ROOT_URL + iframe_path[0]
-        else:
-            print("[ERROR]consumer: can not get the iframe url from the page %s" % station_url)
-            return {}
+    def consume(self, task):
+        station_url, title, detail = task
+        iframe_url = detail["iframe_url"]
+        results = get_page_results(self.http_client, iframe_url, 'iframe', html_extractor.station_iframe_extractor)
+        if not results:
+            consumer_log.error("can not get the page for the iframe url %s, the station url %s", iframe_url,
+                               station_url)
+            return
+        source = parse_station_iframe(results, iframe_url, station_url)
+        if source:
+            self.emit((station_url, title, detail, source))
+
+
+class StationRecordConsumer(StageConsumer):
+    # stage 'record': assembles the station record and writes it out with the genres listing it so far
+    def __init__(self, stage, next_stage=None, queue_timeout=None, output_file=None, journal=None, consumer_id=0,
+                 listing=None, controller=None):
+        StageConsumer.__init__(self, stage, next_stage, queue_timeout, controller)
+        self.output_file = output_file
+        self.journal = journal
+        self.consumer_id = consumer_id
+        self.listing = listing
 
-        html = self.http_client.get_url(iframe_url)
-        if not html:
-            print("[ERROR]consumer: can not get the page for the iframe url %s, the station url %s"
-                  % (iframe_url, station_url))
-            return {}
-
-        station_source_type = ""
-        station_source_urls = re.findall(STATION_SOURCE_URL_RE, html, flags=re.DOTALL)
-        if station_source_urls and len(station_source_urls) == 1:
-            station_source_type = station_source_urls[0][0]
-            station_source_url = station_source_urls[0][1]
-        else:
-            station_embeded_source_urls = re.findall(STATION_EMBEDED_SOURCE_URL_RE, html, flags=re.DOTALL)
-            if station_embeded_source_urls and len(station_embeded_source_urls) == 1:
-                station_source_url = station_embeded_source_urls[0]
-            else:
-                print("[ERROR]consumer: can not get the stream url from the page %s, the station url %s"
-                      % (iframe_url, station_url))
-                return {}
-
-        return {
-            "station_page_url": station_url,
-            "station_source_url": station_source_url,
-            "station_source_type": station_source_type,
-            "logo_url": logo_url,
-            "title": title,
-            "desc": desc,
-            "country": country,
-            "genres": genres_array,
-            "rating": rating,
-            "generated_date": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-        }
+    def consume(self, task):
+        listing_genres = self.listing.get(task[0]) if self.listing is not None else None
+        # the journal entry is recorded by the writer once the record is committed
+        self.output_file.write_json(make_station(*task, listing_genres=listing_genres),
+                                    journal_entry(self.journal, JOURNAL_STATION, task[0]), shard_key=self.consumer_id)
 
 
 class StationStreamProducer(Producer):
-    def __init__(self, queue_size=2048000):
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE, journal=None, dedup_options=None):
         Producer.__init__(self, queue_size)
         self.url_black_list = {"http://Yes"}
+        self.journal = journal
+        self.dedup_options = dedup_options or {}
 
     def produce(self):
-        print("[INFO]producer: begin to get all station info from the input file")
-
-        station_total = 0
-        data_map = {}
-        with open(RADIO_GUIDE_SOURCE_FILE) as input_file:
-            for line in input_file:
-                data = json.loads(line)
-                if not data or 'station_source_url' not in data:
-                    print("[WARN]producer: the data is invalid[data=%s]" % line)
-                    continue
-
-                if data['station_source_url'] in self.url_black_list:
-                    print("[WARN]producer: the station source url of the data is invalid[data=%s]" % line)
-                    continue
-
-                if data['station_source_url'] in data_map:
-                    continue
-                else:
-                    data_map[data['station_source_url']] = 1
+        producer_log.info("begin to get all station info from the input file")
+        prefetch_station_hosts(self.url_black_list, self.journal)
 
-                station_total += 1
-                yield data
+        for data in read_station_sources(self.url_black_list, self.journal, make_dedup(**self.dedup_options)):
+            yield data
 
-        print("[INFO]producer: station number: %d" % station_total)
         cur_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-        print("[INFO]producer: end to get all station info from the input file at %s" % cur_time)
+        producer_log.info("end to get all station info from the input file at %s", cur_time)
 
 
 class StationStreamConsumer(Consumer):
-    def __init__(self, queue, queue_timeout=5, consumer_id=0, output_file=None):
-        Consumer.__init__(self, queue, queue_timeout)
+    def __init__(self, queue, queue_timeout=None, consumer_id=0, output_file=None, journal=None, controller=None):
+        Consumer.__init__(self, queue, queue_timeout, controller)
         self.consumer_id = consumer_id
         self.output_file = output_file
+        self.journal = journal
         kwargs = {
-            'requests_per_second': 5,
-            'http_timeout': 60
+            'http_timeout': 60,
+            'controller': controller
         }
         self.http_client = HttpClient(**kwargs)
+        # requests can not read the 'ICY 200 OK' status line of a shoutcast stream
+        self.stream_probe = StreamProbe(controller=controller)
+        self.resolver = StreamResolver(self.fetch_playlist, self.probe_stream, max_depth=MAX_PLAYLIST_DEPTH,
+                                       fan_out=STREAM_FAN_OUT, max_streams=MAX_LIVE_STREAMS)
+
+    def run(self):
+        try:
+            Consumer.run(self)
+        finally:
+            self.resolver.close()
 
     def consume(self, station):
         res = self.parse_source_url(station)
         if res:
-            self.output_file.write_json(res)
+            self.output_file.write_json(res, journal_entry(self.journal, JOURNAL_SOURCE, res['station_source_url']),
+                                        shard_key=self.consumer_id)
 
     def parse_source_url(self, station):
-        station_source_url = station['station_source_url']
-        if not station_source_url or not station_source_url.strip():
-            print("[WARN]consumer: the station source url is invalid[data=%s]" % station_source_url)
+        station_source_url = get_station_source_url(station)
+        if not station_source_url:
             return None
+        return update_station_streams(station, make_station_streams(self.resolver.resolve(station_source_url)))
 
-        station_source_url = station_source_url.strip()
-        match = False
-        playlist_exts = ['.m3u', '.m3u8', '.pls', '.xspf', '.xml']
-        for ext in playlist_exts:
-            if station_source_url.endswith(ext):
-                match = True
-                break
-
-        stream_urls = []
-        if not match:
-            stream_url = {'url': station_source_url}
-            stream_urls.append(stream_url)
-        else:
-            data = self.http_client.get_url(station_source_url)
-            xs = parse_playlist_data(data)
-            if xs:
-                for x in xs:
-                    if x:
-                        stream_url = {'url': x}
-                        stream_urls.append(stream_url)
-            else:
-                print("[ERROR]consumer: the station source url is invalid[data=%s]" % station_source_url)
-
-        final_stream_urls = []
-        if stream_urls and len(stream_urls) >= 1:
-            for stream_url in stream_urls:
-                res = self.http_client.get_url(stream_url['url'], stream=True)
-                if res:
-                    data = json.loads(res)
-                    data.update(stream_url)
-                    final_stream_urls.append(data)
-            if final_stream_urls:
-                station['stream_urls'] = final_stream_urls
-                station['parsed_date'] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-
-        return station
-
-
-def crawl_radio_guide_source():
-    begin_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-    print("[INFO]main: get all the stations from radioguide at %s" % begin_time)
+    def fetch_playlist(self, url):
+        # called by the threads of the resolver, the http client keeps no state of a request
+        def load():
+            urls = parse_playlist(self.http_client.get_url(url, cache_class='playlist', ensure_utf8=False), url)
+            prefetch_urls(urls or [])
+            return urls
+        return resolve_cached(RESOLUTION_PLAYLIST, url, load)
 
-    output_file = OutputFile(RADIO_GUIDE_SOURCE_FILE)
+    def probe_stream(self, url):
+        return resolve_cached(RESOLUTION_STREAM, fix_url(url),
+                              lambda: self.stream_probe.probe_blocking(url, playlist_types=True))
 
-    thread_count = 8
-    producer = StationProducer()
-    producer.start()
-    consumer_array = []
-    for i in range(thread_count):
-        consumer = StationConsumer(queue=producer.queue, queue_timeout=30, consumer_id=i, output_file=output_file)
-        consumer_array.append(consumer)
-        consumer.start()
 
-    # waiting for producer and consumers finished
-    producer.join()
-    for consumer in consumer_array:
-        consumer.join()
+class AsyncStationProducer(AsyncProducer):
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE, fetch_workers=8, prefetch_pages=4, journal=None, listing=None):
+        AsyncProducer.__init__(self, queue_size)
+        kwargs = {
+            'http_timeout': 60
+        }
+        self.http_client = AsyncHttpClient(**kwargs)
+        self.fetch_workers = fetch_workers
+        self.prefetch_pages = prefetch_pages
+        self.journal = journal
+        self.listing = listing if listing is not None else StationListing()
 
-    output_file.destroy()
-    end_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-    print("[INFO]main: finish to get all the stations from radioguide at %s" % end_time)
+    async def produce(self):
+        producer_log.info("begin to get all station info list(including title and page_url)")
 
+        total_time1 = time.time()
+        genres = await self.get_genres(ROOT_URL + GENRES_PATH)
+        genres_total = len(genres.items())
 
-def parse_radio_guide_station():
-    begin_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-    print("[INFO]main: parse all the stations from radioguide at %s" % begin_time)
+        station_total, station_skipped = 0, 0
+        async for genre, station in self.get_all_stations(genres):
+            station_total += 1
+            station_path, title = station
+            # a station listed by an earlier genre only adds this genre to its listing
+            if not self.listing.add(ROOT_URL + station_path, genre):
+                continue
+            if self.journal and self.journal.contains(JOURNAL_STATION, ROOT_URL + station_path):
+                station_skipped += 1
+                continue
+            yield station
+
+        total_time2 = time.time()
+        producer_log.info("genres number: %d, station number: %d, unique stations: %d", genres_total, station_total,
+                          len(self.listing))
+        if self.journal:
+            producer_log.info("skipped %d stations finished before", station_skipped)
+        producer_log.info("get all station info list(including title and page_url) using %d seconds",
+                          total_time2 - total_time1)
+
+        cur_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        producer_log.info("end to get all station info list(including title and page_url) at %s", cur_time)
+
+    async def get_all_stations(self, genres):
+        # same scheduling as StationProducer.get_all_stations, a cancelled task also aborts its request
+        pending = {}
+        semaphore = asyncio.Semaphore(self.fetch_workers)
+
+        async def fetch(url):
+            async with semaphore:
+                return await self.http_client.get_url(url, cache_class='genre')
+
+        def submit(genre_pages):
+            for page in genre_pages.pages_to_fetch():
+                pending[asyncio.ensure_future(fetch(genre_pages.page_url(page)))] = (genre_pages, page)
+
+        try:
+            for genre, genre_path in genres.items():
+                if self.journal and self.journal.contains(JOURNAL_GENRE, genre):
+                    for station in read_journal_genre(self.journal, genre):
+                        yield genre, station
+                    continue
+                producer_log.info("retrieving genre %s", get_genre_url(genre_path))
+                submit(GenrePages(genre, genre_path, self.prefetch_pages))
+
+            while pending:
+                done, _ = await asyncio.wait(list(pending), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task not in pending:
+                        continue
+                    genre_pages, page = pending.pop(task)
+                    if genre_pages.finished:
+                        continue
+                    for station in genre_pages.complete(page, task.result()):
+                        yield genre_pages.genre, station
+                    if genre_pages.finished:
+                        genre_pages.print_stats()
+                        journal_genre(self.journal, genre_pages)
+                    for other, (other_pages, other_page) in list(pending.items()):
+                        if other_pages is genre_pages and genre_pages.is_stale(other_page):
+                            other.cancel()
+                            del pending[other]
+                    submit(genre_pages)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def get_genres(self, website_url):
+        html = await self.http_client.get_url(website_url, cache_class='genre')
+        if not html:
+            producer_log.error("can not get the page of genres for %s", website_url)
+        return parse_genres(html)
+
+
+class AsyncStationPageConsumer(AsyncStageConsumer):
+    # stage 'station': fetches the station page and hands its detail to the iframe stage
+    def __init__(self, stage, next_stage=None, queue_timeout=None, output_file=None, journal=None, consumer_id=0,
+                 listing=None, controller=None):
+        AsyncStageConsumer.__init__(self, stage, next_stage, queue_timeout, controller)
+        kwargs = {
+            'http_timeout': 60,
+            'controller': controller
+        }
+        self.http_client = AsyncHttpClient(**kwargs)
+
+    async def consume(self, task):
+        station_path, title = task
+        station_url = ROOT_URL + station_path
+        results = await get_page_results_async(self.http_client, station_url, 'station',
+                                               html_extractor.station_page_extractor)
+        if not results:
+            consumer_log.error("can not get the page for %s", station_url)
+            return
+        detail = parse_station_page(results, station_url)
+        if detail:
+            await self.emit((station_url, title, detail))
+
+
+class AsyncStationIframeConsumer(AsyncStageConsumer):
+    # stage 'iframe': fetches the player iframe and hands the stream source to the record stage
+    def __init__(self, stage, next_stage=None, queue_timeout=None, output_file=None, journal=None, consumer_id=0,
+                 listing=None, controller=None):
+        AsyncStageConsumer.__init__(self, stage, next_stage, queue_timeout, controller)
+        kwargs = {
+            'http_timeout': 60,
+            'controller': controller
+        }
+        self.http_client = AsyncHttpClient(**kwargs)
+
+    async def consume(self, task):
+        station_url, title, detail = task
+        iframe_url = detail["iframe_url"]
+        results = await get_page_results_async(self.http_client, iframe_url, 'iframe',
+                                               html_extractor.station_iframe_extractor)
+        if not results:
+            consumer_log.error("can not get the page for the iframe url %s, the station url %s", iframe_url,
+                               station_url)
+            return
+        source = parse_station_iframe(results, iframe_url, station_url)
+        if source:
+            await self.emit((station_url, title, detail, source))
+
+
+class AsyncStationRecordConsumer(AsyncStageConsumer):
+    # stage 'record': same as StationRecordConsumer
+    def __init__(self, stage, next_stage=None, queue_timeout=None, output_file=None, journal=None, consumer_id=0,
+                 listing=None, controller=None):
+        AsyncStageConsumer.__init__(self, stage, next_stage, queue_timeout, controller)
+        self.output_file = output_file
+        self.journal = journal
+        self.consumer_id = consumer_id
+        self.listing = listing
+
+    async def consume(self, task):
+        listing_genres = self.listing.get(task[0]) if self.listing is not None else None
+        # the journal entry is recorded by the writer once the record is committed
+        self.output_file.write_json(make_station(*task, listing_genres=listing_genres),
+                                    journal_entry(self.journal, JOURNAL_STATION, task[0]), shard_key=self.consumer_id)
+
+
+class AsyncStationStreamProducer(AsyncProducer):
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE, journal=None, dedup_options=None):
+        AsyncProducer.__init__(self, queue_size)
+        self.url_black_list = {"http://Yes"}
+        self.journal = journal
+        self.dedup_options = dedup_options or {}
 
-    output_file = OutputFile(RADIO_GUIDE_OUTPUT_FILE)
+    async def produce(self):
+        producer_log.info("begin to get all station info from the input file")
+        prefetch_station_hosts(self.url_black_list, self.journal)
 
-    thread_count = 8
-    producer = StationStreamProducer()
+        for data in read_station_sources(self.url_black_list, self.journal, make_dedup(**self.dedup_options)):
+            yield data
+
+        cur_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        producer_log.info("end to get all station info from the input file at %s", cur_time)
+
+
+class AsyncStationStreamConsumer(AsyncConsumer):
+    def __init__(self, queue, queue_timeout=None, consumer_id=0, output_file=None, journal=None, controller=None):
+        AsyncConsumer.__init__(self, queue, queue_timeout, controller)
+        self.consumer_id = consumer_id
+        self.output_file = output_file
+        self.journal = journal
+        kwargs = {
+            'http_timeout': 60,
+            'controller': controller
+        }
+        self.http_client = AsyncHttpClient(**kwargs)
+        self.stream_probe = StreamProbe(controller=controller)
+        self.resolver = AsyncStreamResolver(self.fetch_playlist, self.probe_stream, max_depth=MAX_PLAYLIST_DEPTH,
+                                            fan_out=STREAM_FAN_OUT, max_streams=MAX_LIVE_STREAMS)
+
+    async def consume(self, station):
+        res = await self.parse_source_url(station)
+        if res:
+            self.output_file.write_json(res, journal_entry(self.journal, JOURNAL_SOURCE, res['station_source_url']),
+                                        shard_key=self.consumer_id)
+
+    async def parse_source_url(self, station):
+        station_source_url = get_station_source_url(station)
+        if not station_source_url:
+            return None
+        return update_station_streams(station, make_station_streams(await self.resolver.resolve(station_source_url)))
+
+    async def fetch_playlist(self, url):
+        async def load():
+            data = await self.http_client.get_url(url, cache_class='playlist', ensure_utf8=False)
+            urls = await parse_playlist_async(data, url)
+            prefetch_urls(urls or [])
+            return urls
+        return await resolve_cached_async(RESOLUTION_PLAYLIST, url, load)
+
+    async def probe_stream(self, url):
+        return await resolve_cached_async(RESOLUTION_STREAM, fix_url(url),
+                                         lambda: self.stream_probe.probe(url, playlist_types=True))
+
+
+def run_workers(producer_cls, consumer_cls, output_file, worker_count, engine, journal=None, producer_kwargs=None,
+                controller=None):
+    producer_kwargs = producer_kwargs or {}
+    if engine == ENGINE_ASYNCIO:
+        def setup():
+            producer = producer_cls(journal=journal, **producer_kwargs)
+            metrics.watch_queue(STAGE_STREAM, producer.queue)
+            consumers = [consumer_cls(queue=producer.queue, consumer_id=i, output_file=output_file,
+                                      journal=journal, controller=controller)
+                         for i in range(worker_count)]
+            return producer, consumers
+
+        def teardown():
+            print_connection_pool_stats(close_async_connection_pool())
+            print_http_cache_stats()
+            print_transfer_stats()
+            print_extraction_pool_stats()
+            print_resolution_cache_stats()
+            print_dns_cache_stats()
+
+        run_event_loop(setup, teardown=teardown)
+        return
+
+    producer = producer_cls(journal=journal, **producer_kwargs)
+    metrics.watch_queue(STAGE_STREAM, producer.queue)
     producer.start()
     consumer_array = []
-    for i in range(thread_count):
-        consumer = StationStreamConsumer(queue=producer.queue, queue_timeout=30, consumer_id=i, output_file=output_file)
+    for i in range(worker_count):
+        consumer = consumer_cls(queue=producer.queue, consumer_id=i, output_file=output_file,
+                                journal=journal, controller=controller)
         consumer_array.append(consumer)
         consumer.start()
 
@@ -345,10 +896,218 @@ def parse_radio_guide_station():
     producer.join()
     for consumer in consumer_array:
         consumer.join()
+    print_connection_pool_stats(connection_pool.stats())
+    print_http_cache_stats()
+    print_transfer_stats()
+    print_extraction_pool_stats()
+    print_resolution_cache_stats()
+    print_dns_cache_stats()
+
+
+def run_station_pipeline(output_file, engine, stage_workers, queue_size=1024, producer_kwargs=None, journal=None,
+                         controllers=None, listing=None):
+    # station page -> iframe -> record, every stage has its own workers and a bounded queue in front
+    listing = listing if listing is not None else StationListing()
+    controllers = controllers or {}
+    producer_kwargs = dict(producer_kwargs or {}, queue_size=queue_size, journal=journal, listing=listing)
+    if engine == ENGINE_ASYNCIO:
+        producer_cls, queue_cls = AsyncStationProducer, asyncio.Queue
+        consumer_classes = [AsyncStationPageConsumer, AsyncStationIframeConsumer, AsyncStationRecordConsumer]
+    else:
+        producer_cls, queue_cls = StationProducer, queue.Queue
+        consumer_classes = [StationPageConsumer, StationIframeConsumer, StationRecordConsumer]
+
+    def build_stages(producer):
+        station = Stage(STAGE_STATION, producer.queue)
+        iframe = Stage(STAGE_IFRAME, queue_cls(maxsize=queue_size), upstream=station)
+        record = Stage(STAGE_RECORD, queue_cls(maxsize=queue_size), upstream=iframe)
+        for stage in [station, iframe, record]:
+            metrics.watch_queue(stage.name, stage.queue)
+        return [station, iframe, record]
+
+    def build_consumers(stages):
+        consumers = []
+        for i, stage in enumerate(stages):
+            next_stage = stages[i + 1] if i + 1 < len(stages) else None
+            for consumer_id in range(stage_workers[stage.name]):
+                consumers.append(consumer_classes[i](stage, next_stage, output_file=output_file,
+                                                     journal=journal, consumer_id=consumer_id, listing=listing,
+                                                     controller=controllers.get(stage.name)))
+        return consumers
+
+    if engine == ENGINE_ASYNCIO:
+        pipeline = []
+
+        def setup():
+            producer = producer_cls(**producer_kwargs)
+            pipeline.extend(build_stages(producer))
+            return producer, build_consumers(pipeline) + [AsyncStageMonitor(pipeline)]
+
+        def teardown():
+            print_stage_stats(pipeline)
+            print_connection_pool_stats(close_async_connection_pool())
+            print_http_cache_stats()
+            print_transfer_stats()
+            print_extraction_pool_stats()
+            print_dns_cache_stats()
+
+        run_event_loop(setup, teardown=teardown)
+        return
+
+    producer = producer_cls(**producer_kwargs)
+    stages = build_stages(producer)
+    consumers = build_consumers(stages)
+    producer.start()
+    for consumer in consumers:
+        consumer.start()
+    StageMonitor(stages).start()
+
+    # waiting for producer and consumers finished
+    producer.join()
+    for consumer in consumers:
+        consumer.join()
+    print_stage_stats(stages)
+    print_connection_pool_stats(connection_pool.stats())
+    print_http_cache_stats()
+    print_transfer_stats()
+    print_extraction_pool_stats()
+    print_dns_cache_stats()
+
+
+def print_connection_pool_stats(stats):
+    main_log.info("connection pool hits: %d, misses: %d, evictions: %d, idle: %d", stats['hits'], stats['misses'],
+                  stats['evictions'], stats['idle'])
+
+
+def print_http_cache_stats():
+    if not util.http_cache:
+        return
+    stats = util.http_cache.stats()
+    main_log.info("http cache hits: %d, revalidated: %d, misses: %d, entries: %d, size: %d", stats['hits'],
+                  stats['revalidated'], stats['misses'], stats['entries'], stats['size'])
+
+
+def print_extraction_pool_stats():
+    if not util.extraction_pool:
+        return
+    stats = util.extraction_pool.stats()
+    main_log.info("extraction processes: %d, tasks: %d, waited: %.1f seconds", stats['processes'], stats['tasks'],
+                  stats['wait_time'])
+
+
+def print_resolution_cache_stats():
+    if not util.resolution_cache:
+        return
+    for kind, stats in sorted(util.resolution_cache.stats().items()):
+        main_log.info("resolution cache %s hits: %d, coalesced: %d, misses: %d, hit rate: %.1f%%, entries: %d",
+                      kind, stats['hits'], stats['coalesced'], stats['misses'], stats['hit_rate'] * 100,
+                      stats['entries'])
+
+
+def print_dns_cache_stats():
+    cache = get_dns_cache()
+    if not cache:
+        return
+    stats = cache.stats()
+    main_log.info("dns cache hits: %d, negative hits: %d, coalesced: %d, misses: %d, prefetched: %d, failed: %d, "
+                  "hit rate: %.1f%%, entries: %d", stats['hits'], stats['negative_hits'], stats['coalesced'],
+                  stats['misses'], stats['prefetched'], stats['failed'], stats['hit_rate'] * 100, stats['entries'])
+
+
+def print_transfer_stats():
+    stats = util.transfer_stats.stats()
+    if not stats['pages']:
+        return
+    main_log.info("streamed pages: %d, cut off early: %d, bytes read: %d, bytes skipped: %d", stats['pages'],
+                  stats['cutoffs'], stats['bytes_read'], stats['bytes_skipped'])
+
+
+def make_controllers(engine, stage_workers, adaptive_workers):
+    # an adaptive stage starts its max workers, the controller decides how many of them run at once
+    controllers = {}
+    controller_cls = AsyncConcurrencyController if engine == ENGINE_ASYNCIO else ConcurrencyController
+    for stage, (min_workers, max_workers) in (adaptive_workers or {}).items():
+        if stage not in stage_workers or stage not in ADAPTIVE_STAGES:
+            main_log.warning("the stage %s has no adaptive workers here, ignored", stage)
+            continue
+        controllers[stage] = controller_cls(stage, min_workers=min_workers, max_workers=max_workers,
+                                            workers=stage_workers[stage], **CONTROLLER_OPTIONS.get(stage, {}))
+        metrics.watch_concurrency(stage, controllers[stage])
+        stage_workers[stage] = controllers[stage].max_workers
+    return controllers
+
+
+def parse_adaptive_workers(adaptive_workers):
+    stage_bounds = {}
+    for stage_workers in adaptive_workers:
+        stage, _, bounds = stage_workers.partition("=")
+        min_workers, _, max_workers = bounds.partition(":")
+        stage_bounds[stage] = (int(min_workers), int(max_workers))
+    return stage_bounds
+
+
+def parse_host_rates(host_rates, default_burst):
+    host_limits = {}
+    for host_rate in host_rates:
+        host, _, rate = host_rate.partition("=")
+        requests_per_second, _, burst = rate.partition(":")
+        host_limits[host] = (float(requests_per_second), int(burst) if burst else default_burst)
+    return host_limits
+
+
+def crawl_radio_guide_source(engine=ENGINE_THREAD, thread_count=8, fetch_workers=8, prefetch_pages=4,
+                             stage_workers=None, stage_queue_size=1024, resume=False, output_options=None,
+                             adaptive_workers=None):
+    begin_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+    main_log.info("get all the stations from radioguide at %s", begin_time)
+
+    # without resume both files start over, with resume the finished work in the journal is skipped
+    output_file = open_output_file(RADIO_GUIDE_SOURCE_FILE, append=resume, **(output_options or {}))
+    journal = Journal(get_journal_file_name(RADIO_GUIDE_SOURCE_FILE), resume=resume)
+    # a resumed crawl lists the finished genres again from the journal, so the listing ends up complete
+    listing = StationListing()
+    if not resume and os.path.exists(get_listing_file_name(RADIO_GUIDE_SOURCE_FILE)):
+        os.remove(get_listing_file_name(RADIO_GUIDE_SOURCE_FILE))
+
+    producer_kwargs = {'fetch_workers': fetch_workers, 'prefetch_pages': prefetch_pages}
+    workers = {STAGE_STATION: thread_count, STAGE_IFRAME: thread_count, STAGE_RECORD: 1}
+    workers.update(stage_workers or {})
+    controllers = make_controllers(engine, workers, adaptive_workers)
+    run_station_pipeline(output_file, engine, workers, queue_size=stage_queue_size, producer_kwargs=producer_kwargs,
+                         journal=journal, controllers=controllers, listing=listing)
+    print_concurrency_stats(controllers.values())
 
     output_file.destroy()
+    write_listing(RADIO_GUIDE_SOURCE_FILE, listing)
+    journal.close()
     end_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-    print("[INFO]main: finish to parse all the stations from radioguide at %s" % end_time)
+    main_log.info("finish to get all the stations from radioguide at %s", end_time)
+
+
+def parse_radio_guide_station(engine=ENGINE_THREAD, thread_count=8, resume=False, output_options=None,
+                              dedup_options=None, adaptive_workers=None):
+    begin_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+    main_log.info("parse all the stations from radioguide at %s", begin_time)
+
+    output_file = open_output_file(RADIO_GUIDE_OUTPUT_FILE, append=resume, **(output_options or {}))
+    journal = Journal(get_journal_file_name(RADIO_GUIDE_OUTPUT_FILE), resume=resume)
+
+    producer_kwargs = {'dedup_options': dedup_options}
+    workers = {STAGE_STREAM: thread_count}
+    controllers = make_controllers(engine, workers, adaptive_workers)
+    controller = controllers.get(STAGE_STREAM)
+    if engine == ENGINE_ASYNCIO:
+        run_workers(AsyncStationStreamProducer, AsyncStationStreamConsumer, output_file, workers[STAGE_STREAM], engine,
+                    journal, producer_kwargs, controller)
+    else:
+        run_workers(StationStreamProducer, StationStreamConsumer, output_file, workers[STAGE_STREAM], engine,
+                    journal, producer_kwargs, controller)
+    print_concurrency_stats(controllers.values())
+
+    output_file.destroy()
+    journal.close()
+    end_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+    main_log.info("finish to parse all the stations from radioguide at %s", end_time)
 
 
 if __name__ == "__main__":
@@ -356,10 +1115,142 @@ if __name__ == "__main__":
     args_array = ['--crawl-radioguide-source', '--parse-radioguide-station']
     for arg in args_array:
         parser.add_argument(arg, action="store_true")
+    # the asyncio engine runs every worker as a coroutine of one event loop,
+    # so the worker count can go far beyond the thread engine's.
+    parser.add_argument('--engine', choices=[ENGINE_THREAD, ENGINE_ASYNCIO], default=ENGINE_THREAD)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--root-url', default=ROOT_URL,
+                        help="the site to crawl, e.g. the local radioguide of benchmark/fixture_server.py")
+    parser.add_argument('--resume', action="store_true",
+                        help="append to the output of an interrupted run and skip the work in its journal")
+    parser.add_argument('--genre-workers', type=int, default=8, help="genre pages fetched concurrently")
+    parser.add_argument('--prefetch-pages', type=int, default=4,
+                        help="pages fetched ahead of a genre whose page count is unknown")
+    parser.add_argument('--station-workers', type=int, help="workers fetching station pages, --workers by default")
+    parser.add_argument('--iframe-workers', type=int, help="workers fetching player iframes, --workers by default")
+    parser.add_argument('--record-workers', type=int, default=1, help="workers writing station records")
+    parser.add_argument('--stage-queue-size', type=int, default=1024, help="bounded queue in front of every stage")
+    parser.add_argument('--adaptive-workers', action='append', default=[], metavar='STAGE=MIN:MAX',
+                        help="let the latency, timeouts and 429/5xx responses of the station, iframe or stream "
+                             "stage move its running workers between MIN and MAX, can be given several times")
+    # the rate limit is per host and shared by all workers, so adding workers does not raise it
+    parser.add_argument('--requests-per-second', type=float, default=5)
+    parser.add_argument('--burst', type=int, default=1)
+    parser.add_argument('--host-rate', action='append', default=[], metavar='HOST=RPS[:BURST]',
+                        help="per host override of the rate limit, can be given several times")
+    parser.add_argument('--http-cache', metavar='DIR', help="keep responses on disk and revalidate them on re-crawl")
+    parser.add_argument('--http-cache-size', type=int, default=1024, help="max size of the http cache in MB")
+    parser.add_argument('--http-cache-ttl', action='append', default=[], metavar='CLASS=SECONDS',
+                        help="seconds a cached genre/station/iframe/playlist page is used without revalidation")
+    parser.add_argument('--output-flush-records', type=int, default=1000,
+                        help="records written by the output writer between two flushes")
+    parser.add_argument('--output-flush-interval', type=float, default=1.0,
+                        help="max seconds a written record waits for the flush")
+    parser.add_argument('--output-fsync', choices=FSYNC_POLICIES, default=FSYNC_NEVER,
+                        help="fsync the output after every batch, on close only, or never")
+    parser.add_argument('--output-shards', type=int, default=0,
+                        help="write the output as this many compressed shards plus a manifest, 0 for a single file")
+    parser.add_argument('--output-shard-by', choices=[SHARD_BY_HASH, SHARD_BY_WORKER], default=SHARD_BY_HASH,
+                        help="pick the shard by the hash of station_page_url or by the writing worker")
+    parser.add_argument('--output-shard-size', type=int, default=256,
+                        help="MB of compressed data after which a shard starts a new file")
+    parser.add_argument('--output-compression', choices=sorted(COMPRESSION_EXTS), default=COMPRESSION_GZIP)
+    parser.add_argument('--dedup', choices=DEDUP_MODES, default=DEDUP_EXACT,
+                        help="how the stream source urls seen are kept: full urls, exact 64-bit fingerprints "
+                             "or a bloom filter")
+    parser.add_argument('--dedup-capacity', type=int, default=10000000, help="urls the bloom filter is sized for")
+    parser.add_argument('--dedup-error-rate', type=float, default=0.001,
+                        help="chance of the bloom filter taking a new url for a duplicate")
+    parser.add_argument('--extraction-processes', type=int, default=0,
+                        help="parse station pages, iframes and playlists in this many processes, 0 parses them "
+                             "in the fetching workers; pages are then read whole instead of cut off early")
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help="serve the metrics in the prometheus text format on http://127.0.0.1:PORT/metrics")
+    parser.add_argument('--metrics-interval', type=float, default=60,
+                        help="seconds between two metrics summary lines, 0 for none")
+    parser.add_argument('--log-level', action='append', default=[], metavar='[CATEGORY=]LEVEL',
+                        help="DEBUG, INFO, WARN or ERROR for all the logs, or for one category such as http, "
+                             "throttle, producer, consumer or output, can be given several times")
+    parser.add_argument('--log-format', choices=log.LOG_FORMATS, default=log.LOG_FORMAT_TEXT,
+                        help="text lines, or one json object per line")
+    parser.add_argument('--log-file', help="write the logs to this file instead of stdout")
+    parser.add_argument('--log-sample', action='append', default=[], metavar='CATEGORY=RATE',
+                        help="write only this share of the records of a category, throttle=0.01 by default")
+    parser.add_argument('--resolution-cache-size', type=int, default=100000,
+                        help="playlists and stream probes kept for the stations sharing them, 0 to resolve each one")
+    parser.add_argument('--resolution-cache-ttl', type=float, default=3600,
+                        help="seconds a resolved playlist or stream probe is reused")
+    parser.add_argument('--resolution-cache-error-ttl', type=float, default=300,
+                        help="seconds an empty playlist or a failed stream probe is reused")
+    parser.add_argument('--resolution-cache-file', help="keep the resolution cache in this file between runs")
+    parser.add_argument('--max-playlist-streams', type=int, default=MAX_PLAYLIST_STREAMS,
+                        help="stream urls taken from one playlist, 0 for all of them")
+    parser.add_argument('--max-playlist-depth', type=int, default=MAX_PLAYLIST_DEPTH,
+                        help="levels of playlists in playlists followed")
+    parser.add_argument('--stream-fan-out', type=int, default=STREAM_FAN_OUT,
+                        help="stream urls of one station probed at the same time")
+    parser.add_argument('--max-live-streams', type=int, default=MAX_LIVE_STREAMS,
+                        help="stop probing the streams of a station after this many answered, 0 probes all")
+    parser.add_argument('--dns-cache-size', type=int, default=10000,
+                        help="hosts whose addresses are kept, 0 leaves every connect to the system resolver")
+    parser.add_argument('--dns-cache-ttl', type=float, default=300,
+                        help="seconds addresses are kept when the resolver tells no ttl")
+    parser.add_argument('--dns-cache-max-ttl', type=float, default=3600, help="seconds addresses are kept at most")
+    parser.add_argument('--dns-cache-error-ttl', type=float, default=60,
+                        help="seconds a host that did not resolve is not asked again")
+    parser.add_argument('--dns-workers', type=int, default=16, help="host name lookups run at the same time")
+    parser.add_argument('--no-dns-prefetch', action="store_true",
+                        help="do not look up the hosts of the station sources before probing them")
+    parser.add_argument('--pool-size', type=int, default=10, help="idle keep-alive connections kept per host")
+    parser.add_argument('--pool-idle-timeout', type=float, default=60,
+                        help="seconds before an idle keep-alive connection is closed")
     args = parser.parse_args()
 
+    log_level, category_levels = log.parse_levels(args.log_level)
+    log.configure_logging(level=log_level, category_levels=category_levels, log_format=args.log_format,
+                          log_file=args.log_file, sample_rates=log.parse_sample_rates(args.log_sample))
+    ROOT_URL = args.root_url.rstrip("/")
+    MAX_PLAYLIST_STREAMS = args.max_playlist_streams
+    MAX_PLAYLIST_DEPTH = args.max_playlist_depth
+    STREAM_FAN_OUT = args.stream_fan_out
+    MAX_LIVE_STREAMS = args.max_live_streams
+    DNS_PREFETCH = not args.no_dns_prefetch
+    configure_http_cache(args.http_cache, max_size=args.http_cache_size * 1024 * 1024,
+                         ttls=dict((k, float(v)) for k, _, v in [t.partition("=") for t in args.http_cache_ttl]))
+    configure_connection_pool(pool_size=args.pool_size, idle_timeout=args.pool_idle_timeout)
+    configure_dns_cache(args.dns_cache_size, ttl=args.dns_cache_ttl, max_ttl=args.dns_cache_max_ttl,
+                        error_ttl=args.dns_cache_error_ttl, workers=args.dns_workers)
+    configure_extraction_pool(args.extraction_processes)
+    configure_resolution_cache(args.resolution_cache_size, ttl=args.resolution_cache_ttl,
+                               error_ttl=args.resolution_cache_error_ttl, cache_file=args.resolution_cache_file)
+    metrics.configure_metrics(port=args.metrics_port, interval=args.metrics_interval)
+    configure_rate_limiter(requests_per_second=args.requests_per_second, burst=args.burst,
+                           host_limits=parse_host_rates(args.host_rate, args.burst))
+
+    output_options = {'flush_records': args.output_flush_records, 'flush_interval': args.output_flush_interval,
+                      'fsync': args.output_fsync, 'shards': args.output_shards, 'shard_by': args.output_shard_by,
+                      'max_shard_size': args.output_shard_size * 1024 * 1024,
+                      'compression': args.output_compression}
+
     if args.crawl_radioguide_source:
-        crawl_radio_guide_source()
+        stage_workers = {STAGE_STATION: args.station_workers or args.workers,
+                         STAGE_IFRAME: args.iframe_workers or args.workers,
+                         STAGE_RECORD: args.record_workers}
+        crawl_radio_guide_source(engine=args.engine, thread_count=args.workers, fetch_workers=args.genre_workers,
+                                 prefetch_pages=args.prefetch_pages, stage_workers=stage_workers,
+                                 stage_queue_size=args.stage_queue_size, resume=args.resume,
+                                 output_options=output_options,
+                                 adaptive_workers=parse_adaptive_workers(args.adaptive_workers))
 
     if args.parse_radioguide_station:
-        parse_radio_guide_station()
+        dedup_options = {'mode': args.dedup, 'capacity': args.dedup_capacity, 'error_rate': args.dedup_error_rate}
+        parse_radio_guide_station(engine=args.engine, thread_count=args.workers, resume=args.resume,
+                                  output_options=output_options, dedup_options=dedup_options,
+                                  adaptive_workers=parse_adaptive_workers(args.adaptive_workers))
+
+    close_extraction_pool()
+    close_resolution_cache()
+    close_probe_loop()
+    close_dns_cache()
+    metrics.close_metrics()
+    log.close_logging()
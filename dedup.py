@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: abekthink
+
+import math
+from array import array
+from bisect import bisect_left
+
+import log
+
+DEDUP_DICT = "dict"
+DEDUP_EXACT = "exact"
+DEDUP_BLOOM = "bloom"
+DEDUP_MODES = [DEDUP_DICT, DEDUP_EXACT, DEDUP_BLOOM]
+
+dedup_log = log.get_logger("dedup")
+
+
+def url_fingerprint(url):
+    # the 64-bit siphash python keeps for every str, salted per process, which is fine for sets
+    # that live in memory only. the chance of any collision among 10M urls is about 3e-6.
+    return hash(url) & 0xffffffffffffffff
+
+
+class DictDedup(object):
+    # the full urls in a dict, as StationStreamProducer used to keep them
+    def __init__(self, **kwargs):
+        self.keys = {}
+
+    def add(self, key):
+        if key in self.keys:
+            return False
+        self.keys[key] = 1
+        return True
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class FingerprintSet(object):
+    """
+    exact set of 64-bit url fingerprints, 8 bytes per url plus a small write buffer.
+    the fingerprints are split into buckets by their top bits, every bucket is a sorted
+    array('Q') and a set of the latest fingerprints, merged into the array once the set
+    grows past an eighth of it, so the merges stay small and sorting stays cheap.
+    """
+
+    def __init__(self, bucket_bits=12, **kwargs):
+        self.shift = 64 - bucket_bits
+        self.arrays = [array('Q') for _ in range(1 << bucket_bits)]
+        self.pending = [set() for _ in range(1 << bucket_bits)]
+        self.count = 0
+
+    def add(self, key):
+        fingerprint = url_fingerprint(key)
+        bucket = fingerprint >> self.shift
+        pending = self.pending[bucket]
+        if fingerprint in pending:
+            return False
+        sorted_array = self.arrays[bucket]
+        index = bisect_left(sorted_array, fingerprint)
+        if index < len(sorted_array) and sorted_array[index] == fingerprint:
+            return False
+
+        pending.add(fingerprint)
+        self.count += 1
+        if len(pending) > max(64, len(sorted_array) >> 3):
+            merged = array('Q', sorted_array)
+            merged.extend(pending)
+            self.arrays[bucket] = array('Q', sorted(merged))
+            pending.clear()
+        return True
+
+    def __contains__(self, key):
+        fingerprint = url_fingerprint(key)
+        bucket = fingerprint >> self.shift
+        if fingerprint in self.pending[bucket]:
+            return True
+        sorted_array = self.arrays[bucket]
+        index = bisect_left(sorted_array, fingerprint)
+        return index < len(sorted_array) and sorted_array[index] == fingerprint
+
+    def __len__(self):
+        return self.count
+
+
+class BloomFilter(object):
+    """
+    probabilistic set: no false negatives, a url seen for the first time is taken for a
+    duplicate with probability error_rate as long as at most capacity urls are added.
+    the bit positions come from the 64-bit fingerprint by double hashing.
+    """
+
+    def __init__(self, capacity=10000000, error_rate=0.001, **kwargs):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.hash_count = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) >> 3)
+        self.count = 0
+
+    def add(self, key):
+        fingerprint = url_fingerprint(key)
+        h1, h2 = fingerprint & 0xffffffff, (fingerprint >> 32) | 1
+        bits, size = self.bits, self.size
+        new = False
+        for i in range(self.hash_count):
+            position = (h1 + i * h2) % size
+            mask = 1 << (position & 7)
+            if not bits[position >> 3] & mask:
+                bits[position >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+            if self.count == self.capacity + 1:
+                dedup_log.warning("the bloom filter holds more than %d urls, the error rate grows", self.capacity)
+        return new
+
+    def __contains__(self, key):
+        fingerprint = url_fingerprint(key)
+        h1, h2 = fingerprint & 0xffffffff, (fingerprint >> 32) | 1
+        bits, size = self.bits, self.size
+        for i in range(self.hash_count):
+            position = (h1 + i * h2) % size
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+
+def make_dedup(mode=DEDUP_EXACT, capacity=10000000, error_rate=0.001):
+    if mode == DEDUP_DICT:
+        return DictDedup()
+    if mode == DEDUP_EXACT:
+        return FingerprintSet()
+    if mode == DEDUP_BLOOM:
+        return BloomFilter(capacity=capacity, error_rate=error_rate)
+    raise ValueError("unknown dedup mode: %s" % mode)
@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: abekthink
+
+import asyncio
+import ipaddress
+import itertools
+import queue
+import socket
+import threading
+import time
+import log
+import metrics
+
+import urllib.parse as urlparse
+from collections import OrderedDict
+from concurrent import futures
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from urllib3.poolmanager import PoolManager
+
+try:
+    # with dnspython the answers are cached for their own ttl, the system resolver does not tell it
+    import dns.exception
+    import dns.resolver
+except ImportError:
+    dns = None
+
+DEFAULT_TTL = 300
+DEFAULT_MAX_TTL = 3600
+DEFAULT_ERROR_TTL = 60
+DEFAULT_LOOKUP_WORKERS = 16
+DEFAULT_LOOKUP_TIMEOUT = 5
+
+# the lookups somebody waits for go before the prefetched ones
+PRIORITY_CLOSE = 0
+PRIORITY_LOOKUP = 1
+PRIORITY_PREFETCH = 2
+
+dns_log = log.get_logger("dns")
+
+
+def normalize_host(host):
+    return host.strip('[]').rstrip('.').lower()
+
+
+def is_ip_address(host):
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
+
+
+def url_host(url):
+    try:
+        return urlparse.urlsplit(url.strip()).hostname
+    except ValueError:
+        return None
+
+
+class SystemResolver(object):
+    # getaddrinfo, what every connect did before. it tells no ttl.
+    def lookup(self, host):
+        # ([addresses], ttl or None), socket.gaierror if the host does not resolve
+        addresses = []
+        for _, _, _, _, sockaddr in socket.getaddrinfo(host, None, 0, socket.SOCK_STREAM):
+            if sockaddr[0] not in addresses:
+                addresses.append(sockaddr[0])
+        return addresses, None
+
+
+class DnsPythonResolver(object):
+    # asks the name servers of resolv.conf itself, the hosts file and ipv6 only hosts go to the system
+    def __init__(self, timeout=DEFAULT_LOOKUP_TIMEOUT):
+        self.resolver = dns.resolver.Resolver()
+        self.resolver.lifetime = timeout
+        # dnspython < 2.0 only has query()
+        self.query = getattr(self.resolver, 'resolve', None) or self.resolver.query
+        self.system = SystemResolver()
+
+    def lookup(self, host):
+        try:
+            answer = self.query(host, 'A')
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            return self.system.lookup(host)
+        except dns.exception.Timeout as e:
+            raise socket.gaierror(socket.EAI_AGAIN, 'lookup timed out: %s' % e)
+        except dns.exception.DNSException as e:
+            raise socket.gaierror(socket.EAI_FAIL, str(e))
+        return [item.address for item in answer], answer.rrset.ttl
+
+
+def default_resolver():
+    return DnsPythonResolver() if dns else SystemResolver()
+
+
+class DnsFlight(object):
+    # one lookup queued or running, everybody asking for the host meanwhile waits for its future
+    def __init__(self, priority):
+        self.future = futures.Future()
+        self.priority = priority
+        self.started = False
+
+
+class DnsCache(object):
+    """
+    in-memory LRU cache of the addresses of the hosts, kept for the ttl of the answer (ttl when the
+    resolver tells none, at most max_ttl), and of the failed lookups, kept for error_ttl.
+    the lookups run on worker threads of their own, so a slow name server holds up neither the
+    event loop nor more threads than the workers. a host is looked up once however many threads and
+    coroutines ask for it at the same time, and prefetch() queues the lookups of a batch of hosts
+    behind the ones somebody waits for. the resolver is anything with a lookup(host) method
+    returning ([addresses], ttl or None), see SystemResolver.
+    """
+
+    def __init__(self, resolver=None, max_entries=10000, ttl=DEFAULT_TTL, max_ttl=DEFAULT_MAX_TTL,
+                 error_ttl=DEFAULT_ERROR_TTL, workers=DEFAULT_LOOKUP_WORKERS):
+        self.resolver = resolver or default_resolver()
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_ttl = max_ttl
+        self.error_ttl = error_ttl
+        self.workers = workers
+        self.mutex = threading.Lock()
+        # host -> (addresses, error, expires_at), the least recently used first
+        self.entries = OrderedDict()
+        self.flights = {}
+        self.tasks = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.threads = []
+        self.counts = {'hits': 0, 'negative_hits': 0, 'coalesced': 0, 'misses': 0, 'prefetched': 0, 'failed': 0,
+                       'expired': 0, 'evictions': 0}
+
+    def count(self, result):
+        # called with the mutex held
+        self.counts[result] += 1
+        if result in ('hits', 'negative_hits', 'coalesced', 'misses', 'prefetched'):
+            metrics.observe_dns(result)
+
+    def lookup(self, host):
+        # (addresses, error, expires_at) of the cached answer, None when the host has to be looked up
+        entry = self.entries.get(host)
+        if entry is None:
+            return None
+        if entry[2] <= time.time():
+            del self.entries[host]
+            self.count('expired')
+            return None
+        self.entries.move_to_end(host)
+        return entry
+
+    def put(self, host, entry):
+        self.entries[host] = entry
+        self.entries.move_to_end(host)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.count('evictions')
+
+    def start(self, host):
+        # (entry, None) for a cached host, else (None, future of the lookup)
+        with self.mutex:
+            entry = self.lookup(host)
+            if entry is not None:
+                self.count('negative_hits' if entry[1] else 'hits')
+                return entry, None
+            flight = self.flights.get(host)
+            if flight is None:
+                flight = self.flights[host] = DnsFlight(PRIORITY_LOOKUP)
+                self.count('misses')
+                self.submit(PRIORITY_LOOKUP, host)
+            else:
+                self.count('coalesced')
+                if flight.priority != PRIORITY_LOOKUP and not flight.started:
+                    # a prefetched host somebody waits for now jumps the queue
+                    flight.priority = PRIORITY_LOOKUP
+                    self.submit(PRIORITY_LOOKUP, host)
+            return None, flight.future
+
+    def submit(self, priority, host):
+        # called with the mutex held, the workers are started with the first lookup
+        if not self.threads:
+            for i in range(max(1, self.workers)):
+                thread = threading.Thread(target=self.run_worker, name="dns-%d" % i)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        self.tasks.put((priority, next(self.sequence), host))
+
+    def run_worker(self):
+        while True:
+            _, _, host = self.tasks.get()
+            if host is None:
+                return
+            with self.mutex:
+                flight = self.flights.get(host)
+                # queued again with a higher priority and looked up already
+                if flight is None or flight.started:
+                    continue
+                flight.started = True
+            entry = self.load(host)
+            with self.mutex:
+                self.put(host, entry)
+                self.flights.pop(host, None)
+                if entry[1]:
+                    self.count('failed')
+            flight.future.set_result(entry)
+
+    def load(self, host):
+        begin = time.time()
+        try:
+            addresses, ttl = self.resolver.lookup(host)
+            if not addresses:
+                raise socket.gaierror(socket.EAI_NONAME, 'no addresses')
+        except OSError as e:
+            metrics.observe_dns_lookup('error', time.time() - begin)
+            dns_log.debug("lookup failed", host=host, error=e)
+            return None, (e.errno or socket.EAI_FAIL, e.strerror or str(e)), time.time() + self.error_ttl
+        except Exception as e:
+            metrics.observe_dns_lookup('error', time.time() - begin)
+            dns_log.exception("lookup failed", host=host)
+            return None, (socket.EAI_FAIL, str(e)), time.time() + self.error_ttl
+        metrics.observe_dns_lookup('ok', time.time() - begin)
+        ttl = self.ttl if ttl is None else ttl
+        return addresses, None, time.time() + min(ttl, self.max_ttl)
+
+    def answer(self, host, entry):
+        addresses, error, _ = entry
+        if error:
+            raise socket.gaierror(error[0], '%s: %s' % (error[1], host))
+        return addresses
+
+    def resolve(self, host, timeout=None):
+        """
+        the addresses of the host, socket.gaierror if it does not resolve and socket.timeout
+        if the lookup takes longer than timeout. the calling thread only waits.
+        """
+        host = normalize_host(host)
+        if is_ip_address(host):
+            return [host]
+        entry, future = self.start(host)
+        if future is not None:
+            try:
+                entry = future.result(timeout)
+            except futures.TimeoutError:
+                raise socket.timeout('dns lookup timed out: %s' % host)
+        return self.answer(host, entry)
+
+    async def resolve_async(self, host):
+        # the same for coroutines, a cancelled caller leaves the lookup running for the others
+        host = normalize_host(host)
+        if is_ip_address(host):
+            return [host]
+        entry, future = self.start(host)
+        if future is not None:
+            entry = await asyncio.shield(asyncio.wrap_future(future))
+        return self.answer(host, entry)
+
+    def prefetch(self, hosts):
+        # queue the lookups of the hosts neither cached nor being looked up, returns how many were queued
+        queued = 0
+        for host in set(normalize_host(host) for host in hosts if host):
+            if is_ip_address(host):
+                continue
+            with self.mutex:
+                if host in self.flights or self.lookup(host) is not None:
+                    continue
+                self.flights[host] = DnsFlight(PRIORITY_PREFETCH)
+                self.count('prefetched')
+                self.submit(PRIORITY_PREFETCH, host)
+            queued += 1
+        return queued
+
+    def stats(self):
+        with self.mutex:
+            stats = dict(self.counts, entries=len(self.entries), pending=len(self.flights))
+        lookups = stats['hits'] + stats['negative_hits'] + stats['coalesced'] + stats['misses']
+        stats['hit_rate'] = (lookups - stats['misses']) / float(lookups) if lookups else 0.0
+        return stats
+
+    def close(self):
+        # stops the workers, the lookups not started yet fail
+        with self.mutex:
+            threads, self.threads = self.threads, []
+            queued = [flight for flight in self.flights.values() if not flight.started]
+            self.flights = dict((host, flight) for host, flight in self.flights.items() if flight.started)
+        for _ in threads:
+            self.tasks.put((PRIORITY_CLOSE, next(self.sequence), None))
+        for flight in queued:
+            flight.future.set_result((None, (socket.EAI_AGAIN, 'the dns cache is closed'), 0))
+
+
+dns_cache = None
+
+
+def configure_dns_cache(max_entries, ttl=None, max_ttl=None, error_ttl=None, workers=None, resolver=None):
+    # 0 entries leaves the lookups to the system resolver in every connect
+    global dns_cache
+    close_dns_cache()
+    if not max_entries:
+        return None
+    kwargs = {'max_entries': max_entries, 'resolver': resolver}
+    for name, value in [('ttl', ttl), ('max_ttl', max_ttl), ('error_ttl', error_ttl), ('workers', workers)]:
+        if value is not None:
+            kwargs[name] = value
+    dns_cache = DnsCache(**kwargs)
+    return dns_cache
+
+
+def close_dns_cache():
+    global dns_cache
+    cache, dns_cache = dns_cache, None
+    if cache:
+        cache.close()
+    return cache
+
+
+def get_dns_cache(cache=None):
+    # the cache given to a client, else the shared one
+    return cache or dns_cache
+
+
+def prefetch_urls(urls, cache=None):
+    cache = get_dns_cache(cache)
+    if cache is None:
+        return 0
+    return cache.prefetch(url_host(url) for url in urls if url)
+
+
+async def open_connection(host, port, ssl=None, dns_cache=None):
+    # asyncio.open_connection with the host resolved through the dns cache, trying its addresses in turn
+    cache = get_dns_cache(dns_cache)
+    if cache is None:
+        return await asyncio.open_connection(host, port, ssl=ssl)
+    addresses = await cache.resolve_async(host)
+    for i, address in enumerate(addresses):
+        try:
+            return await asyncio.open_connection(address, port, ssl=ssl, server_hostname=host if ssl else None)
+        except OSError:
+            if i == len(addresses) - 1:
+                raise
+
+
+class DnsCacheConnectionMixin(object):
+    # the host of a new urllib3 connection is resolved through the dns cache, tls still verifies the host name
+    def __init__(self, *args, **kwargs):
+        self.dns_cache = kwargs.pop('dns_cache', None)
+        super(DnsCacheConnectionMixin, self).__init__(*args, **kwargs)
+
+    def _new_conn(self):
+        host = self._dns_host
+        if self.dns_cache is None:
+            return super(DnsCacheConnectionMixin, self)._new_conn()
+        timeout = self.timeout if isinstance(self.timeout, (int, float)) else None
+        try:
+            addresses = self.dns_cache.resolve(host, timeout)
+        except socket.timeout:
+            raise ConnectTimeoutError(self, 'Lookup of %s timed out. (connect timeout=%s)' % (host, timeout))
+        except socket.gaierror as e:
+            raise NewConnectionError(self, 'Failed to resolve %s: %s' % (host, e))
+        try:
+            for i, address in enumerate(addresses):
+                self._dns_host = address
+                try:
+                    return super(DnsCacheConnectionMixin, self)._new_conn()
+                except NewConnectionError:
+                    if i == len(addresses) - 1:
+                        raise
+        finally:
+            self._dns_host = host
+
+
+class DnsCacheHTTPConnection(DnsCacheConnectionMixin, HTTPConnection):
+    pass
+
+
+class DnsCacheHTTPSConnection(DnsCacheConnectionMixin, HTTPSConnection):
+    pass
+
+
+class DnsCachePoolManager(PoolManager):
+    def __init__(self, dns_cache, *args, **kwargs):
+        PoolManager.__init__(self, *args, **kwargs)
+        self.dns_cache = dns_cache
+
+    def _new_pool(self, scheme, host, port, request_context=None):
+        pool = PoolManager._new_pool(self, scheme, host, port, request_context)
+        pool.ConnectionCls = DnsCacheHTTPSConnection if scheme == 'https' else DnsCacheHTTPConnection
+        pool.conn_kw['dns_cache'] = self.dns_cache
+        return pool
+
+
+class DnsCacheAdapter(HTTPAdapter):
+    # mounted on a requests session, its connections resolve their hosts through the dns cache
+    def __init__(self, dns_cache, **kwargs):
+        self.dns_cache = dns_cache
+        HTTPAdapter.__init__(self, **kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        HTTPAdapter.init_poolmanager(self, connections, maxsize, block, **pool_kwargs)
+        self.poolmanager = DnsCachePoolManager(self.dns_cache, num_pools=connections, maxsize=maxsize, block=block,
+                                               **pool_kwargs)
@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: abekthink
+
+import re
+
+# The extraction rules below produce exactly what re.findall() returned for the DOTALL regexes the
+# crawler used before, without their chains of '.*?'. A rule is a list of steps: Seek(token) moves
+# the cursor past the next token and keeps its groups, Until(token) captures the text up to the next
+# token. The cursor of a rule only moves forward and never backtracks. The rules of a page advance
+# together in the order of their hits in the text, so the page goes through one forward pass, fed in
+# chunks as they arrive: a search resumes where the last one stopped, and the text behind every
+# rule is dropped.
+
+# a token regex cut off at the end of the text so far starts at most this far from it
+MAX_TOKEN_SIZE = 256
+# the text behind every rule is dropped once it is this much of the buffer
+COMPACT_SIZE = 4096
+
+REGEX_CHARS = '.^$*+?[]|()'
+QUANTIFIER_RE = re.compile(r'\{\d*,?\d*\}')
+
+
+def split_literal(token):
+    # the plain text a token starts with, and whether that is the whole token
+    literal = []
+    i = 0
+    while i < len(token):
+        c = token[i]
+        if c == '\\' and i + 1 < len(token) and not token[i + 1].isalnum():
+            literal.append(token[i + 1])
+            i += 2
+            continue
+        if c == '\\' or c in REGEX_CHARS or QUANTIFIER_RE.match(token, i):
+            if c in '*?{' and literal:
+                # the quantifier applies to the last char
+                literal.pop()
+            return ''.join(literal), False
+        literal.append(c)
+        i += 1
+    return ''.join(literal), True
+
+
+class Seek(object):
+    capture = False
+
+    def __init__(self, token):
+        self.token = re.compile(token)
+        # plain tokens are looked up with str.find, which is much cheaper than a regex search
+        self.literal, plain = split_literal(token)
+        if not plain:
+            self.literal = None
+        # text searched without a hit can hold the start of one only in its last chars
+        self.overlap = len(self.literal) - 1 if plain else MAX_TOKEN_SIZE
+
+
+class Until(Seek):
+    capture = True
+
+
+class Rule(object):
+    def __init__(self, name, steps):
+        self.name = name
+        self.steps = steps
+        self.compiled = [(step.capture, step.literal, step.token, step.overlap) for step in steps]
+
+
+GENRE_RULE = Rule('genres', [
+    Seek(r'<li>'),
+    Seek(r'<div\s+class="inner">'),
+    Seek(r'<a\s+href="(?=/genre/)'),
+    Until(r'"'),
+    Seek(r'>'),
+    Until(r'</a>'),
+    Seek(r'</div>'),
+    Seek(r'</li>'),
+])
+
+STATION_RULE = Rule('stations', [
+    Seek(r'<li\s+class="clearfix">'),
+    Seek(r'<div class="station-info2">'),
+    Seek(r'<a\s+href="(?=/)'),
+    Until(r'"'),
+    Seek(r'>'),
+    Seek(r'<strong>'),
+    Until(r'</strong>'),
+    Seek(r'</div>'),
+    Seek(r'</li>'),
+])
+
+STATION_DETAIL_RULE = Rule('detail', [
+    Seek(r'<div\s+class="player">'),
+    Seek(r'<span\s+class="logo">'),
+    Seek(r'<img\s+src="'),
+    Until(r'"\s+alt="'),
+    Until(r'">'),
+    Seek(r'</span>'),
+    Seek(r'</div>'),
+    Seek(r'<div\s+class="station-info">'),
+    Seek(r'<strong>Country:</strong>\s+<a\s+href="/'),
+    Seek(r'">'),
+    Until(r'</a>'),
+    Seek(r'<strong>Genre\(s\):</strong>'),
+    Until(r'\|'),
+    Seek(r'<strong>Rating:</strong>'),
+    Seek(r'<div'),
+    Seek(r'title="Rating:\s+(\d\.*\d*)"'),
+    Seek(r'>'),
+    Seek(r'</div>'),
+    Seek(r'</div>'),
+])
+
+STATION_FRAME_PATH_RULE = Rule('iframe', [
+    Seek(r'<iframe\s+name="playerContainer"'),
+    Seek(r'src="'),
+    Until(r'"'),
+    Seek(r'>'),
+    Seek(r'</iframe>'),
+])
+
+STATION_SOURCE_URL_RULE = Rule('source', [
+    Seek(r'"setMedia"'),
+    Seek(r'{'),
+    Until(r':'),
+    Seek(r'"'),
+    Until(r'"'),
+    Seek(r'}'),
+])
+
+STATION_EMBEDED_SOURCE_URL_RULE = Rule('embeded_source', [
+    Seek(r'<embed'),
+    Seek(r'src="'),
+    Until(r'"'),
+    Seek(r'>'),
+    Seek(r'<style>'),
+    Seek(r'</style>'),
+])
+
+GENRE_NAME_RE = re.compile(r"<a\s+href=\"/genre/.*?\">(.*?)</a>", re.DOTALL)
+
+PAGE_LINK_RE = re.compile(r"<a\s+href=\"[^\"]*[?&]page=(\d+)\"")
+
+
+def scan_page(rule, text, limit=None):
+    # the matches of one rule in a whole page: with all the text at hand there is no hit to hold back
+    # for the next chunk, no other rule to wait for and nothing to compact, so it is one tight loop
+    steps = rule.compiled
+    step_count = len(steps)
+    find = text.find
+    pos, step = 0, 0
+    captures, results = [], []
+    while limit is None or len(results) < limit:
+        capture, literal, token, _ = steps[step]
+        if literal is not None:
+            start = find(literal, pos)
+            if start < 0:
+                break
+            end = start + len(literal)
+            groups = None
+        else:
+            m = token.search(text, pos)
+            if m is None:
+                break
+            start, end = m.span()
+            groups = m.groups() if m.lastindex else None
+        if capture:
+            captures.append(text[pos:start])
+        elif groups:
+            captures.extend(groups)
+        pos = end
+        step += 1
+        if step == step_count:
+            results.append(captures[0] if len(captures) == 1 else tuple(captures))
+            captures = []
+            step = 0
+    return results
+
+
+class RuleState(object):
+    def __init__(self, rule, limit=None):
+        self.rule = rule
+        self.limit = limit
+        # offsets into the buffer of the extractor: the capture of an Until step starts at pos,
+        # the current step searches from resume, no hit of it starts before
+        self.pos = 0
+        self.resume = 0
+        self.step = 0
+        # (start, end, groups) of the next hit of the current step, once it is in the text
+        self.hit = None
+        self.stopped = False
+        self.captures = []
+        self.results = []
+
+    @property
+    def done(self):
+        return self.limit is not None and len(self.results) >= self.limit
+
+    @property
+    def active(self):
+        return not self.stopped and not self.done
+
+    def scan(self, buf, final, bound=None):
+        # advance as far as the text allows, or until the next hit starts after bound
+        steps = self.rule.compiled
+        step_count = len(steps)
+        pos, resume, step, hit = self.pos, self.resume, self.step, self.hit
+        captures, results, limit = self.captures, self.results, self.limit
+        while limit is None or len(results) < limit:
+            capture, literal, token, overlap = steps[step]
+            if hit is not None:
+                start, end, groups = hit
+                hit = None
+            elif literal is not None:
+                start = buf.find(literal, resume)
+                if start < 0:
+                    break
+                end = start + len(literal)
+                groups = None
+            else:
+                m = token.search(buf, resume)
+                if m is None:
+                    break
+                start, end = m.span()
+                groups = m.groups() if m.lastindex else None
+            if bound is not None and start > bound:
+                hit = (start, end, groups)
+                break
+            if capture:
+                captures.append(buf[pos:start])
+            elif groups:
+                captures.extend(groups)
+            pos = resume = end
+            step += 1
+            if step == step_count:
+                results.append(captures[0] if len(captures) == 1 else tuple(captures))
+                captures = []
+                step = 0
+        else:
+            self.pos, self.resume, self.step, self.hit, self.captures = pos, resume, step, hit, captures
+            return
+        if hit is None:
+            # the text so far has no hit, the next search starts where one may still begin
+            resume = max(resume, len(buf) - overlap)
+            # no more hits at the end of the page end the rule, like a regex that does not match
+            self.stopped = final
+        self.pos, self.resume, self.step, self.hit, self.captures = pos, resume, step, hit, captures
+
+    def keep_from(self):
+        # the start of the text the rule still needs
+        if self.rule.steps[self.step].capture:
+            return self.pos
+        return self.hit[0] if self.hit else self.resume
+
+    def shift(self, offset):
+        self.pos -= offset
+        self.resume -= offset
+        if self.hit:
+            self.hit = (self.hit[0] - offset, self.hit[1] - offset, self.hit[2])
+
+
+class PageExtractor(object):
+    """
+    runs several rules over one page, the text can be fed in chunks as it arrives.
+    limits maps a rule name to the number of matches after which the rule stops, enough to the number
+    of matches (its limit by default) the rule needs for the rest of the page to be skipped. the
+    extractor is done once every rule named in required (all by default) has exactly enough matches
+    in the text so far, a rule with more is ambiguous and its page is read to the end.
+    """
+
+    def __init__(self, rules, limits=None, required=None, enough=None):
+        limits = limits or {}
+        enough = enough or {}
+        self.buf = ''
+        self.closed = False
+        self.states = [RuleState(rule, limits.get(rule.name)) for rule in rules]
+        self.required = [(state, enough.get(state.rule.name, state.limit)) for state in self.states
+                         if required is None or state.rule.name in required]
+
+    def feed(self, text):
+        self.buf = self.buf + text if self.buf else text
+        self.scan(final=False)
+        self.compact()
+
+    def feed_page(self, text):
+        # the fast path of a page that arrived whole, in place of feed() and the end of the page
+        self.closed = True
+        for state in self.states:
+            state.results = scan_page(state.rule, text, state.limit)
+
+    def scan(self, final):
+        buf = self.buf
+        states = [state for state in self.states if state.active]
+        if len(states) == 1:
+            states[0].scan(buf, final)
+            return
+        for state in states:
+            state.scan(buf, final, -1)
+        while True:
+            # the rule with the hit nearest to the start of the page runs until it passes the next one
+            waiting = sorted((state for state in states if state.hit is not None), key=lambda x: x.hit[0])
+            if not waiting:
+                return
+            waiting[0].scan(buf, final, waiting[1].hit[0] if len(waiting) > 1 else None)
+
+    def compact(self):
+        # drop the text behind every rule, once it is worth the copy
+        states = [state for state in self.states if state.active]
+        offset = min(state.keep_from() for state in states) if states else len(self.buf)
+        if offset >= COMPACT_SIZE or (offset and offset == len(self.buf)):
+            self.buf = self.buf[offset:]
+            for state in states:
+                state.shift(offset)
+
+    @property
+    def done(self):
+        return all(count is not None and len(state.results) == count for state, count in self.required)
+
+    def results(self):
+        if not self.closed:
+            # the end of the page: a token regex cut off at the end of the text no longer waits for more
+            self.closed = True
+            self.scan(final=True)
+            self.buf = ''
+        return dict((state.rule.name, state.results) for state in self.states)
+
+
+def station_page_extractor():
+    # the logo, station-info block and player iframe sit near the top of the station page. a second
+    # match is kept, so the page is still rejected when it has two of them (see parse_station_page)
+    return PageExtractor([STATION_DETAIL_RULE, STATION_FRAME_PATH_RULE],
+                         limits={STATION_DETAIL_RULE.name: 2, STATION_FRAME_PATH_RULE.name: 2},
+                         enough={STATION_DETAIL_RULE.name: 1, STATION_FRAME_PATH_RULE.name: 1})
+
+
+def station_iframe_extractor():
+    # setMedia wins over embed, so only a single setMedia can end the page early. with two of them the
+    # page is read to the end and falls back to a single embed (see parse_station_iframe)
+    return PageExtractor([STATION_SOURCE_URL_RULE, STATION_EMBEDED_SOURCE_URL_RULE],
+                         limits={STATION_SOURCE_URL_RULE.name: 2, STATION_EMBEDED_SOURCE_URL_RULE.name: 2},
+                         enough={STATION_SOURCE_URL_RULE.name: 1},
+                         required=[STATION_SOURCE_URL_RULE.name])
+
+
+def run_extractor(make_extractor, text):
+    # a whole page through a new extractor, run in the processes of util.ExtractionPool.
+    # a page that is not utf-8 is rejected, like util.read_response does without the pool
+    if isinstance(text, bytes):
+        try:
+            text = text.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+    extractor = make_extractor()
+    extractor.feed_page(text)
+    return extractor.results()
+
+
+def extract(rules, html, limits=None):
+    limits = limits or {}
+    return dict((rule.name, scan_page(rule, html, limits.get(rule.name))) for rule in rules)
+
+
+def findall(rule, html):
+    return scan_page(rule, html)
+
+
+def extract_genre_names(genres_html):
+    return GENRE_NAME_RE.findall(genres_html)
+
+
+def extract_page_count(genre_html):
+    # the highest page linked from the pagination block, None when the page has no pagination
+    pages = [int(page) for page in PAGE_LINK_RE.findall(genre_html)]
+    return max(pages) if pages else None
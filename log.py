@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: abekthink
+
+import atexit
+import json
+import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+LOG_FORMAT_TEXT = "text"
+LOG_FORMAT_JSON = "json"
+LOG_FORMATS = [LOG_FORMAT_TEXT, LOG_FORMAT_JSON]
+
+ROOT_LOGGER_NAME = "crawler"
+# records waiting for the writer thread, once it falls that far behind new records are dropped
+LOG_QUEUE_SIZE = 65536
+
+# categories logging once per request or so, only one record in 1 / rate of them is written.
+# the throttle delays are summed up by the metrics anyway.
+DEFAULT_SAMPLE_RATES = {
+    "throttle": 0.01,
+}
+
+LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARN", ERROR: "ERROR", logging.CRITICAL: "CRITICAL"}
+LEVELS = {"DEBUG": DEBUG, "INFO": INFO, "WARN": WARNING, "WARNING": WARNING, "ERROR": ERROR}
+
+
+class Logger(object):
+    """
+    the logger of one category, e.g. "http" or "producer". a record below the level of the category
+    costs one cached level check, a sampled out one a counter increment. the message is formatted
+    with its args, and the keyword fields are written, by the writer thread only.
+    """
+
+    def __init__(self, category):
+        self.category = category
+        self.logger = logging.getLogger(ROOT_LOGGER_NAME + "." + category)
+        self.sample_every = 1
+        self.sample_count = 0
+
+    def set_sample_rate(self, rate):
+        # 1 keeps every record, 0 none
+        self.sample_every = int(round(1.0 / rate)) if rate > 0 else 0
+
+    def enabled(self, level):
+        return self.logger.isEnabledFor(level)
+
+    def log(self, level, msg, args, fields, exc_info=None):
+        if not self.logger.isEnabledFor(level):
+            return
+        if self.sample_every != 1:
+            if not self.sample_every:
+                return
+            # not locked, a lost increment only moves the sample by one
+            self.sample_count += 1
+            if self.sample_count % self.sample_every:
+                return
+            fields["sampled"] = self.sample_every
+        # no caller lookup, the category says where the record comes from
+        record = self.logger.makeRecord(self.logger.name, level, "", 0, msg, args, exc_info,
+                                        extra={"category": self.category, "fields": fields})
+        self.logger.handle(record)
+
+    def debug(self, msg, *args, **fields):
+        self.log(DEBUG, msg, args, fields)
+
+    def info(self, msg, *args, **fields):
+        self.log(INFO, msg, args, fields)
+
+    def warning(self, msg, *args, **fields):
+        self.log(WARNING, msg, args, fields)
+
+    def error(self, msg, *args, **fields):
+        self.log(ERROR, msg, args, fields)
+
+    def exception(self, msg, *args, **fields):
+        # an error with the traceback of the exception being handled
+        self.log(ERROR, msg, args, fields, sys.exc_info())
+
+
+def format_field(value):
+    text = str(value)
+    return json.dumps(text) if not text or " " in text or "=" in text else text
+
+
+class TextFormatter(logging.Formatter):
+    # [INFO]producer: station number: 10 url=http://... in the way the crawler always printed
+    def format(self, record):
+        line = "[%s]%s: %s" % (LEVEL_NAMES.get(record.levelno, record.levelname),
+                               getattr(record, "category", record.name), record.getMessage())
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join("%s=%s" % (key, format_field(value)) for key, value in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    # one json object per line: time, level, category, message, thread and the fields of the record
+    def format(self, record):
+        data = {
+            "time": round(record.created, 6),
+            "level": LEVEL_NAMES.get(record.levelno, record.levelname),
+            "category": getattr(record, "category", record.name),
+            "message": record.getMessage(),
+            "thread": record.threadName,
+        }
+        data.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str, ensure_ascii=False)
+
+
+class RecordQueueHandler(QueueHandler):
+    """
+    hands the records to the writer thread without blocking: they are queued as they are, unformatted,
+    and dropped when the queue is full. the args of a record must not change after it is logged.
+    """
+
+    def __init__(self, record_queue):
+        QueueHandler.__init__(self, record_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+loggers = {}
+category_sample_rates = dict(DEFAULT_SAMPLE_RATES)
+queue_handler = None
+listener = None
+
+
+def get_logger(category):
+    logger = loggers.get(category)
+    if logger is None:
+        logger = loggers.setdefault(category, Logger(category))
+        logger.set_sample_rate(category_sample_rates.get(category, 1))
+    return logger
+
+
+def make_handler(log_format=LOG_FORMAT_TEXT, log_file=None):
+    handler = logging.FileHandler(log_file, encoding="utf-8") if log_file else logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter() if log_format == LOG_FORMAT_JSON else TextFormatter())
+    return handler
+
+
+def parse_levels(levels):
+    # ["INFO", "http=DEBUG"] -> the level of all categories and the levels of single ones
+    level, category_levels = INFO, {}
+    for item in levels or []:
+        category, _, name = item.rpartition("=")
+        value = LEVELS.get(name.upper())
+        if value is None:
+            raise ValueError("unknown log level: %s" % item)
+        if category:
+            category_levels[category] = value
+        else:
+            level = value
+    return level, category_levels
+
+
+def parse_sample_rates(rates):
+    # ["throttle=0.01"] -> {"throttle": 0.01}
+    return dict((category, float(rate)) for category, _, rate in [r.partition("=") for r in rates or []])
+
+
+def configure_logging(level=INFO, category_levels=None, log_format=LOG_FORMAT_TEXT, log_file=None,
+                      sample_rates=None, queue_size=LOG_QUEUE_SIZE):
+    """
+    from here on records are queued to one writer thread, instead of every worker writing
+    to stdout under its lock. close_logging() writes the records still queued.
+    """
+    global queue_handler, listener
+    close_logging()
+    root = logging.getLogger(ROOT_LOGGER_NAME)
+    root.setLevel(level)
+    for category, category_level in (category_levels or {}).items():
+        logging.getLogger(ROOT_LOGGER_NAME + "." + category).setLevel(category_level)
+
+    category_sample_rates.update(sample_rates or {})
+    for category, logger in loggers.items():
+        logger.set_sample_rate(category_sample_rates.get(category, 1))
+
+    queue_handler = RecordQueueHandler(queue.Queue(queue_size))
+    listener = QueueListener(queue_handler.queue, make_handler(log_format, log_file))
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+    root.addHandler(queue_handler)
+    listener.start()
+
+
+def close_logging():
+    # back to writing in the calling thread, so nothing logged after the close gets lost
+    global queue_handler, listener
+    if listener is None:
+        return
+    root = logging.getLogger(ROOT_LOGGER_NAME)
+    root.removeHandler(queue_handler)
+    listener.stop()
+    handler = listener.handlers[0]
+    dropped = queue_handler.dropped
+    queue_handler, listener = None, None
+    root.addHandler(handler)
+    if dropped:
+        get_logger("log").warning("dropped %d records, the writer thread fell behind", dropped)
+
+
+def init_logging():
+    # until configure_logging() every record is written at once to stdout, like the prints were
+    root = logging.getLogger(ROOT_LOGGER_NAME)
+    root.setLevel(INFO)
+    root.propagate = False
+    root.addHandler(make_handler())
+
+
+init_logging()
+atexit.register(close_logging)
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: abekthink
+
+import http.server
+import socketserver
+import threading
+import time
+
+import log
+
+# the per host series of a metric stop at MAX_SERIES, later hosts are counted as OTHER_LABEL,
+# so probing millions of stream hosts does not grow the registry without bound.
+MAX_SERIES = 1000
+OTHER_LABEL = "other"
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+metrics_log = log.get_logger("metrics")
+
+
+def format_labels(label_names, labels):
+    if not label_names:
+        return ""
+    pairs = ('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+             for name, value in zip(label_names, labels))
+    return "{%s}" % ",".join(pairs)
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help_text, label_names=(), max_series=MAX_SERIES):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.max_series = max_series
+        self.mutex = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        # called with the mutex held
+        labels = tuple(labels)
+        if labels not in self.values and len(self.values) >= self.max_series:
+            labels = tuple(OTHER_LABEL for _ in labels)
+        return labels
+
+    def samples(self):
+        with self.mutex:
+            return [(self.name, labels, value) for labels, value in sorted(self.values.items())]
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help_text), "# TYPE %s %s" % (self.name, self.kind)]
+        for name, labels, value in self.samples():
+            lines.append("%s%s %s" % (name, format_labels(self.label_names, labels), format_value(value)))
+        return lines
+
+
+def format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return "%d" % value
+    return repr(value)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, labels=(), amount=1):
+        with self.mutex:
+            key = self.key(labels)
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def totals(self):
+        with self.mutex:
+            return dict(self.values)
+
+
+class Gauge(Metric):
+    """
+    a gauge is either set, or read from the function watched for its labels when it is rendered,
+    e.g. the qsize() of a queue.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, label_names=(), max_series=MAX_SERIES):
+        Metric.__init__(self, name, help_text, label_names, max_series)
+        self.watched = {}
+
+    def set(self, labels=(), value=0):
+        with self.mutex:
+            self.values[self.key(labels)] = value
+
+    def watch(self, labels, fn):
+        with self.mutex:
+            self.watched[tuple(labels)] = fn
+
+    def samples(self):
+        with self.mutex:
+            values = dict(self.values)
+            watched = list(self.watched.items())
+        for labels, fn in watched:
+            try:
+                values[labels] = fn()
+            except Exception:
+                pass
+        return [(self.name, labels, value) for labels, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS, max_series=MAX_SERIES):
+        Metric.__init__(self, name, help_text, label_names, max_series)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, labels=(), value=0.0):
+        with self.mutex:
+            key = self.key(labels)
+            series = self.values.get(key)
+            if series is None:
+                # the count of every bucket, then the sum and the count of all observations
+                series = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def means(self):
+        with self.mutex:
+            return dict((labels, series[-2] / series[-1]) for labels, series in self.values.items() if series[-1])
+
+    def samples(self):
+        samples = []
+        with self.mutex:
+            items = sorted((labels, list(series)) for labels, series in self.values.items())
+        for labels, series in items:
+            for bound, count in zip(self.buckets, series):
+                samples.append((self.name + "_bucket", labels + (repr(bound),), count))
+            samples.append((self.name + "_bucket", labels + ("+Inf",), series[-1]))
+            samples.append((self.name + "_sum", labels, series[-2]))
+            samples.append((self.name + "_count", labels, series[-1]))
+        return samples
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help_text), "# TYPE %s %s" % (self.name, self.kind)]
+        for name, labels, value in self.samples():
+            label_names = self.label_names + ("le",) if name.endswith("_bucket") else self.label_names
+            lines.append("%s%s %s" % (name, format_labels(label_names, labels), format_value(value)))
+        return lines
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.metrics = []
+
+    def register(self, metric):
+        with self.mutex:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, label_names=(), **kwargs):
+        return self.register(Counter(name, help_text, label_names, **kwargs))
+
+    def gauge(self, name, help_text, label_names=(), **kwargs):
+        return self.register(Gauge(name, help_text, label_names, **kwargs))
+
+    def histogram(self, name, help_text, label_names=(), **kwargs):
+        return self.register(Histogram(name, help_text, label_names, **kwargs))
+
+    def render(self):
+        with self.mutex:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+http_requests = registry.counter("crawler_http_requests_total", "http requests by host and request type",
+                                 ["host", "type"])
+http_responses = registry.counter("crawler_http_responses_total", "http responses by host and status code",
+                                  ["host", "status"])
+http_errors = registry.counter("crawler_http_errors_total", "http requests failed without a response, by error tag",
+                               ["host", "error_tag"])
+http_latency = registry.histogram("crawler_http_request_seconds", "time to the response headers by request type",
+                                  ["type"])
+throttle_delay = registry.counter("crawler_throttle_delay_seconds_total", "seconds requests waited for the rate limit",
+                                  ["host"])
+queue_depth = registry.gauge("crawler_queue_depth", "tasks waiting in front of a stage", ["stage"])
+concurrency_limit = registry.gauge("crawler_concurrency_limit", "workers a stage may run at once", ["stage"])
+stage_tasks = registry.counter("crawler_stage_tasks_total", "tasks finished by a stage", ["stage"])
+records_written = registry.counter("crawler_records_written_total", "records committed to an output file", ["file"])
+resolution_lookups = registry.counter("crawler_resolution_lookups_total",
+                                      "playlist and stream probe lookups by result: hits, coalesced or misses",
+                                      ["kind", "result"])
+dns_lookups = registry.counter("crawler_dns_lookups_total",
+                               "host name lookups by result: hits, negative_hits, coalesced, misses or prefetched",
+                               ["result"])
+dns_latency = registry.histogram("crawler_dns_lookup_seconds", "time of the host name lookups by the resolver",
+                                 ["result"])
+
+
+def observe_request(host, request_type, latency, status=None, error_tag=None):
+    http_requests.inc((host, request_type))
+    if status is None:
+        http_errors.inc((host, error_tag or "OtherError"))
+        return
+    http_responses.inc((host, status))
+    http_latency.observe((request_type,), latency)
+
+
+def observe_throttle(host, delay):
+    throttle_delay.inc((host,), delay)
+
+
+def observe_stage_task(stage):
+    stage_tasks.inc((stage,))
+
+
+def observe_records(file_name, count):
+    records_written.inc((file_name,), count)
+
+
+def observe_resolution(kind, result):
+    resolution_lookups.inc((kind, result))
+
+
+def observe_dns(result):
+    dns_lookups.inc((result,))
+
+
+def observe_dns_lookup(result, latency):
+    # result is ok or error
+    dns_latency.observe((result,), latency)
+
+
+def watch_queue(stage, queue):
+    queue_depth.watch((stage,), queue.qsize)
+
+
+def watch_concurrency(stage, controller):
+    concurrency_limit.watch((stage,), lambda: controller.limit)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # the registry in the prometheus text format on http://host:port/metrics
+    daemon_threads = True
+
+    def __init__(self, port, host="127.0.0.1", registry=registry):
+        http.server.HTTPServer.__init__(self, (host, port), MetricsHandler)
+        self.registry = registry
+        self.thread = threading.Thread(target=self.serve_forever, name="metrics-server")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        metrics_log.info("serving http://%s:%d/metrics", *self.server_address[:2])
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def top_items(totals, count=3):
+    items = sorted(totals.items(), key=lambda item: -item[1])[:count]
+    return ", ".join("%s=%s" % (key, format_value(value)) for key, value in items) or "-"
+
+
+def sum_by(totals, index):
+    sums = {}
+    for labels, value in totals.items():
+        sums[labels[index]] = sums.get(labels[index], 0) + value
+    return sums
+
+
+class MetricsReporter(threading.Thread):
+    """
+    prints one summary line of the registry every interval seconds: request and record rates,
+    the busiest hosts, status codes, error tags, mean latency by request type, queue depths.
+    """
+
+    def __init__(self, interval=60):
+        threading.Thread.__init__(self, name="metrics-reporter")
+        self.daemon = True
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.last_time = time.time()
+        self.last_requests = 0
+        self.last_records = 0
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def stop(self):
+        self.stopped.set()
+        self.report()
+
+    def report(self):
+        now = time.time()
+        elapsed = max(now - self.last_time, 1e-6)
+        requests = http_requests.totals()
+        request_count = sum(requests.values())
+        record_count = sum(records_written.totals().values())
+        depths = dict((labels[0], value) for _, labels, value in queue_depth.samples())
+        latencies = sorted(((labels[0], mean) for labels, mean in http_latency.means().items()), key=lambda x: -x[1])
+        metrics_log.info("requests: %d (%.1f/s), records: %d (%.1f/s), throttled: %.1fs, top hosts: %s, "
+                         "status: %s, errors: %s, latency: %s, queues: %s",
+                         request_count, (request_count - self.last_requests) / elapsed,
+                         record_count, (record_count - self.last_records) / elapsed,
+                         sum(throttle_delay.totals().values()), top_items(sum_by(requests, 0)),
+                         top_items(sum_by(http_responses.totals(), 1), 5),
+                         top_items(sum_by(http_errors.totals(), 1), 5),
+                         ", ".join("%s=%.3fs" % item for item in latencies) or "-", top_items(depths, 5))
+        self.last_time, self.last_requests, self.last_records = now, request_count, record_count
+
+
+metrics_server = None
+metrics_reporter = None
+
+
+def configure_metrics(port=0, interval=0, host="127.0.0.1"):
+    # port 0 serves no endpoint, interval 0 prints no summary
+    global metrics_server, metrics_reporter
+    if port:
+        metrics_server = MetricsServer(port, host)
+        metrics_server.start()
+    if interval:
+        metrics_reporter = MetricsReporter(interval)
+        metrics_reporter.start()
+
+
+def close_metrics():
+    # the last summary line covers the end of the run
+    global metrics_server, metrics_reporter
+    if metrics_reporter:
+        metrics_reporter.stop()
+        metrics_reporter = None
+    if metrics_server:
+        metrics_server.stop()
+        metrics_server = None
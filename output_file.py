@@ -2,3 +2,454 @@
 # -*- coding: utf-8 -*-
 # author: abekthink
 
+import gzip
+import json
+import lzma
+import os
+import queue
+import time
+import threading
+import zlib
+import log
+import metrics
+
+FSYNC_NEVER = "never"
+FSYNC_BATCH = "batch"
+FSYNC_CLOSE = "close"
+FSYNC_POLICIES = [FSYNC_NEVER, FSYNC_BATCH, FSYNC_CLOSE]
+
+SHARD_BY_HASH = "hash"
+SHARD_BY_WORKER = "worker"
+
+COMPRESSION_NONE = "none"
+COMPRESSION_GZIP = "gzip"
+COMPRESSION_LZMA = "lzma"
+COMPRESSION_EXTS = {COMPRESSION_NONE: "", COMPRESSION_GZIP: ".gz", COMPRESSION_LZMA: ".xz"}
+
+_STOP = object()
+
+output_log = log.get_logger("output")
+
+
+def truncate_partial_line(file_name):
+    # drops a last line cut off by a crash, so appending continues on a line boundary
+    if not os.path.exists(file_name):
+        return
+    with open(file_name, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b"\n":
+            return
+        pos = size
+        while pos > 0:
+            step = min(pos, 64 * 1024)
+            f.seek(pos - step)
+            index = f.read(step).rfind(b"\n")
+            if index >= 0:
+                pos = pos - step + index + 1
+                break
+            pos -= step
+        f.truncate(pos)
+        output_log.warning("dropped an incomplete last line of %s, %d bytes", file_name, size - pos)
+
+
+class OutputFile(object):
+    """
+    json lines output written by one writer thread.
+    write_json() only queues the record, the writer serializes the records and commits them
+    in batches: a flush after flush_records records or flush_interval seconds, plus an fsync
+    per batch (FSYNC_BATCH), on close only (FSYNC_CLOSE) or never (FSYNC_NEVER).
+    on_written callbacks run in the writer thread once their record is committed.
+    """
+
+    def __init__(self, output_file_name, append=False, flush_records=1000, flush_interval=1.0,
+                 fsync=FSYNC_NEVER, queue_size=10000):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("unknown fsync policy: %s" % fsync)
+        self.output_file_name = output_file_name
+        self.flush_records = flush_records
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.open_output(append)
+        self.queue = queue.Queue(maxsize=queue_size)
+
+        self.mutex = threading.Lock()
+        self.records = 0
+        self.batches = 0
+        self.errors = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+
+        self.writer = threading.Thread(target=self.run, name="output-writer")
+        self.writer.daemon = True
+        self.writer.start()
+
+    def open_output(self, append):
+        if append:
+            truncate_partial_line(self.output_file_name)
+        else:
+            # a fresh single file replaces the sharded output of an earlier run
+            remove_sharded_output(self.output_file_name)
+        self.file = open(self.output_file_name, "a" if append else "w", encoding="utf-8", buffering=1024 * 1024)
+
+    def write_records(self, records):
+        # returns the (enqueue_time, on_written) pairs to be confirmed by the next commit
+        self.file.write("".join(record[2] for record in records))
+        return [(record[0], record[4]) for record in records]
+
+    def flush_output(self):
+        self.file.flush()
+        if self.fsync == FSYNC_BATCH:
+            os.fsync(self.file.fileno())
+
+    def close_output(self):
+        self.file.flush()
+        if self.fsync != FSYNC_NEVER:
+            os.fsync(self.file.fileno())
+        self.file.close()
+
+    def write_json(self, json_data, on_written=None, shard_key=None):
+        self.queue.put((time.time(), json_data, on_written, shard_key))
+
+    def run(self):
+        pending = []
+        last_commit = time.time()
+        while True:
+            timeout = None
+            if pending:
+                timeout = max(self.flush_interval - (time.time() - last_commit), 0)
+            items = []
+            try:
+                items.append(self.queue.get(timeout=timeout))
+                # drain what is queued already, so a busy writer handles many records per wakeup
+                while len(items) < self.flush_records:
+                    items.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            stop = False
+            records = []
+            for item in items:
+                if item is _STOP:
+                    stop = True
+                    continue
+                enqueue_time, json_data, on_written, shard_key = item
+                try:
+                    records.append((enqueue_time, json_data, json.dumps(json_data) + "\n", shard_key, on_written))
+                except:
+                    output_log.exception("can not serialize a record for %s", self.output_file_name)
+                    with self.mutex:
+                        self.errors += 1
+            if records:
+                try:
+                    pending.extend(self.write_records(records))
+                except:
+                    output_log.exception("can not write %d records to %s", len(records), self.output_file_name)
+                    with self.mutex:
+                        self.errors += len(records)
+
+            if stop:
+                self.commit(pending)
+                return
+            if pending and (len(pending) >= self.flush_records or time.time() - last_commit >= self.flush_interval):
+                self.commit(pending)
+                pending = []
+                last_commit = time.time()
+
+    def commit(self, pending):
+        if not pending:
+            return
+        try:
+            self.flush_output()
+        except:
+            output_log.exception("can not flush %s", self.output_file_name)
+            with self.mutex:
+                self.errors += len(pending)
+            return
+
+        # the write lag is the time from write_json() to the record being committed
+        now = time.time()
+        metrics.observe_records(self.output_file_name, len(pending))
+        with self.mutex:
+            self.records += len(pending)
+            self.batches += 1
+            for enqueue_time, _ in pending:
+                lag = now - enqueue_time
+                self.total_lag += lag
+                self.max_lag = max(self.max_lag, lag)
+        run_callbacks(on_written for _, on_written in pending)
+
+    def stats(self):
+        with self.mutex:
+            return {
+                'records': self.records,
+                'batches': self.batches,
+                'errors': self.errors,
+                'queued': self.queue.qsize(),
+                'avg_lag': self.total_lag / self.records if self.records else 0.0,
+                'max_lag': self.max_lag
+            }
+
+    def destroy(self):
+        self.queue.put(_STOP)
+        self.writer.join()
+        try:
+            self.close_output()
+        except:
+            output_log.exception("can not close %s", self.output_file_name)
+        stats = self.stats()
+        output_log.info("%s records: %d, batches: %d, errors: %d, write lag avg: %.3f seconds, max: %.3f seconds",
+                        self.output_file_name, stats['records'], stats['batches'], stats['errors'], stats['avg_lag'],
+                        stats['max_lag'])
+
+
+def run_callbacks(callbacks):
+    for callback in callbacks:
+        if callback:
+            try:
+                callback()
+            except:
+                output_log.exception("the callback of a written record failed")
+
+
+class ShardPart(object):
+    # one compressed file of a shard, the size is what reached the disk so far and flushed the
+    # records a reader finds in it
+    def __init__(self, file_name, shard, part, compression):
+        self.file_name = file_name
+        self.shard = shard
+        self.part = part
+        self.compression = compression
+        self.raw = open(file_name, "wb")
+        if compression == COMPRESSION_GZIP:
+            self.file = gzip.GzipFile(fileobj=self.raw, mode="wb")
+        elif compression == COMPRESSION_LZMA:
+            self.file = lzma.LZMAFile(self.raw, mode="wb")
+        else:
+            self.file = self.raw
+        self.records = 0
+        self.flushed = 0
+        self.waiting = []
+
+    def write(self, data, count):
+        self.file.write(data)
+        self.records += count
+
+    def size(self):
+        return self.raw.tell()
+
+    def flush(self, fsync=False):
+        # a gzip sync flush makes everything written so far readable, an lzma stream only is at close
+        self.file.flush()
+        self.raw.flush()
+        if fsync:
+            os.fsync(self.raw.fileno())
+        if self.compression != COMPRESSION_LZMA:
+            self.flushed = self.records
+
+    def close(self, fsync=False):
+        if self.file is not self.raw:
+            self.file.close()
+        self.raw.flush()
+        if fsync:
+            os.fsync(self.raw.fileno())
+        self.raw.close()
+        self.flushed = self.records
+
+    def entry(self):
+        return {
+            "file": os.path.basename(self.file_name),
+            "shard": self.shard,
+            "part": self.part,
+            "records": self.flushed,
+            "bytes": self.size() if not self.raw.closed else os.path.getsize(self.file_name)
+        }
+
+
+class ShardedOutputFile(OutputFile):
+    """
+    OutputFile writing json lines to shards of compressed files, next to a manifest listing them.
+    a record goes to the shard picked by the hash of its hash_field (SHARD_BY_HASH), or by the
+    shard_key its worker passes to write_json (SHARD_BY_WORKER). a shard starts a new part once
+    max_shard_size compressed bytes are written. the compression runs in the writer thread.
+    """
+
+    def __init__(self, output_file_name, shards=8, shard_by=SHARD_BY_HASH, hash_field="station_page_url",
+                 max_shard_size=256 * 1024 * 1024, compression=COMPRESSION_GZIP, **kwargs):
+        if compression not in COMPRESSION_EXTS:
+            raise ValueError("unknown compression: %s" % compression)
+        self.shards = shards
+        self.shard_by = shard_by
+        self.hash_field = hash_field
+        self.max_shard_size = max_shard_size
+        self.compression = compression
+        OutputFile.__init__(self, output_file_name, **kwargs)
+
+    def open_output(self, append):
+        self.manifest_file_name = get_manifest_file_name(self.output_file_name)
+        manifest = read_manifest(self.output_file_name) if append else None
+        if not append:
+            remove_sharded_output(self.output_file_name)
+        # parts of an earlier run stay as they are, a resumed run continues with new parts
+        self.entries = manifest["files"] if manifest else []
+        self.next_parts = [1] * self.shards
+        for entry in self.entries:
+            if entry["shard"] < self.shards:
+                self.next_parts[entry["shard"]] = max(self.next_parts[entry["shard"]], entry["part"] + 1)
+        self.parts = [None] * self.shards
+        self.write_manifest()
+
+    def get_shard(self, json_data, shard_key):
+        if self.shard_by == SHARD_BY_WORKER:
+            key = shard_key if shard_key is not None else 0
+            return int(key) % self.shards
+        # crc32 keeps the shard of a station stable across runs, unlike hash()
+        key = str(json_data.get(self.hash_field, "")) if isinstance(json_data, dict) else ""
+        return zlib.crc32(key.encode("utf-8")) % self.shards
+
+    def get_part(self, shard):
+        part = self.parts[shard]
+        if part is None:
+            number = self.next_parts[shard]
+            self.next_parts[shard] += 1
+            file_name = "%s.%05d.%04d%s" % (self.output_file_name, shard, number, COMPRESSION_EXTS[self.compression])
+            part = ShardPart(file_name, shard, number, self.compression)
+            self.parts[shard] = part
+            self.write_manifest()
+        return part
+
+    def write_records(self, records):
+        groups = {}
+        for record in records:
+            groups.setdefault(self.get_shard(record[1], record[3]), []).append(record)
+
+        pending = []
+        for shard, group in groups.items():
+            part = self.get_part(shard)
+            part.write("".join(record[2] for record in group).encode("utf-8"), len(group))
+            if self.compression == COMPRESSION_LZMA:
+                # confirmed once the part is closed, see ShardPart.flush
+                part.waiting.extend(record[4] for record in group)
+                pending.extend((record[0], None) for record in group)
+            else:
+                pending.extend((record[0], record[4]) for record in group)
+            if part.size() >= self.max_shard_size:
+                # rotated: the manifest gets the final count of the part before the next one starts
+                self.close_part(shard)
+        return pending
+
+    def close_part(self, shard, fsync=None):
+        part = self.parts[shard]
+        self.parts[shard] = None
+        part.close(fsync=self.fsync != FSYNC_NEVER if fsync is None else fsync)
+        self.update_entry(part)
+        self.write_manifest()
+        run_callbacks(part.waiting)
+
+    def update_entry(self, part):
+        entry = part.entry()
+        self.entries = [e for e in self.entries if e["file"] != entry["file"]] + [entry]
+
+    def flush_output(self):
+        for part in self.parts:
+            if part is not None:
+                part.flush(fsync=self.fsync == FSYNC_BATCH)
+        # the counts of the open parts follow every commit, not only their close
+        self.write_manifest()
+
+    def close_output(self):
+        for shard, part in enumerate(self.parts):
+            if part is not None:
+                self.close_part(shard)
+
+    def write_manifest(self):
+        for part in self.parts:
+            if part is not None:
+                self.update_entry(part)
+        manifest = {
+            "compression": self.compression,
+            "shard_by": self.shard_by,
+            "shards": self.shards,
+            "records": sum(entry["records"] for entry in self.entries),
+            "files": sorted(self.entries, key=lambda e: (e["shard"], e["part"]))
+        }
+        # replaced atomically, a reader never sees half a manifest
+        tmp_file_name = self.manifest_file_name + ".tmp"
+        with open(tmp_file_name, "w") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp_file_name, self.manifest_file_name)
+
+
+def get_manifest_file_name(output_file_name):
+    return output_file_name + ".manifest"
+
+
+def read_manifest(output_file_name):
+    manifest_file_name = get_manifest_file_name(output_file_name)
+    if not os.path.exists(manifest_file_name):
+        return None
+    with open(manifest_file_name) as f:
+        return json.load(f)
+
+
+def remove_sharded_output(output_file_name):
+    manifest = read_manifest(output_file_name)
+    if not manifest:
+        return
+    base_dir = os.path.dirname(output_file_name)
+    for entry in manifest["files"]:
+        file_name = os.path.join(base_dir, entry["file"])
+        if os.path.exists(file_name):
+            os.remove(file_name)
+    os.remove(get_manifest_file_name(output_file_name))
+
+
+def open_output_file(output_file_name, append=False, shards=0, shard_by=SHARD_BY_HASH,
+                     max_shard_size=256 * 1024 * 1024, compression=COMPRESSION_GZIP, **kwargs):
+    if shards:
+        return ShardedOutputFile(output_file_name, shards=shards, shard_by=shard_by, max_shard_size=max_shard_size,
+                                 compression=compression, append=append, **kwargs)
+    return OutputFile(output_file_name, append=append, **kwargs)
+
+
+def open_shard_part(file_name):
+    if file_name.endswith(COMPRESSION_EXTS[COMPRESSION_GZIP]):
+        return gzip.open(file_name, "rt", encoding="utf-8")
+    if file_name.endswith(COMPRESSION_EXTS[COMPRESSION_LZMA]):
+        return lzma.open(file_name, "rt", encoding="utf-8")
+    return open(file_name, encoding="utf-8")
+
+
+def read_json_lines(output_file_name):
+    """
+    yields the lines written by OutputFile or ShardedOutputFile under output_file_name,
+    the manifest of a sharded output wins over a plain file of the same name.
+    """
+    manifest = read_manifest(output_file_name)
+    if not manifest:
+        with open(output_file_name, encoding="utf-8") as f:
+            for line in f:
+                yield line
+        return
+
+    base_dir = os.path.dirname(output_file_name)
+    for entry in manifest["files"]:
+        file_name = os.path.join(base_dir, entry["file"])
+        try:
+            with open_shard_part(file_name) as f:
+                for line in f:
+                    if line.endswith("\n"):
+                        yield line
+        except (EOFError, lzma.LZMAError, OSError) as e:
+            # the part a crash left unfinished, everything before the cut is kept
+            output_log.warning("stop reading the incomplete part %s, error = %s", file_name, e)
+
+
+if __name__ == "__main__":
+    output_file = OutputFile("a.output")
+    output_file.write_json({"a": 123, "b": "123"})
+    output_file.write_json({"a": 323, "b": "323"})
+    output_file.write_json({"a": 133, "b": "133"})
+    output_file.destroy()
@@ -14,9 +14,11 @@
     OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
     '''
 
-from xml.dom import minidom
 from random import randrange
 
+from .fastparser import sniff, m3uUrls, plsUrls
+from . import xspfparser, xmlparser
+
 try:
     from chardet.universaldetector import UniversalDetector
     chardet = True
@@ -109,38 +111,14 @@ class Playlist:
                     return True
 
 
-def typeGuess(data):
-    lines = data.split('\n')
-    if lines[0].startswith('http://') or \
-      lines[0].startswith('https://'):
-      return '.m3u'
-
-    if '#EXTM3U' in lines[0]:
-        try:
-            lines.decode('utf-8')
-            return '.m3u8'
-        except:
-            return '.m3u'
-    if '[playlist]' in lines[0]:
-        return '.pls'
-    dom = minidom.parseString(data)
-    try:
-        for namespace in dom.getElementsByTagName('playlist')[0].attributes.items():
-            try:
-                if namespace[1] == 'http://xspf.org/ns/0/':
-                    return '.xspf'
-            except:
-                pass
-    except:
-        pass
-    try:
-        dom.getElementsByTagName('plist')
-        return '.xml'
-    except:
-        return None
+def typeGuess(data, contentType=None, fileName=None):
+    # from the first bytes only, see fastparser.sniff
+    return sniff(data, contentType, fileName)
 
 
 def decode(filename, data):
+    if isinstance(data, str):
+        return {'data' : data, 'encoding' : 'utf-8'}
     if '.m3u8' in filename:
         encoding = 'utf-8'
         data = data.decode(encoding)
@@ -163,7 +141,7 @@ def decode(filename, data):
                     encoding = 'ascii'
             else:
                 encoding = 'ascii'
-    elif '.xml' in filename or '.xspf' in filename:
+    else:
         encoding = 'utf-8'
 
     return {'data' : data, 'encoding' : encoding}
@@ -174,6 +152,8 @@ def parse(filename=None, filedata=None, trackObject=Track, playlistObject=Playli
         file = filedata
         if filename == None:
             filename = typeGuess(filedata)
+            if filename == None:
+                return playlistObject(Tracks=list())
     else:
         f = open(filename, 'r')
         file = f.read()
@@ -192,18 +172,39 @@ def parse(filename=None, filedata=None, trackObject=Track, playlistObject=Playli
             encoding = decoded['encoding']
 
     if '.m3u' in filename or '.m3u8' in filename:
-        import m3uparser
+        from . import m3uparser
         return m3uparser.parse(file, encoding, trackObject, playlistObject)
     if '.pls' in filename:
-        import plsparser
+        from . import plsparser
         return plsparser.parse(file, encoding, trackObject, playlistObject)
     if '.xspf' in filename:
-        import xspfparser
         return xspfparser.parse(file, trackObject, playlistObject)
     if '.xml' in filename:
-        import xmlparser
         return xmlparser.parse(file, trackObject, playlistObject)
 
+def streamUrls(data, contentType=None, fileName=None, limit=None):
+    ''' only the stream urls of a playlist given as bytes (or str), at most limit of them. m3u/m3u8/pls
+        are read in one pass by fastparser, xspf/xml by the pull parsers, which stop at the limit. '''
+    kind = sniff(data, contentType, fileName)
+    if kind in ('.m3u', '.m3u8'):
+        return m3uUrls(data, limit)
+    if kind == '.pls':
+        return plsUrls(data, limit)
+    if kind == '.xspf':
+        tracks = xspfparser.iterTracks(data, Track)
+    elif kind == '.xml':
+        tracks = xmlparser.iterTracks(data, Track)
+    else:
+        return list()
+    urls = list()
+    for track in tracks:
+        if track.File:
+            urls.append(track.File)
+            if limit and len(urls) >= limit:
+                break
+    return urls
+
+
 if __name__ == '__main__':
     from sys import argv
     f = open(argv[1], 'r')
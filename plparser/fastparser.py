@@ -0,0 +1,153 @@
+''' Python Playlist Parser (plparser)
+    Copyright (C) 2012  Hugo Caille
+
+    Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+    1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+    2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer
+    in the documentation and/or other materials provided with the distribution.
+    3. The name of the author may not be used to endorse or promote products derived from this software without specific prior written permission.
+
+    THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+    OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+    SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+    PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+    OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+    '''
+
+# the format of a playlist sniffed from its first bytes, and single pass m3u/pls readers working on
+# the raw bytes that only decode the stream urls. nothing is kept between calls, so any number of
+# threads can use them at once.
+
+from xml.etree.ElementTree import XMLPullParser
+
+SNIFF_SIZE = 512
+# the xml playlists are fed to the pull parser in chunks, so a reader stopping early leaves the rest unparsed
+XML_CHUNK_SIZE = 16 * 1024
+# the m3u/pls lines are split in chunks, so a reader stopping early leaves the rest unsplit
+LINE_CHUNK_SIZE = 4 * 1024
+BOM = b'\xef\xbb\xbf'
+
+CONTENT_TYPES = {
+    'audio/x-mpegurl': '.m3u',
+    'audio/mpegurl': '.m3u',
+    'application/x-mpegurl': '.m3u',
+    'application/vnd.apple.mpegurl': '.m3u8',
+    'audio/x-scpls': '.pls',
+    'audio/scpls': '.pls',
+    'application/pls+xml': '.pls',
+    'application/xspf+xml': '.xspf',
+}
+EXTENSIONS = ('.m3u8', '.m3u', '.pls', '.xspf', '.xml')
+URL_SCHEMES = (b'http://', b'https://', b'mms://', b'mmsh://', b'rtsp://', b'rtmp://', b'icy://')
+
+
+def toBytes(data):
+    if isinstance(data, str):
+        return data.encode('utf-8', 'surrogateescape')
+    return data
+
+
+def hintType(contentType=None, fileName=None):
+    if contentType:
+        guess = CONTENT_TYPES.get(contentType.split(';')[0].strip().lower())
+        if guess:
+            return guess
+    if fileName:
+        path = fileName.split('?')[0].split('#')[0].lower()
+        for ext in EXTENSIONS:
+            if path.endswith(ext):
+                return ext
+    return None
+
+
+def sniff(data, contentType=None, fileName=None):
+    ''' .m3u, .m3u8, .pls, .xspf, .xml or None, from the first SNIFF_SIZE bytes of the playlist.
+        the Content-Type or the file name only decide when the bytes do not. '''
+    head = toBytes(data[:SNIFF_SIZE])
+    if head.startswith(BOM):
+        head = head[len(BOM):]
+    head = head.lstrip()
+    first = head[:16].lower()
+
+    if first.startswith(b'#extm3u') or first.startswith(b'#extinf') or first.startswith(URL_SCHEMES):
+        return '.m3u8' if hintType(contentType, fileName) == '.m3u8' else '.m3u'
+    if first.startswith(b'[playlist]'):
+        return '.pls'
+    hint = hintType(contentType, fileName)
+    if first.startswith(b'<'):
+        lower = head.lower()
+        if b'xspf.org/ns/' in lower or b'<playlist' in lower:
+            return '.xspf'
+        if b'<plist' in lower or b'<!doctype plist' in lower:
+            return '.xml'
+        return hint if hint in ('.xspf', '.xml') else None
+    return hint
+
+
+def decodeField(value):
+    try:
+        return value.decode('utf-8')
+    except UnicodeDecodeError:
+        return value.decode('latin-1')
+
+
+def localName(tag):
+    # '{http://xspf.org/ns/0/}track' -> 'track'
+    return tag.rpartition('}')[2]
+
+
+def iterElements(data, events=('start', 'end')):
+    ''' (event, element) of the xml document as the chunks of data are parsed '''
+    parser = XMLPullParser(events)
+    for offset in range(0, len(data), XML_CHUNK_SIZE):
+        parser.feed(data[offset:offset + XML_CHUNK_SIZE])
+        for item in parser.read_events():
+            yield item
+    parser.close()
+    for item in parser.read_events():
+        yield item
+
+
+def iterLines(data):
+    ''' the lines of data as data.splitlines() has them, split LINE_CHUNK_SIZE bytes at a time as the reader asks for them '''
+    start, size = 0, len(data)
+    while start < size:
+        # a chunk ends after a \n, so it never splits a \r\n
+        stop = data.rfind(b'\n', start, start + LINE_CHUNK_SIZE)
+        if stop < 0:
+            stop = data.find(b'\n', start + LINE_CHUNK_SIZE)
+        stop = size if stop < 0 else stop + 1
+        for line in data[start:stop].splitlines():
+            yield line
+        start = stop
+
+
+def m3uUrls(data, limit=None):
+    ''' the stream urls of a m3u/m3u8 playlist: every line that is neither empty nor a # directive '''
+    data = toBytes(data)
+    if data.startswith(BOM):
+        data = data[len(BOM):]
+    urls = list()
+    for line in iterLines(data):
+        line = line.strip()
+        if line and not line.startswith(b'#'):
+            urls.append(decodeField(line))
+            if limit and len(urls) >= limit:
+                break
+    return urls
+
+
+def plsUrls(data, limit=None):
+    ''' the stream urls of a pls playlist, the FileN entries in the order of N '''
+    data = toBytes(data)
+    files = dict()
+    for line in iterLines(data):
+        key, sep, value = line.partition(b'=')
+        if not sep:
+            continue
+        key = key.strip()
+        if key[:4].lower() == b'file' and key[4:].isdigit():
+            value = value.strip()
+            if value:
+                files[int(key[4:])] = value
+    return [decodeField(files[index]) for index in sorted(files)[:limit or None]]
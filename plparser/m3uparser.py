@@ -37,9 +37,12 @@ def parse(file, encoding, trackObject, playlistObject):
 
         if fileref != None:
             if info:
-                info = info.split(',')
-                length = int(info [0])
-                name = info[1]
+                length, _, name = info.partition(',')
+                try:
+                    length = int(length)
+                except ValueError:
+                    # #EXTINF:-1 tvg-id="..." group-title="...",name
+                    length = None
             else:
                 length = None
                 name = None
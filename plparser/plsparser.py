@@ -15,55 +15,37 @@
     '''
 
 Keys = ['File', 'Title', 'Length']
-genKeys = dict()
 
-def iniParse(data):
-    result = dict()
-    lines = data.split('\n')
-    for line in lines:
-        line = line.strip()
-        parts = line.split('=')
-        if len(parts) == 2:
-            result[parts[0]] = parts[1] # parts[1].replace('\r','')
-    return result
 
-def mkKeys(cursor):
-    global genKeys
-    cKeys = list()
-    for key in Keys:
-        cKeys.append(key + str(cursor))
-        genKeys[key + str(cursor)] = key
-    return cKeys
+def entryKey(key):
+    # 'File12' -> ('File', 12), None for the keys that do not belong to an entry
+    for name in Keys:
+        index = key[len(name):]
+        if key[:len(name)].lower() == name.lower() and index.isdigit():
+            return name, int(index)
+    return None
 
-def getKeyName(genKey):
-    global genKeys
-    return genKeys[genKey]
 
 def parse(data, encoding, trackObject, playlistObject):
     Track = trackObject
     Playlist = playlistObject
-    playlist = list()
-    data = iniParse(data)
+    # one pass over the lines, the entries are kept by their number until all are read
+    entries = dict()
+    for line in data.splitlines():
+        key, sep, value = line.partition('=')
+        if not sep:
+            continue
+        entry = entryKey(key.strip())
+        if entry:
+            entries.setdefault(entry[1], dict())[entry[0]] = value.strip()
 
-    finish = False
-    cursor = 1
-    while finish != True:
-        keys = mkKeys(cursor)
-        result = dict()
-        for key in keys:
-            try:
-                result[ getKeyName(key) ] = data[key]
-            except KeyError:
-                pass
-        if len(result) > 0:
-            try:
-                playlist.append( Track(Name=result.get('Title', None),
-                                       Duration=int(result.get('Length', 0)) or None,
-                                        File=result.get('File', None)))
-            except KeyError:
-                pass
-            cursor = cursor + 1
-        else:
-            finish = True
+    playlist = list()
+    for index in sorted(entries):
+        result = entries[index]
+        try:
+            duration = int(result.get('Length', 0)) or None
+        except ValueError:
+            duration = None
+        playlist.append( Track(Name=result.get('Title', None), Duration=duration, File=result.get('File', None)) )
 
     return Playlist(Tracks=playlist, Encoding = encoding)
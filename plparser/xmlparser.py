@@ -14,32 +14,52 @@
     OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
     '''
 
-from xml.dom import minidom
+from .fastparser import iterElements
 
-def parse(data, trackObject, playlistObject):
-    Track = trackObject
-    Playlist = playlistObject
-    dom = minidom.parseString(data)
-
-    tracks = dom.getElementsByTagName('dict')[0].getElementsByTagName('dict')[0].getElementsByTagName('dict')
-    playlist = list()
-
-    for track in tracks:
-        t = Track()
-        items = track.getElementsByTagName('key')
-        for item in items:
-            key = item.childNodes[0].nodeValue
-            value = item.nextSibling.childNodes[0].nodeValue
-            if key == 'Artist':
-                t.Artist = value
-            if key == 'Name':
-                t.Title = value
-            if key == 'Location':
-                t.File = value
-            if key == 'Total Time':
+def makeTrack(element, Track):
+    # <key>Name</key><string>...</string> pairs
+    t = Track()
+    items = list(element)
+    for item, valueItem in zip(items[::2], items[1::2]):
+        key = item.text
+        value = valueItem.text
+        if item.tag != 'key' or value == None:
+            continue
+        if key == 'Artist':
+            t.Artist = value
+        if key == 'Name':
+            t.Title = value
+        if key == 'Location':
+            t.File = value
+        if key == 'Total Time':
+            try:
                 t.Duration = int(value)
-            if key == 'Album':
-                t.Album = value
-            playlist.append(t)
+            except ValueError:
+                pass
+        if key == 'Album':
+            t.Album = value
+    return t
 
-    return Playlist(Tracks=playlist, Encoding='utf-8')
+def iterTracks(data, trackObject):
+    # plist > dict > the first dict in it, the tracks > one dict per track. each track is dropped
+    # from the tree once it is made, and the rest of the document is not read after the tracks.
+    parents = list()
+    tracksDict = None
+    for event, element in iterElements(data):
+        if event == 'start':
+            if tracksDict == None and element.tag == 'dict' and [p.tag for p in parents] == ['plist', 'dict']:
+                tracksDict = element
+            parents.append(element)
+            continue
+        parents.pop()
+        if element is tracksDict:
+            return
+        if parents and parents[-1] is tracksDict:
+            # the <key> of each track goes too
+            tracksDict.remove(element)
+            if element.tag == 'dict':
+                yield makeTrack(element, trackObject)
+
+def parse(data, trackObject, playlistObject):
+    Playlist = playlistObject
+    return Playlist(Tracks=list(iterTracks(data, trackObject)), Encoding='utf-8')
@@ -14,33 +14,44 @@
     OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
     '''
 
-from xml.dom import minidom
+from .fastparser import iterElements, localName
 
-playlist = list()
+def makeTrack(element, Track):
+    t = Track()
+    for item in element:
+        key = localName(item.tag)
+        value = item.text
+        if not value:
+            continue
+        value = value.strip()
+        if key == "creator":
+            t.Artist = value
+        if key == "title":
+            t.Title = value
+        if key == "location" and t.File == None:
+            t.File = value
+        if key == "duration":
+            try:
+                t.Duration = int(value)
+            except ValueError:
+                pass
+        if key == "album":
+            t.Album = value
+    return t
+
+def iterTracks(data, trackObject):
+    # the tracks as their </track> is read, each one is dropped from the tree once it is made
+    parents = list()
+    for event, element in iterElements(data):
+        if event == 'start':
+            parents.append(element)
+            continue
+        parents.pop()
+        if localName(element.tag) == 'track' and parents and localName(parents[-1].tag) == 'trackList':
+            track = makeTrack(element, trackObject)
+            parents[-1].remove(element)
+            yield track
 
 def parse(data, trackObject, playlistObject):
-    Track = trackObject
     Playlist = playlistObject
-    dom = minidom.parseString(data)
-
-    tracks = dom.getElementsByTagName('trackList')[0].getElementsByTagName('track')
-    for track in tracks:
-        t = Track()
-        for item in track.childNodes:
-            key = item.nodeName
-            try:
-                value = item.childNodes[0].nodeValue
-                if key == "creator":
-                    t.Artist = value
-                if key == "title":
-                    t.Title = value
-                if key == "location":
-                    t.File = value
-                if key == "duration":
-                    t.Duration = int(value)
-                if key == "album":
-                    t.Album = value
-                playlist.append(t)
-            except:
-                pass
-    return Playlist(Tracks=playlist, Encoding='utf-8')
+    return Playlist(Tracks=list(iterTracks(data, trackObject)), Encoding='utf-8')
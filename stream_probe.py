@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: abekthink
+
+import asyncio
+import sys
+import threading
+import requests
+import metrics
+
+import urllib.parse as urlparse
+
+from dns_cache import open_connection
+from async_http import get_ssl_context, read_status_and_headers, REDIRECT_CODES
+from util import rate_limiter, fix_url, request_headers, read_response, observe_request, url_net_loc, Timer, \
+    http_log, throttle_log
+
+
+class ProbeResponse(object):
+    def __init__(self, url, status_code, reason, headers):
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = None
+
+
+class StreamProbe(object):
+    """
+    lightweight stream url checker built directly on asyncio streams.
+    it sends a minimal GET with 'Icy-MetaData: 1', parses the status line and the icy-* headers
+    itself (shoutcast's 'ICY 200 OK' included) and closes the connection right after the headers.
+    probe() returns the same json string as util.parse_stream_url_data, probe_blocking() runs it
+    for a thread on the shared probe loop. only the stream resolver asks for playlist_types.
+    """
+
+    def __init__(self, **kwargs):
+        self.rate_limiter = kwargs.get('rate_limiter', rate_limiter)
+        self.connect_timeout = kwargs.get('connect_timeout', 5)
+        self.read_timeout = kwargs.get('read_timeout', 8)
+        self.max_redirects = kwargs.get('max_redirects', 5)
+        self.controller = kwargs.get('controller')
+        self.dns_cache = kwargs.get('dns_cache')
+
+    async def probe(self, url, throttle=True, playlist_types=False):
+        if url.startswith("mms"):
+            http_log.error("PROBE URL is invalid", url=url)
+            return None
+        url = fix_url(url)
+
+        if throttle:
+            delay = self.rate_limiter.reserve(url)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                metrics.observe_throttle(url_net_loc(url), delay)
+                throttle_log.info("PROBE URL throttle", delay=round(delay, 3), url=url)
+
+        res = None
+        timer = Timer()
+        timer.start()
+        try:
+            res = await self.fetch_headers(url)
+        except requests.exceptions.InvalidURL:
+            error_tag = 'InvalidURL'
+        except requests.Timeout:
+            error_tag = 'Timeout'
+        except requests.ConnectionError:
+            error_tag = 'ConnectionError'
+        except requests.TooManyRedirects:
+            error_tag = 'TooManyRedirects'
+        except asyncio.CancelledError:
+            raise
+        except:
+            http_log.exception("PROBE URL failed", url=url)
+            error_tag = 'OtherError'
+
+        observe_request(self.controller, url, 'stream', timer.stop(), res, error_tag if res is None else None)
+        if res is None:
+            http_log.error("PROBE URL connect", url=url, error_tag=error_tag)
+            return None
+        return read_response(res, url, stream=True, playlist_types=playlist_types)
+
+    def probe_blocking(self, url, throttle=True, playlist_types=False):
+        return get_probe_loop().submit(self.probe(url, throttle, playlist_types)).result()
+
+    async def probe_many(self, urls, concurrency=1000):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def probe_one(url):
+            async with semaphore:
+                return await self.probe(url)
+
+        return await asyncio.gather(*[probe_one(url) for url in urls])
+
+    async def fetch_headers(self, url):
+        for _ in range(self.max_redirects + 1):
+            res = await self.send(url)
+            location = res.headers.get('location')
+            if res.status_code not in REDIRECT_CODES or not location:
+                return res
+            url = urlparse.urljoin(url, location)
+        raise requests.TooManyRedirects('Exceeded %d redirects. url = %s' % (self.max_redirects, url))
+
+    async def send(self, url):
+        r = urlparse.urlsplit(url)
+        try:
+            port = r.port
+        except ValueError:
+            raise requests.exceptions.InvalidURL('Invalid port. url = %s' % url)
+        if r.scheme not in ('http', 'https') or not r.hostname:
+            raise requests.exceptions.InvalidURL('Invalid URL. url = %s' % url)
+        use_ssl = r.scheme == 'https'
+        port = port or (443 if use_ssl else 80)
+
+        try:
+            reader, writer = await asyncio.wait_for(
+                open_connection(r.hostname, port, ssl=get_ssl_context() if use_ssl else None,
+                                dns_cache=self.dns_cache),
+                self.connect_timeout)
+        except asyncio.TimeoutError:
+            raise requests.ConnectTimeout('Connect timed out. url = %s' % url)
+        except OSError as e:
+            raise requests.ConnectionError('%s. url = %s' % (e, url))
+
+        target = urlparse.urlunsplit(('', '', r.path or '/', r.query, ''))
+        lines = ['GET %s HTTP/1.1' % target, 'Host: %s' % r.netloc,
+                 'User-Agent: %s' % request_headers(stream=True)['User-Agent'],
+                 'Accept: */*', 'Icy-MetaData: 1', 'Connection: close']
+        try:
+            writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+            await writer.drain()
+            _, status_code, reason, headers = await read_status_and_headers(reader, url, self.read_timeout)
+        except OSError as e:
+            raise requests.ConnectionError('%s. url = %s' % (e, url))
+        finally:
+            # only the headers are needed, never wait for the audio data.
+            writer.close()
+        return ProbeResponse(url, status_code, reason, headers)
+
+
+class ProbeLoop(object):
+    # an event loop in its own thread, the threads of the thread engine wait on their probes there
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run, name="stream-probe-loop")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+probe_loop = None
+probe_loop_mutex = threading.Lock()
+
+
+def get_probe_loop():
+    # started by the first blocking probe
+    global probe_loop
+    with probe_loop_mutex:
+        if probe_loop is None:
+            probe_loop = ProbeLoop()
+        return probe_loop
+
+
+def close_probe_loop():
+    global probe_loop
+    with probe_loop_mutex:
+        loop, probe_loop = probe_loop, None
+    if loop:
+        loop.close()
+
+
+if __name__ == "__main__":
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    results = loop.run_until_complete(StreamProbe().probe_many(sys.argv[1:]))
+    for stream_url, result in zip(sys.argv[1:], results):
+        print("%s %s" % (stream_url, result))
+    loop.close()
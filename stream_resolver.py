@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author: abekthink
+
+import asyncio
+import json
+import log
+
+from collections import deque
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
+
+from util import classify_url, fix_url, is_playlist_content_type
+
+DEFAULT_MAX_DEPTH = 3
+DEFAULT_FAN_OUT = 4
+
+RESOLVED_PLAYLIST = 'playlist'
+RESOLVED_STREAM = 'stream'
+
+resolver_log = log.get_logger("resolver")
+
+
+def is_playlist_url(url):
+    return classify_url(url) == 'playlist'
+
+
+def is_playlist_probe(res):
+    # the probe of a url not looking like a playlist answered with a playlist, or with text that may be one.
+    # only the resolver takes these content types from a probe, see util.parse_stream_url_data
+    if not res:
+        return False
+    content_type = json.loads(res).get('icy-ct') or ''
+    return is_playlist_content_type(content_type) or content_type.startswith('text/plain')
+
+
+class Resolution(object):
+    """
+    the state of resolving the source url of one station. the urls to resolve are kept with their
+    position in the playlists, (2, 0) is the first entry of the playlist third in the source playlist,
+    so the streams come out in playlist order whatever order their probes answered in.
+    """
+
+    def __init__(self, url, max_depth=DEFAULT_MAX_DEPTH, max_streams=0):
+        self.max_depth = max_depth
+        self.max_streams = max_streams
+        self.todo = deque([((), url, 0)])
+        # every url is resolved once, which also breaks playlists linking to each other
+        self.seen = {fix_url(url)}
+        self.streams = []
+
+    def next_task(self):
+        return self.todo.popleft()
+
+    def enough(self):
+        return self.max_streams and len(self.streams) >= self.max_streams
+
+    def expand(self, depth):
+        # whether a playlist found at this depth is fetched
+        return depth < self.max_depth
+
+    def add(self, task, kind, value):
+        position, url, depth = task
+        if kind == RESOLVED_STREAM:
+            # probes answering together past max_streams are dropped
+            if value and not self.enough():
+                self.streams.append((position, url, value))
+            return
+        if not value:
+            resolver_log.error("the playlist has no stream urls", url=url, depth=depth)
+            return
+        for i, child in enumerate(value):
+            key = fix_url(child)
+            if key in self.seen:
+                resolver_log.debug("the url is resolved already", url=child, playlist=url)
+                continue
+            self.seen.add(key)
+            self.todo.append((position + (i,), child, depth + 1))
+
+    def results(self):
+        # [(stream url, probe json)]
+        return [(url, value) for _, url, value in sorted(self.streams, key=lambda x: x[0])]
+
+
+class StreamResolver(object):
+    """
+    resolves the source url of a station to its live streams. a url is a playlist by its path, by
+    the content type its probe answers with or, for text, by its first bytes. nested playlists are
+    followed max_depth levels deep. the urls of a station are resolved fan_out at a time on a pool
+    of threads, and with max_streams the rest is dropped once that many streams answered.
+    fetch_playlist(url) returns the stream urls of a playlist, probe(url) the json of a stream, or of
+    a playlist or text/plain content type (util.parse_stream_url_data with playlist_types).
+    """
+
+    def __init__(self, fetch_playlist, probe, max_depth=DEFAULT_MAX_DEPTH, fan_out=DEFAULT_FAN_OUT, max_streams=0):
+        self.fetch_playlist = fetch_playlist
+        self.probe = probe
+        self.max_depth = max_depth
+        self.fan_out = max(1, fan_out)
+        self.max_streams = max_streams
+        self.executor = ThreadPoolExecutor(max_workers=self.fan_out)
+
+    def resolve_url(self, url, expand):
+        # (RESOLVED_PLAYLIST, stream urls) or (RESOLVED_STREAM, probe json)
+        try:
+            if not is_playlist_url(url):
+                res = self.probe(url)
+                if not is_playlist_probe(res):
+                    return RESOLVED_STREAM, res
+            if not expand:
+                resolver_log.warning("the playlist is nested too deep", url=url)
+                return RESOLVED_STREAM, None
+            return RESOLVED_PLAYLIST, self.fetch_playlist(url)
+        except Exception:
+            resolver_log.exception("can not resolve the url", url=url)
+            return RESOLVED_STREAM, None
+
+    def resolve(self, url):
+        resolution = Resolution(url, self.max_depth, self.max_streams)
+        pending = {}
+        try:
+            while True:
+                while resolution.todo and len(pending) < self.fan_out:
+                    task = resolution.next_task()
+                    pending[self.executor.submit(self.resolve_url, task[1], resolution.expand(task[2]))] = task
+                if not pending:
+                    break
+                done, _ = futures.wait(list(pending), return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    resolution.add(pending.pop(future), *future.result())
+                if resolution.enough():
+                    break
+        finally:
+            # the probes already running finish on their own
+            for future in pending:
+                future.cancel()
+        return resolution.results()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+class AsyncStreamResolver(object):
+    """
+    the same on the event loop, fetch_playlist and probe are coroutine functions.
+    the probes still running are cancelled once max_streams answered.
+    """
+
+    def __init__(self, fetch_playlist, probe, max_depth=DEFAULT_MAX_DEPTH, fan_out=DEFAULT_FAN_OUT, max_streams=0):
+        self.fetch_playlist = fetch_playlist
+        self.probe = probe
+        self.max_depth = max_depth
+        self.fan_out = max(1, fan_out)
+        self.max_streams = max_streams
+
+    async def resolve_url(self, url, expand):
+        try:
+            if not is_playlist_url(url):
+                res = await self.probe(url)
+                if not is_playlist_probe(res):
+                    return RESOLVED_STREAM, res
+            if not expand:
+                resolver_log.warning("the playlist is nested too deep", url=url)
+                return RESOLVED_STREAM, None
+            return RESOLVED_PLAYLIST, await self.fetch_playlist(url)
+        except Exception:
+            resolver_log.exception("can not resolve the url", url=url)
+            return RESOLVED_STREAM, None
+
+    async def resolve(self, url):
+        resolution = Resolution(url, self.max_depth, self.max_streams)
+        pending = {}
+        try:
+            while True:
+                while resolution.todo and len(pending) < self.fan_out:
+                    task = resolution.next_task()
+                    pending[asyncio.ensure_future(self.resolve_url(task[1], resolution.expand(task[2])))] = task
+                if not pending:
+                    break
+                done, _ = await asyncio.wait(list(pending), return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    resolution.add(pending.pop(future), *future.result())
+                if resolution.enough():
+                    break
+        finally:
+            for future in pending:
+                future.cancel()
+            if pending:
+                # wait for the cancelled probes to unwind, so their connections are closed here
+                await asyncio.gather(*pending, return_exceptions=True)
+        return resolution.results()
+
+    def close(self):
+        pass
@@ -2,21 +2,36 @@
 # -*- coding: utf-8 -*-
 # author: abekthink
 
+import asyncio
+import codecs
 import hashlib
 import json
+import multiprocessing
 import os
+import sys
 import time
-import traceback
 import threading
 import requests
+import log
+import metrics
 import plparser
 
 import urllib.parse as urlparse
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+from dns_cache import DnsCacheAdapter, get_dns_cache
+from output_file import OutputFile, truncate_partial_line
 
 # crawl radio guide
 RADIO_GUIDE_SOURCE_FILE = "radio_guide_source.json"
 RADIO_GUIDE_OUTPUT_FILE = "radio_guide.json"
 
+http_log = log.get_logger("http")
+# once per delayed request, sampled
+throttle_log = log.get_logger("throttle")
+journal_log = log.get_logger("journal")
+
 
 class Timer(object):
     def __init__(self):
@@ -30,25 +45,98 @@ class Timer(object):
         return self._stop_ts - self._start_ts
 
 
-class SessionThrottle(object):
-    def __init__(self, requests_per_second=None):
+class TokenBucket(object):
+    """
+    token bucket refilled at requests_per_second up to burst tokens.
+    the bucket may go into debt: every reservation books the next free slot, so waiting
+    callers are served in the order they arrived, like a fair wait queue.
+    """
+
+    def __init__(self, requests_per_second, burst=1):
         self.requests_per_second = requests_per_second
-        self.total_requests = 0
-        self.start_time = time.time()
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.last_time = time.monotonic()
+        self.mutex = threading.Lock()
 
-    def set_requests_per_second(self, requests_per_second):
+    def set_rate(self, requests_per_second, burst=None):
+        with self.mutex:
+            self.requests_per_second = requests_per_second
+            if burst is not None:
+                self.burst = max(burst, 1)
+                self.tokens = min(self.tokens, self.burst)
+
+    def reserve(self):
+        # take one token and return how long the caller has to wait for it
+        with self.mutex:
+            if not self.requests_per_second:
+                return 0
+            now_time = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now_time - self.last_time) * self.requests_per_second)
+            self.last_time = now_time
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.requests_per_second
+
+
+class RateLimiter(object):
+    """
+    process-wide limiter keyed by netloc, every host gets its own token bucket
+    no matter how many clients or workers send requests to it.
+    """
+
+    def __init__(self, requests_per_second=0, burst=1):
         self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.host_limits = {}
+        self.buckets = {}
+        self.mutex = threading.Lock()
 
-    def run(self):
-        if self.requests_per_second:
-            now_time = time.time()
-            total_seconds = self.total_requests / self.requests_per_second
-            self.total_requests += 1
-            delay = total_seconds - (now_time - self.start_time)
-            if delay > 0.1:
-                time.sleep(delay)
-                return delay
-        return 0
+    def set_rate(self, requests_per_second, burst=None, host=None):
+        with self.mutex:
+            if host:
+                limit = (requests_per_second, self.burst if burst is None else burst)
+                self.host_limits[host] = limit
+                if host in self.buckets:
+                    self.buckets[host].set_rate(*limit)
+                return
+
+            self.requests_per_second = requests_per_second
+            if burst is not None:
+                self.burst = burst
+            for netloc, bucket in self.buckets.items():
+                if netloc not in self.host_limits:
+                    bucket.set_rate(self.requests_per_second, self.burst)
+
+    def get_bucket(self, netloc):
+        with self.mutex:
+            bucket = self.buckets.get(netloc)
+            if bucket is None:
+                requests_per_second, burst = self.host_limits.get(netloc, (self.requests_per_second, self.burst))
+                bucket = TokenBucket(requests_per_second, burst)
+                self.buckets[netloc] = bucket
+            return bucket
+
+    def reserve(self, url):
+        return self.get_bucket(url_net_loc(url)).reserve()
+
+    def run(self, url):
+        delay = self.reserve(url)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+
+rate_limiter = RateLimiter()
+
+
+def configure_rate_limiter(requests_per_second=None, burst=None, host_limits=None):
+    if requests_per_second is not None or burst is not None:
+        rate_limiter.set_rate(rate_limiter.requests_per_second if requests_per_second is None else requests_per_second,
+                              burst=burst)
+    for host, (host_requests_per_second, host_burst) in (host_limits or {}).items():
+        rate_limiter.set_rate(host_requests_per_second, burst=host_burst, host=host)
 
 
 def url_net_loc(url):
@@ -61,48 +149,653 @@ def is_url_localhost(url):
     return loc == 'localhost'
 
 
+def url_pool_key(url):
+    r = urlparse.urlsplit(url)
+    return '%s://%s' % (r.scheme, r.netloc)
+
+
+class ConnectionPool(object):
+    """
+    per host pool of idle keep-alive connections, shared by every client of the process.
+    a connection is anything with a close() method, e.g. a requests.Session.
+    """
+
+    def __init__(self, pool_size=10, idle_timeout=60):
+        # pool_size is the number of idle connections kept for each host
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.idle = {}
+        self.mutex = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.last_sweep_time = time.time()
+
+    def acquire(self, key):
+        # return a warm connection for the host, or None if the caller has to open a new one
+        expired = []
+        with self.mutex:
+            now_time = time.time()
+            if now_time - self.last_sweep_time > self.idle_timeout:
+                self.last_sweep_time = now_time
+                for k in list(self.idle.keys()):
+                    expired.extend(self._evict(k, now_time))
+            else:
+                expired.extend(self._evict(key, now_time))
+
+            conn = None
+            entries = self.idle.get(key)
+            if entries:
+                # the most recently released connection is the least likely to be closed by the server
+                conn = entries.pop()[0]
+                self.hits += 1
+            else:
+                self.misses += 1
+        for c in expired:
+            close_quietly(c)
+        return conn
+
+    def release(self, key, conn):
+        with self.mutex:
+            entries = self.idle.setdefault(key, deque())
+            if len(entries) < self.pool_size:
+                entries.append((conn, time.time()))
+                return
+        close_quietly(conn)
+
+    def _evict(self, key, now_time):
+        expired = []
+        entries = self.idle.get(key)
+        while entries and now_time - entries[0][1] > self.idle_timeout:
+            expired.append(entries.popleft()[0])
+        if entries is not None and not entries:
+            del self.idle[key]
+        self.evictions += len(expired)
+        return expired
+
+    def stats(self):
+        with self.mutex:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'idle': sum(len(entries) for entries in self.idle.values())
+            }
+
+    def close(self):
+        with self.mutex:
+            entries = [conn for host_entries in self.idle.values() for conn, _ in host_entries]
+            self.idle = {}
+        for conn in entries:
+            close_quietly(conn)
+
+
+def close_quietly(conn):
+    try:
+        conn.close()
+    except:
+        pass
+
+
+connection_pool = ConnectionPool()
+
+
+def configure_connection_pool(pool_size=None, idle_timeout=None):
+    if pool_size is not None:
+        connection_pool.pool_size = pool_size
+    if idle_timeout is not None:
+        connection_pool.idle_timeout = idle_timeout
+
+
+# seconds a cached body is served without asking the server, after that it is revalidated
+# with If-None-Match/If-Modified-Since and a 304 keeps serving the cached body.
+DEFAULT_CACHE_TTLS = {
+    'genre': 24 * 3600,
+    'station': 24 * 3600,
+    'iframe': 24 * 3600,
+    'playlist': 3600,
+    'default': 0
+}
+
+PLAYLIST_EXTS = ('.m3u', '.m3u8', '.pls', '.xspf', '.xml')
+
+
+def is_playlist_content_type(content_type):
+    return plparser.fastparser.hintType(contentType=content_type) is not None
+
+
+def classify_url(url):
+    path = urlparse.urlsplit(url).path
+    if path.endswith(PLAYLIST_EXTS):
+        return 'playlist'
+    return 'default'
+
+
+class CachedResponse(object):
+    def __init__(self, url, content, status_code=200, headers=None):
+        self.url = url
+        self.content = content
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class HttpCache(object):
+    """
+    on-disk response cache, keyed by get_sha1_key(url).
+    <key>.json keeps the validators and <key>.body the response body,
+    the least recently used entries are evicted once max_size bytes are exceeded.
+    """
+
+    def __init__(self, cache_dir, max_size=1024 * 1024 * 1024, ttls=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.ttls = dict(DEFAULT_CACHE_TTLS, **(ttls or {}))
+        self.mutex = threading.Lock()
+        self.index = {}
+        self.total_size = 0
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.load_index()
+
+    def load_index(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith('.body'):
+                    continue
+                st = os.stat(os.path.join(root, name))
+                self.index[name[:-len('.body')]] = [st.st_size, st.st_mtime]
+                self.total_size += st.st_size
+
+    def get_path(self, key, ext):
+        return os.path.join(self.cache_dir, key[:2], key + ext)
+
+    def lookup(self, url):
+        key = get_sha1_key(url)
+        if key not in self.index:
+            return None
+        try:
+            with open(self.get_path(key, '.json')) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        entry['key'] = key
+        return entry
+
+    def ttl(self, cache_class):
+        return self.ttls.get(cache_class, self.ttls['default'])
+
+    def read_body(self, entry):
+        try:
+            with open(self.get_path(entry['key'], '.body'), 'rb') as f:
+                body = f.read()
+        except IOError:
+            return None
+        with self.mutex:
+            if entry['key'] in self.index:
+                self.index[entry['key']][1] = time.time()
+        return body
+
+    def fresh_response(self, entry, cache_class):
+        if time.time() - entry['stored_at'] >= self.ttl(cache_class):
+            return None
+        body = self.read_body(entry)
+        if body is None:
+            return None
+        self.hits += 1
+        return CachedResponse(entry['url'], body)
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        return headers
+
+    def update(self, url, cache_class, entry, res):
+        # serve the cached body on 304, store the new body on 200
+        if res.status_code == 304 and entry:
+            body = self.read_body(entry)
+            if body is not None:
+                self.revalidated += 1
+                entry['stored_at'] = time.time()
+                self.write_file(self.get_path(entry['key'], '.json'), json.dumps(entry).encode('utf-8'))
+                return CachedResponse(res.url, body, status_code=304, headers=res.headers)
+        if res.status_code == 200:
+            self.misses += 1
+            if 'no-store' not in res.headers.get('Cache-Control', ''):
+                self.store(url, cache_class, res.headers, res.content)
+        return res
+
+    def store(self, url, cache_class, headers, body):
+        if body is None:
+            return
+        key = get_sha1_key(url)
+        entry = {
+            'url': url,
+            'url_class': cache_class,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'stored_at': time.time(),
+            'size': len(body)
+        }
+        try:
+            os.makedirs(os.path.dirname(self.get_path(key, '.body')), exist_ok=True)
+            self.write_file(self.get_path(key, '.body'), body)
+            self.write_file(self.get_path(key, '.json'), json.dumps(entry).encode('utf-8'))
+        except (IOError, OSError):
+            http_log.exception("can not store the response in the http cache", url=url)
+            return
+
+        with self.mutex:
+            old = self.index.get(key)
+            if old:
+                self.total_size -= old[0]
+            self.index[key] = [len(body), time.time()]
+            self.total_size += len(body)
+            evicted = self.pick_evictions()
+        for key in evicted:
+            self.remove(key)
+
+    def pick_evictions(self):
+        # evict down to 90% of max_size so a full cache does not evict on every store
+        if self.total_size <= self.max_size:
+            return []
+        evicted = []
+        for key, (size, _) in sorted(self.index.items(), key=lambda x: x[1][1]):
+            if self.total_size <= self.max_size * 0.9:
+                break
+            del self.index[key]
+            self.total_size -= size
+            evicted.append(key)
+        return evicted
+
+    def remove(self, key):
+        for ext in ('.body', '.json'):
+            try:
+                os.remove(self.get_path(key, ext))
+            except OSError:
+                pass
+
+    def write_file(self, path, data):
+        tmp_path = '%s.%d.tmp' % (path, threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'revalidated': self.revalidated,
+            'misses': self.misses,
+            'entries': len(self.index),
+            'size': self.total_size
+        }
+
+
+http_cache = None
+
+
+def lookup_http_cache(cache, url, method, stream, cache_class):
+    # only plain GETs are cached, stream probes are never stored.
+    cache = cache or http_cache
+    if not cache or method != 'GET' or stream or url.startswith("mms"):
+        return None, None, None
+    url = fix_url(url)
+    return cache, cache.lookup(url), cache_class or classify_url(url)
+
+
+def configure_http_cache(cache_dir, max_size=None, ttls=None):
+    global http_cache
+    if not cache_dir:
+        http_cache = None
+        return
+    kwargs = {'ttls': ttls}
+    if max_size:
+        kwargs['max_size'] = max_size
+    http_cache = HttpCache(cache_dir, **kwargs)
+
+
+# what a station resolves to, shared by all the stations: the stream urls of a playlist and the
+# probe result of a stream url. kept per run, the empty results only for a short while.
+RESOLUTION_PLAYLIST = 'playlist'
+RESOLUTION_STREAM = 'stream'
+RESOLUTION_KINDS = [RESOLUTION_PLAYLIST, RESOLUTION_STREAM]
+
+
+class ResolutionFlight(object):
+    # one load in progress, the lookups of the same key coming meanwhile wait for its result
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResolutionCache(object):
+    """
+    in-memory LRU cache with a ttl in front of the playlist fetches and the stream probes.
+    concurrent lookups of a key missing from the cache are coalesced into one load, which the
+    threads wait for on an event and the coroutines on a future. with a cache_file the entries
+    not expired yet are loaded at start and saved by close().
+    """
+
+    def __init__(self, max_entries=100000, ttl=3600, error_ttl=300, cache_file=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.cache_file = cache_file
+        self.mutex = threading.Lock()
+        # (kind, key) -> [value, expires_at], the least recently used first
+        self.entries = OrderedDict()
+        self.flights = {}
+        self.async_flights = {}
+        self.counts = dict((kind, {'hits': 0, 'coalesced': 0, 'misses': 0, 'expired': 0, 'evictions': 0})
+                           for kind in RESOLUTION_KINDS)
+        if cache_file:
+            self.load()
+
+    def lookup(self, kind, key):
+        # (True, value) for a fresh entry, called with the mutex held
+        entry = self.entries.get((kind, key))
+        if entry is None:
+            return False, None
+        if entry[1] <= time.time():
+            del self.entries[(kind, key)]
+            self.count(kind, 'expired')
+            return False, None
+        self.entries.move_to_end((kind, key))
+        return True, entry[0]
+
+    def store(self, kind, key, value):
+        with self.mutex:
+            self.put(kind, key, value, time.time() + (self.ttl if value else self.error_ttl))
+
+    def put(self, kind, key, value, expires_at):
+        self.entries[(kind, key)] = [value, expires_at]
+        self.entries.move_to_end((kind, key))
+        while len(self.entries) > self.max_entries:
+            (evicted_kind, _), _ = self.entries.popitem(last=False)
+            self.count(evicted_kind, 'evictions')
+
+    def count(self, kind, result):
+        self.counts[kind][result] += 1
+        if result in ('hits', 'coalesced', 'misses'):
+            metrics.observe_resolution(kind, result)
+
+    def get(self, kind, key, loader):
+        # the cached value, or loader() once for all the threads asking for the key at the same time
+        with self.mutex:
+            found, value = self.lookup(kind, key)
+            if found:
+                self.count(kind, 'hits')
+                return value
+            flight = self.flights.get((kind, key))
+            leader = flight is None
+            if leader:
+                flight = self.flights[(kind, key)] = ResolutionFlight()
+            self.count(kind, 'misses' if leader else 'coalesced')
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = loader()
+            self.store(kind, key, flight.value)
+            return flight.value
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.mutex:
+                self.flights.pop((kind, key), None)
+            flight.event.set()
+
+    async def get_async(self, kind, key, loader):
+        # the same for coroutines, loader is a coroutine function
+        while True:
+            with self.mutex:
+                found, value = self.lookup(kind, key)
+                if found:
+                    self.count(kind, 'hits')
+                    return value
+                future = self.async_flights.get((kind, key))
+                leader = future is None
+                if leader:
+                    future = self.async_flights[(kind, key)] = asyncio.get_event_loop().create_future()
+                self.count(kind, 'misses' if leader else 'coalesced')
+            if leader:
+                break
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # the loading coroutine was cancelled, not this one: try again
+                if not future.cancelled():
+                    raise
+
+        try:
+            value = await loader()
+            self.store(kind, key, value)
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # nobody may be waiting, reading the exception keeps asyncio from warning about it
+            future.exception()
+            raise
+        finally:
+            with self.mutex:
+                self.async_flights.pop((kind, key), None)
+
+    def stats(self):
+        with self.mutex:
+            stats = dict((kind, dict(counts, entries=0)) for kind, counts in self.counts.items())
+            for kind, _ in self.entries:
+                stats[kind]['entries'] += 1
+        for counts in stats.values():
+            # a coalesced lookup did not load anything either
+            lookups = counts['hits'] + counts['coalesced'] + counts['misses']
+            counts['hit_rate'] = (counts['hits'] + counts['coalesced']) / float(lookups) if lookups else 0.0
+        return stats
+
+    def load(self):
+        try:
+            with open(self.cache_file) as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            return
+        now_time = time.time()
+        with self.mutex:
+            for kind, key, value, expires_at in entries:
+                if kind in self.counts and expires_at > now_time:
+                    self.put(kind, key, value, expires_at)
+        http_log.info("resolution cache loaded %d entries", len(self.entries), file=self.cache_file)
+
+    def save(self):
+        with self.mutex:
+            entries = [[kind, key, value, expires_at] for (kind, key), (value, expires_at) in self.entries.items()]
+        tmp_path = '%s.%d.tmp' % (self.cache_file, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.cache_file)
+        except (IOError, OSError):
+            http_log.exception("can not save the resolution cache", file=self.cache_file)
+
+    def close(self):
+        if self.cache_file:
+            self.save()
+
+
+resolution_cache = None
+
+
+def configure_resolution_cache(max_entries, ttl=None, error_ttl=None, cache_file=None):
+    # 0 entries resolves every station on its own
+    global resolution_cache
+    close_resolution_cache()
+    if not max_entries:
+        return None
+    kwargs = {'max_entries': max_entries, 'cache_file': cache_file}
+    if ttl is not None:
+        kwargs['ttl'] = ttl
+    if error_ttl is not None:
+        kwargs['error_ttl'] = error_ttl
+    resolution_cache = ResolutionCache(**kwargs)
+    return resolution_cache
+
+
+def close_resolution_cache():
+    global resolution_cache
+    cache, resolution_cache = resolution_cache, None
+    if cache:
+        cache.close()
+    return cache
+
+
+def resolve_cached(kind, key, loader):
+    cache = resolution_cache
+    return cache.get(kind, key, loader) if cache else loader()
+
+
+async def resolve_cached_async(kind, key, loader):
+    cache = resolution_cache
+    return await cache.get_async(kind, key, loader) if cache else await loader()
+
+
+class ExtractionPool(object):
+    """
+    worker processes for the cpu-bound parsing of fetched pages and playlists, so it is not
+    serialized by the GIL of the fetching threads or stalls the event loop. the functions
+    and their arguments are pickled, so they have to be module level functions.
+    """
+
+    def __init__(self, processes=None):
+        self.processes = processes or os.cpu_count() or 1
+        kwargs = {'max_workers': self.processes}
+        if sys.version_info >= (3, 7) and 'forkserver' in multiprocessing.get_all_start_methods():
+            # the workers are forked from a clean server process, not from the crawler and its threads
+            kwargs['mp_context'] = multiprocessing.get_context('forkserver')
+        self.executor = ProcessPoolExecutor(**kwargs)
+        self.mutex = threading.Lock()
+        self.tasks = 0
+        self.wait_time = 0.0
+
+    def run(self, fn, *args):
+        begin = time.time()
+        try:
+            return self.executor.submit(fn, *args).result()
+        finally:
+            self.count(time.time() - begin)
+
+    async def run_async(self, fn, *args):
+        begin = time.time()
+        try:
+            return await asyncio.wrap_future(self.executor.submit(fn, *args))
+        finally:
+            self.count(time.time() - begin)
+
+    def count(self, wait_time):
+        with self.mutex:
+            self.tasks += 1
+            self.wait_time += wait_time
+
+    def stats(self):
+        with self.mutex:
+            return {'processes': self.processes, 'tasks': self.tasks, 'wait_time': self.wait_time}
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+extraction_pool = None
+
+
+def configure_extraction_pool(processes):
+    # 0 parses in the fetching workers themselves
+    global extraction_pool
+    if extraction_pool:
+        extraction_pool.close()
+    extraction_pool = ExtractionPool(processes) if processes else None
+    return extraction_pool
+
+
+def close_extraction_pool():
+    global extraction_pool
+    pool, extraction_pool = extraction_pool, None
+    if pool:
+        pool.close()
+    return pool
+
+
 class HttpClient(object):
     def __init__(self, **kwargs):
-        self.session_throttle = SessionThrottle(kwargs.get('requests_per_second', 0))
+        self.rate_limiter = kwargs.get('rate_limiter', rate_limiter)
         self.http_timeout = kwargs.get('http_timeout', 10)
+        self.connection_pool = kwargs.get('connection_pool', connection_pool)
+        self.http_cache = kwargs.get('http_cache')
+        # a dns_cache.DnsCache, the shared one by default
+        self.dns_cache = kwargs.get('dns_cache')
+        # the asynclib.ConcurrencyController of the stage, told the latency and outcome of every request
+        self.controller = kwargs.get('controller')
 
     def set_requests_per_second(self, requests_per_second):
-        self.session_throttle.set_requests_per_second(requests_per_second)
+        # the limiter is shared, so this changes the default rate of every host for all clients
+        self.rate_limiter.set_rate(requests_per_second)
 
     def set_http_timeout(self, http_timeout):
         self.http_timeout = http_timeout
 
     def get_url(self, url, proxy=False, method='GET', data=None, max_size=None, http_timeout=None,
-                stream=False, throttle=True, ensure_utf8=True):
-        print('GET URL works url = %s' % url)
+                stream=False, throttle=True, ensure_utf8=True, cache_class=None, extractor=None):
+        # with an extractor the body is fed into it and the extractor is returned instead of the body,
+        # without a cache the body is streamed and the download stops once the extractor is done.
+        http_log.debug("GET URL", url=url)
+        request_type = get_request_type(url, stream, cache_class)
+        cache, cache_entry, cache_class = lookup_http_cache(self.http_cache, url, method, stream, cache_class)
+        if cache_entry:
+            res = cache.fresh_response(cache_entry, cache_class)
+            if res:
+                return feed_extractor(read_response(res, url, max_size=max_size, ensure_utf8=ensure_utf8), extractor)
+        streaming_extract = extractor is not None and cache is None
+
         if throttle:
-            delay = self.session_throttle.run()
+            delay = self.rate_limiter.run(fix_url(url))
             if delay:
-                print('[INFO] GET URL throttle, delay for %.2f. url = %s' % (delay, url))
+                metrics.observe_throttle(url_net_loc(url), delay)
+                throttle_log.info("GET URL throttle", delay=round(delay, 3), url=url)
 
-        headers = {'User-Agent': 'UniversalFeedParser/3.3 +http://feedparser.org/'}
-
-        if stream:
-            # 如果是流式音频的话，按照mozila来请求的话
-            # shoutcast站点会直接返回网页而不是流式内容.
-            # headers['User-Agent'] = 'curl/7.35.0'
-            # headers['User-Agent'] = 'Mozilla/5.0'
-            headers['User-Agent'] = 'iTunes/9.2.1 (Macintosh; Intel Mac OS X 10.5.8) AppleWebKit/533.16'
+        headers = request_headers(stream)
+        if cache_entry:
+            headers.update(cache.conditional_headers(cache_entry))
         if stream and proxy:
-            print("[INFO] 'proxy' is not compatible with 'stream'")
+            http_log.info("'proxy' is not compatible with 'stream'")
             proxy = False
         if proxy and is_url_localhost(url):
-            print("[INFO] 'proxy' is not compatible with url: 'localhost'")
+            http_log.info("'proxy' is not compatible with url: 'localhost'")
             proxy = False
-        ss = requests.session()
         res = None
 
         # fix url
         if url.startswith("mms"):
-            print('[ERROR] URL is invalid. url = %s' % url)
+            http_log.error("URL is invalid", url=url)
             return None
         url = fix_url(url)
 
+        # stream probes only read the headers, so their connection can never be reused.
+        pool_key = None if stream else url_pool_key(url)
+        ss = self.connection_pool.acquire(pool_key) if pool_key else None
+        if ss is None:
+            ss = make_session(get_dns_cache(self.dns_cache))
+
+        timer = Timer()
+        timer.start()
         try:
             timeout = http_timeout or self.http_timeout
             # connect timeout and read timeout.
@@ -110,8 +803,8 @@ class HttpClient(object):
                 'timeout': (timeout * 0.5, timeout * 0.8),
                 'headers': headers
             }
-            if stream:
-                kwargs['stream'] = stream
+            if stream or streaming_extract:
+                kwargs['stream'] = True
             if method == 'POST':
                 kwargs['data'] = data
 
@@ -122,6 +815,9 @@ class HttpClient(object):
         except requests.exceptions.InvalidURL as e:
             error_tag = 'InvalidURL'
             assert (res is None)
+        except requests.Timeout as e:
+            error_tag = 'Timeout'
+            assert (res is None)
         except requests.ConnectionError as e:
             error_tag = 'ConnectionError'
             assert (res is None)
@@ -129,83 +825,244 @@ class HttpClient(object):
             error_tag = 'TooManyRedirects'
             assert (res is None)
         except:
-            traceback.print_exc()
+            http_log.exception("GET URL failed", url=url)
             error_tag = 'OtherError'
             assert (res is None)
 
+        observe_request(self.controller, url, request_type, timer.stop(), res, error_tag if res is None else None)
         # connection problem.
         if res is None:
             ss.close()
-            print('[ERROR] GET URL connect. url = %s, error_tag = %s' % (url, error_tag))
+            http_log.error("GET URL connect", url=url, error_tag=error_tag)
             return None
 
-        # not modified.
-        if res.status_code == 304:
-            ss.close()
-            print('[INFO] GET URL content not modified. url = %s' % url)
+        try:
+            if streaming_extract:
+                return self.read_response_into(res, url, extractor, max_size=max_size)
+            if cache:
+                res = cache.update(url, cache_class, cache_entry, res)
+            value = read_response(res, url, stream=stream, max_size=max_size, ensure_utf8=ensure_utf8)
+            return feed_extractor(value, extractor)
+        finally:
+            if pool_key:
+                self.connection_pool.release(pool_key, ss)
+            else:
+                ss.close()
 
-        # http server problem.
-        if res.status_code != 200 and res.status_code != 304:
-            ss.close()
-            print('[ERROR] GET URL http. code = %d, url = %s' % (res.status_code, url))
+    def read_response_into(self, res, url, extractor, max_size=None):
+        streaming = StreamingExtract(url, extractor, max_size=max_size, content_length=res.headers.get('content-length'))
+        if not streaming.check_status(res.status_code):
+            return None
+        try:
+            for chunk in res.iter_content(chunk_size=STREAMING_CHUNK_SIZE):
+                if not streaming.feed(chunk):
+                    break
+        except requests.RequestException as e:
+            http_log.error("GET URL read", url=url, error=e)
             return None
+        finally:
+            # an early cutoff leaves the rest of the body unread, so the connection is dropped
+            res.close()
+        return streaming.finish()
 
-        # how to interpret data.
-        if stream:
-            value = parse_stream_url_data(res)
-            if not value:
-                ss.close()
-                print('[ERROR] GET URL data fn. url = %s' % url)
-                return None
-        else:
-            value = res.content
-        ss.close()
 
-        bytes().decode()
-        if value is None:
-            return None
+def make_session(dns_cache=None):
+    # the pooled sessions are shared by the clients, so they keep the dns cache they were made with
+    ss = requests.session()
+    if dns_cache is not None:
+        adapter = DnsCacheAdapter(dns_cache)
+        ss.mount('http://', adapter)
+        ss.mount('https://', adapter)
+    return ss
 
-        # control size.
-        size = len(value)
-        if max_size and size > max_size:
-            print('[ERROR] GET URL content exceeds max_size. size = %d, url = %s' % (size, url))
-            return None
 
-        # ensure utf8.
-        if ensure_utf8:
-            # utf-8 or not.
+def get_request_type(url, stream=False, cache_class=None):
+    # the label of a request in the latency metrics: genre/station/iframe/playlist, stream or default
+    return cache_class or ('stream' if stream else classify_url(url))
+
+
+def observe_request(controller, url, request_type, latency, res=None, error_tag=None):
+    status = res.status_code if res is not None else None
+    metrics.observe_request(url_net_loc(url), request_type, latency, status, error_tag)
+    if controller is not None:
+        controller.observe(latency, status=status, timeout=error_tag == 'Timeout')
+
+
+STREAMING_CHUNK_SIZE = 8 * 1024
+
+
+class TransferStats(object):
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.pages = 0
+        self.cutoffs = 0
+        self.bytes_read = 0
+        self.bytes_skipped = 0
+
+    def add(self, bytes_read, cutoff, content_length=None):
+        with self.mutex:
+            self.pages += 1
+            self.bytes_read += bytes_read
+            if cutoff:
+                self.cutoffs += 1
+                if content_length and content_length.isdigit():
+                    self.bytes_skipped += max(int(content_length) - bytes_read, 0)
+
+    def stats(self):
+        with self.mutex:
+            return {
+                'pages': self.pages,
+                'cutoffs': self.cutoffs,
+                'bytes_read': self.bytes_read,
+                'bytes_skipped': self.bytes_skipped
+            }
+
+
+transfer_stats = TransferStats()
+
+
+class StreamingExtract(object):
+    """
+    decodes body chunks as utf-8 and feeds them into a html_extractor.PageExtractor,
+    feed() returns False as soon as the extractor has every field it needs.
+    shared by HttpClient and AsyncHttpClient.
+    """
+
+    def __init__(self, url, extractor, max_size=None, content_length=None):
+        self.url = url
+        self.extractor = extractor
+        self.max_size = max_size
+        self.content_length = content_length
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.size = 0
+        self.failed = False
+
+    def check_status(self, status_code):
+        if status_code != 200:
+            http_log.error("GET URL http", code=status_code, url=self.url)
+            return False
+        return True
+
+    def feed(self, chunk):
+        self.size += len(chunk)
+        if self.max_size and self.size > self.max_size:
+            http_log.error("GET URL content exceeds max_size", size=self.size, url=self.url)
+            self.failed = True
+            return False
+        try:
+            self.extractor.feed(self.decoder.decode(chunk))
+        except UnicodeDecodeError:
+            http_log.error("GET URL content not utf-8", url=self.url)
+            self.failed = True
+            return False
+        return not self.extractor.done
+
+    def finish(self):
+        if self.failed:
+            return None
+        cutoff = self.extractor.done
+        if not cutoff:
             try:
-                value = value.decode('utf-8')
-            except:
-                print('[ERROR] GET URL content not utf-8. url = %s' % url)
+                self.extractor.feed(self.decoder.decode(b'', final=True))
+            except UnicodeDecodeError:
+                http_log.error("GET URL content not utf-8", url=self.url)
                 return None
+        transfer_stats.add(self.size, cutoff, self.content_length)
+        return self.extractor
 
-        # update headers.
-        if 'Last-Modified' in res.headers:
-            headers['If-Modified-Since'] = res.headers['Last-Modified']
-        if 'ETag' in res.headers:
-            headers['If-None-Match'] = res.headers['ETag']
 
+def feed_extractor(value, extractor):
+    if value is None or extractor is None:
         return value
+    # the page is whole already
+    extractor.feed_page(value)
+    return extractor
+
+
+def request_headers(stream=False):
+    headers = {'User-Agent': 'UniversalFeedParser/3.3 +http://feedparser.org/'}
+
+    if stream:
+        # 如果是流式音频的话，按照mozila来请求的话
+        # shoutcast站点会直接返回网页而不是流式内容.
+        # headers['User-Agent'] = 'curl/7.35.0'
+        # headers['User-Agent'] = 'Mozilla/5.0'
+        headers['User-Agent'] = 'iTunes/9.2.1 (Macintosh; Intel Mac OS X 10.5.8) AppleWebKit/533.16'
+    return headers
+
+
+def read_response(res, url, stream=False, max_size=None, ensure_utf8=True, playlist_types=False):
+    # shared by HttpClient and AsyncHttpClient, res only needs status_code, headers, url and content
+    # not modified.
+    if res.status_code == 304:
+        http_log.debug("GET URL content not modified", url=url)
+
+    # http server problem.
+    if res.status_code != 200 and res.status_code != 304:
+        http_log.error("GET URL http", code=res.status_code, url=url)
+        return None
+
+    # how to interpret data.
+    if stream:
+        value = parse_stream_url_data(res, playlist_types)
+        if not value:
+            http_log.error("GET URL data fn", url=url)
+            return None
+    else:
+        value = res.content
+
+    if value is None:
+        return None
+
+    # control size.
+    size = len(value)
+    if max_size and size > max_size:
+        http_log.error("GET URL content exceeds max_size", size=size, url=url)
+        return None
+
+    # ensure utf8, the stream data is already a json string.
+    if ensure_utf8 and isinstance(value, bytes):
+        # utf-8 or not.
+        try:
+            value = value.decode('utf-8')
+        except:
+            http_log.error("GET URL content not utf-8", url=url)
+            return None
+    return value
 
 
 def get_sha1_key(s):
+    if not isinstance(s, bytes):
+        s = s.encode('utf-8')
     return hashlib.sha1(s).hexdigest()
 
 
-def parse_playlist_data(data):
+def parse_playlist_data(data, url=None, max_streams=None):
+    # the raw bytes, the format is sniffed from the first of them and the url extension only breaks a tie
     if not data:
         return []
     try:
-        pls = plparser.parse(filedata=data)
-        xs = map(lambda x: x.File.strip(), pls.Tracks)
+        # a list, so the result can come back from an extraction process
+        xs = [x.strip() for x in plparser.streamUrls(data, fileName=url, limit=max_streams) if x.strip()]
     except:
-        traceback.print_exc()
+        http_log.exception("can not parse the playlist", url=url)
         xs = []
     return xs
 
 
-def parse_stream_url_data(res):
+def decode_header_value(value):
+    # header values are read as latin-1, most servers send utf-8 in them though
+    if isinstance(value, bytes):
+        value = value.decode('latin-1')
+    try:
+        return value.encode('latin-1').decode('utf-8')
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return value
+
+
+def parse_stream_url_data(res, playlist_types=False):
+    # the json of an audio or video stream, None for anything else. with playlist_types a playlist or
+    # text/plain content type is reported too, so the stream resolver can tell a playlist from it.
     headers = res.headers
     ct = headers.get('content-type', '')
 
@@ -219,8 +1076,9 @@ def parse_stream_url_data(res):
         ct = 'audio/mp3'
     # print ct, ext
 
-    if ct and not ct.startswith('audio/') and not ct.startswith('video/'):
-        print('>>>>> PARSE STREAM URL DATA FAILED. ct = %s, url = %s' % (ct, res.url))
+    if ct and not ct.startswith('audio/') and not ct.startswith('video/') \
+            and not (playlist_types and (is_playlist_content_type(ct) or ct.startswith('text/plain'))):
+        http_log.error("PARSE STREAM URL DATA FAILED", ct=ct, url=res.url)
         return None
 
     d = {}
@@ -228,10 +1086,7 @@ def parse_stream_url_data(res):
     fields = ('icy-genre', 'icy-name', 'icy-url', 'icy-description')
     for f in fields:
         if f in headers:
-            try:
-                v = headers[f].decode('utf-8').encode('utf-8')
-            except:
-                v = ''
+            v = decode_header_value(headers[f]).strip()
             if f == 'icy-url' and v:
                 v = fix_url(v)
             d[f] = v
@@ -250,32 +1105,74 @@ def fix_url(url):
     return result
 
 
-class OutputFile(object):
-    def __init__(self, output_file_name):
-        if output_file_name:
-            self.file = open(output_file_name, "w")
-            self.mutex = threading.Lock()
+class Journal(object):
+    """
+    append-only checkpoint journal, one json list per line: [kind, key, values...].
+    an entry is recorded after its work is written out, so on resume every entry found
+    in the journal is finished, a crash in between only repeats that piece of work.
+    """
+
+    def __init__(self, file_name, resume=False, fsync_interval=1.0):
+        self.file_name = file_name
+        self.mutex = threading.Lock()
+        self.fsync_interval = fsync_interval
+        self.last_fsync = time.time()
+        self.keys = set()
+        self.values = {}
+        if resume:
+            truncate_partial_line(file_name)
+            self.load()
+        self.file = open(file_name, "a" if resume else "w")
+
+    def load(self):
+        if not os.path.exists(self.file_name):
+            return
+        count = 0
+        with open(self.file_name) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    journal_log.warning("skip the invalid line %r of %s", line, self.file_name)
+                    continue
+                self.add(entry)
+                count += 1
+        journal_log.info("loaded %d entries from %s", count, self.file_name)
+
+    def add(self, entry):
+        kind, key = entry[0], entry[1]
+        self.keys.add((kind, key))
+        if len(entry) > 2:
+            self.values.setdefault((kind, key), []).append(entry[2:])
+
+    def contains(self, kind, key):
+        return (kind, key) in self.keys
+
+    def get_values(self, kind, key):
+        return self.values.get((kind, key), [])
 
-    def write_json(self, json_data):
-        if self.mutex.acquire(True):
+    def record(self, kind, key, *values):
+        entry = [kind, key] + list(values)
+        line = json.dumps(entry) + "\n"
+        with self.mutex:
+            self.add(entry)
+            self.file.write(line)
+            self.file.flush()
+            # flushing survives a killed process, the periodic fsync bounds the loss on a power cut
+            if time.time() - self.last_fsync >= self.fsync_interval:
+                os.fsync(self.file.fileno())
+                self.last_fsync = time.time()
+
+    def close(self):
+        with self.mutex:
             try:
-                line = json.dumps(json_data) + "\n"
-                self.file.write(line.encode('utf-8'))
                 self.file.flush()
-            finally:
-                self.mutex.release()
+                os.fsync(self.file.fileno())
+                self.file.close()
+            except:
+                journal_log.exception("can not close %s", self.file_name)
 
-    def destroy(self):
-        try:
-            self.file.flush()
-            self.file.close()
-        except:
-            traceback.print_stack()
 
+def get_journal_file_name(output_file_name):
+    return output_file_name + ".journal"
 
-if __name__ == "__main__":
-    output_file = OutputFile("a.output")
-    output_file.write_json({"a":123, "b":"123"})
-    output_file.write_json({"a":323, "b":"323"})
-    output_file.write_json({"a":133, "b":"133"})
-    output_file.destroy()